@@ -61,7 +61,7 @@ from phones.models import (
     suggested_numbers,
 )
 from privaterelay.ftl_bundles import main as ftl_bundle
-from privaterelay.utils import glean_logger
+from privaterelay.utils import glean_logger, update_counters
 
 from ..exceptions import ConflictError
 from ..permissions import HasPhoneService
@@ -772,9 +772,7 @@ def inbound_sms(request):
                     {"code": e.code, "http_status_code": e.status, "msg": e.msg},
                 )
             if success:
-                relay_number.remaining_texts -= 1
-                relay_number.texts_forwarded += 1
-                relay_number.save()
+                relay_number.increment_counters(remaining_texts=-1, texts_forwarded=1)
 
         return response.Response(
             status=200,
@@ -818,12 +816,9 @@ def inbound_sms(request):
                 {"code": e.code, "http_status_code": e.status, "msg": e.msg},
             )
     if result == "SUCCESS":
-        relay_number.remaining_texts -= 1
-        relay_number.texts_forwarded += 1
-        relay_number.save()
+        relay_number.increment_counters(remaining_texts=-1, texts_forwarded=1)
     elif result == "BLOCKED":
-        relay_number.texts_blocked += 1
-        relay_number.save()
+        relay_number.increment_counters(texts_blocked=1)
 
     return response.Response(
         status=201,
@@ -946,8 +941,7 @@ def inbound_call(request):
     if inbound_contact:
         _check_and_update_contact(inbound_contact, "calls", relay_number)
 
-    relay_number.calls_forwarded += 1
-    relay_number.save()
+    relay_number.increment_counters(calls_forwarded=1)
 
     # Note: TemplateTwiMLRenderer will render this as TwiML
     incr_if_enabled("phones_outbound_call")
@@ -1006,8 +1000,7 @@ def voice_status(request):
     if call_duration is None:
         raise exceptions.ValidationError("completed call data missing CallDuration")
     relay_number, _ = _get_phone_objects(called)
-    relay_number.remaining_seconds = relay_number.remaining_seconds - int(call_duration)
-    relay_number.save()
+    relay_number.increment_counters(remaining_seconds=-int(call_duration))
     if relay_number.remaining_seconds < 0:
         info_logger.info(
             "phone_limit_exceeded",
@@ -1505,8 +1498,7 @@ def _check_disabled(relay_number, contact_type):
     if not relay_number.enabled:
         attr = f"{contact_type}_blocked"
         incr_if_enabled(f"phones_{contact_type}_global_blocked")
-        setattr(relay_number, attr, getattr(relay_number, attr) + 1)
-        relay_number.save()
+        relay_number.increment_counters(**{attr: 1})
         return True
 
 
@@ -1537,23 +1529,20 @@ def _check_and_update_contact(inbound_contact, contact_type, relay_number):
     if inbound_contact.blocked:
         incr_if_enabled(f"phones_{contact_type}_specific_blocked")
         contact_attr = f"num_{contact_type}_blocked"
-        setattr(
-            inbound_contact, contact_attr, getattr(inbound_contact, contact_attr) + 1
-        )
-        inbound_contact.save()
+        update_counters(inbound_contact, {contact_attr: 1})
         relay_attr = f"{contact_type}_blocked"
-        setattr(relay_number, relay_attr, getattr(relay_number, relay_attr) + 1)
-        relay_number.save()
+        relay_number.increment_counters(**{relay_attr: 1})
         raise exceptions.ValidationError(f"Number is not accepting {contact_type}.")
 
-    inbound_contact.last_inbound_date = datetime.now(UTC)
+    last_inbound_date = datetime.now(UTC)
     singular_contact_type = contact_type[:-1]  # strip trailing "s"
-    inbound_contact.last_inbound_type = singular_contact_type
-    attr = f"num_{contact_type}"
-    setattr(inbound_contact, attr, getattr(inbound_contact, attr) + 1)
-    last_date_attr = f"last_{singular_contact_type}_date"
-    setattr(inbound_contact, last_date_attr, inbound_contact.last_inbound_date)
-    inbound_contact.save()
+    update_counters(
+        inbound_contact,
+        {f"num_{contact_type}": 1},
+        last_inbound_date=last_inbound_date,
+        last_inbound_type=singular_contact_type,
+        **{f"last_{singular_contact_type}_date": last_inbound_date},
+    )
 
 
 def _validate_twilio_request(request):
@@ -1,3 +1,5 @@
+import atexit
+import json
 import logging
 import os
 from typing import NamedTuple
@@ -12,6 +14,10 @@ from mypy_boto3_ses.client import SESClient
 
 logger = logging.getLogger("events")
 
+# Tracker list files, created by the get_latest_email_tracker_lists command
+TRACKER_LIST_FILE_NAMES = {1: "level-one-trackers.json", 2: "level-two-trackers.json"}
+TRACKER_INDEX_FILE_NAME = "tracker-index.json"
+
 
 # Bad words are split into short and long words
 class BadWords(NamedTuple):
@@ -21,6 +27,16 @@ class BadWords(NamedTuple):
     long: list[str]
 
 
+# The tracker lists, loaded from the tracker index
+class TrackerLists(NamedTuple):
+    # A hash of the lists, or an empty string if loaded without an index
+    version: str
+    # Level one (general) tracker domains, in list order
+    level_one: tuple[str, ...]
+    # Level two (strict) tracker domains, in list order
+    level_two: tuple[str, ...]
+
+
 class EmailsConfig(AppConfig):
     name = "emails"
 
@@ -61,6 +77,21 @@ class EmailsConfig(AppConfig):
             long=sorted(set(word for word in _badwords if len(word) > 4)),
         )
         self.blocklist = set(self._load_terms("blocklist.text"))
+        self.tracker_lists = self._load_tracker_lists()
+
+    def ready(self) -> None:
+        import emails.signals  # noqa: F401 (imported but unused warning)
+
+        # Build the tracker indexes once, before any worker processes are forked
+        from .utils import prepare_tracker_indexes
+
+        prepare_tracker_indexes()
+
+        if settings.COUNTER_BUFFER == "memory":
+            # Write the buffered counters when the process exits normally
+            from .counter_buffer import flush_counter_buffer
+
+            atexit.register(flush_counter_buffer)
 
     def _load_terms(self, filename: str) -> list[str]:
         """Load a list of terms from a file."""
@@ -74,6 +105,35 @@ class EmailsConfig(AppConfig):
                 terms.append(word)
         return terms
 
+    def _load_tracker_lists(self) -> TrackerLists:
+        """
+        Load the tracker lists from the tracker index.
+
+        If the index is missing, the separate tracker list files are loaded. If those
+        are missing, the lists are empty. The lists are never downloaded, since that
+        would delay processing an email.
+        """
+        folder = os.path.join(settings.BASE_DIR, "emails", "tracker_lists")
+        try:
+            with open(os.path.join(folder, TRACKER_INDEX_FILE_NAME)) as index_file:
+                index = json.load(index_file)
+        except FileNotFoundError:
+            pass
+        else:
+            return TrackerLists(
+                index["version"], tuple(index["level_one"]), tuple(index["level_two"])
+            )
+
+        lists: dict[int, tuple[str, ...]] = {}
+        for level, file_name in TRACKER_LIST_FILE_NAMES.items():
+            try:
+                with open(os.path.join(folder, file_name)) as list_file:
+                    lists[level] = tuple(json.load(list_file))
+            except FileNotFoundError:
+                logger.warning("tracker_list_missing", extra={"file_name": file_name})
+                lists[level] = ()
+        return TrackerLists("", lists[1], lists[2])
+
 
 def emails_config() -> EmailsConfig:
     emails_config = apps.get_app_config("emails")
@@ -0,0 +1,261 @@
+"""
+Buffer mask and profile counters, and write them to the database in batches.
+
+Each forwarded or blocked email adds to the mask's counters, and sets the mask's
+last_used_at and the profile's last_engagement. When a mask gets a burst of email,
+these UPDATEs wait on the same row locks. With the counter buffer, the changes are
+added up outside of the database, and a flush writes one UPDATE per changed row.
+
+settings.COUNTER_BUFFER selects where changes are buffered:
+* "" (the default): No buffer, each change is written with update_counters.
+* "memory": In process memory. Changes are flushed when the process exits normally,
+  but are lost if it is killed. process_emails_from_sqs only allows it with --async,
+  since its worker processes are terminated without a flush.
+* "cache": In the cache settings.COUNTER_BUFFER_CACHE, such as Redis. Changes are
+  kept when a process exits, and any process can flush them.
+
+Buffered changes are flushed at most once per settings.COUNTER_BUFFER_FLUSH_SECONDS,
+when the next change is recorded, and after each process_emails_from_sqs cycle,
+which also runs when the queue is empty. Until then, the database counts are behind.
+Changes for a mask that is deleted before the flush are dropped.
+"""
+
+import logging
+import threading
+import time
+from collections import Counter
+from collections.abc import Mapping
+from datetime import datetime
+from typing import Any
+
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models import F, IntegerField, Model, Value
+from django.db.models.functions import Coalesce, Greatest
+
+from privaterelay.utils import update_counters
+
+from .utils import incr_if_enabled
+
+logger = logging.getLogger("events")
+
+# A buffered change: model label, primary key, counter increments, and timestamps
+BufferedChange = tuple[str, Any, dict[str, int], dict[str, datetime]]
+
+# Buffered changes added up by row: (model label, primary key) to
+# (counter totals, latest timestamps)
+PendingChanges = dict[tuple[str, Any], tuple[Counter[str], dict[str, datetime]]]
+
+# In "memory" mode, the changes since the last flush
+_memory_changes: PendingChanges = {}
+_memory_lock = threading.Lock()
+
+# The monotonic time when this process next checks if a flush is due
+_next_flush_check = 0.0
+
+# In "cache" mode, each change is stored as a numbered entry. The sequence is the
+# last entry number, and the cursor is the last entry number that was flushed.
+_CACHE_KEY_PREFIX = "counter_buffer:v1:"
+_SEQUENCE_KEY = _CACHE_KEY_PREFIX + "sequence"
+_CURSOR_KEY = _CACHE_KEY_PREFIX + "cursor"
+# The sequence at the last flush. A missing entry after it may still be written.
+_SEEN_KEY = _CACHE_KEY_PREFIX + "seen"
+_LOCK_KEY = _CACHE_KEY_PREFIX + "lock"
+_FLUSH_DUE_KEY = _CACHE_KEY_PREFIX + "flushed"
+_ENTRY_SECONDS = 60 * 60 * 24
+_LOCK_SECONDS = 60 * 5
+_CACHE_BATCH_SIZE = 500
+_CACHE_MAX_ENTRIES_PER_FLUSH = 50_000
+
+
+def buffer_counters(
+    instance: Model,
+    counters: Mapping[str, int] | None = None,
+    **timestamps: datetime,
+) -> None:
+    """
+    Add to counters and move timestamps forward on a saved model, in the buffer.
+
+    When flushed, the counters are added to the database counts, and a timestamp is
+    only written if it is later than the stored one. The instance gets the same
+    changes. Without a buffer, this is the same as update_counters.
+    """
+    if not settings.COUNTER_BUFFER:
+        update_counters(instance, counters, **timestamps)
+        return
+
+    counters = dict(counters or {})
+    change: BufferedChange = (
+        instance._meta.label_lower,
+        instance.pk,
+        counters,
+        timestamps,
+    )
+    if settings.COUNTER_BUFFER == "cache":
+        _append_to_cache(change)
+    else:
+        with _memory_lock:
+            _add_change(_memory_changes, change)
+
+    for name, amount in counters.items():
+        setattr(instance, name, (getattr(instance, name) or 0) + amount)
+    for name, value in timestamps.items():
+        setattr(instance, name, value)
+
+    flush_counter_buffer_if_due()
+
+
+def flush_counter_buffer_if_due() -> int:
+    """
+    Flush the buffered changes if the flush interval has passed.
+
+    Return the rows updated. A failed flush is logged rather than raised, so that
+    it does not fail the email that triggered it.
+    """
+    global _next_flush_check
+
+    if not settings.COUNTER_BUFFER:
+        return 0
+    now = time.monotonic()
+    if now < _next_flush_check:
+        return 0
+    _next_flush_check = now + settings.COUNTER_BUFFER_FLUSH_SECONDS
+    if settings.COUNTER_BUFFER == "cache":
+        # Flush once per interval across processes
+        buffer_cache = caches[settings.COUNTER_BUFFER_CACHE]
+        if not buffer_cache.add(
+            _FLUSH_DUE_KEY, True, timeout=settings.COUNTER_BUFFER_FLUSH_SECONDS
+        ):
+            return 0
+    try:
+        return flush_counter_buffer()
+    except Exception:
+        # The changes stay buffered for the next flush
+        logger.exception("counter_buffer_flush_failed")
+        return 0
+
+
+def flush_counter_buffer() -> int:
+    """Write the buffered changes to the database, and return the rows updated."""
+    if settings.COUNTER_BUFFER == "memory":
+        return _flush_memory()
+    if settings.COUNTER_BUFFER == "cache":
+        return _flush_cache()
+    return 0
+
+
+def _add_change(pending: PendingChanges, change: BufferedChange) -> None:
+    """Add a buffered change to the pending changes for its row."""
+    label, pk, counters, timestamps = change
+    counts, latest = pending.setdefault((label, pk), (Counter(), {}))
+    counts.update(counters)
+    for name, value in timestamps.items():
+        if name not in latest or value > latest[name]:
+            latest[name] = value
+
+
+def _write_changes(pending: PendingChanges) -> int:
+    """Write the pending changes in one transaction, and return the rows updated."""
+    updated = 0
+    with transaction.atomic():
+        # Update rows in a fixed order, so concurrent flushes do not deadlock
+        for label, pk in sorted(pending, key=lambda key: (key[0], str(key[1]))):
+            counts, latest = pending[(label, pk)]
+            changes: dict[str, Any] = {
+                name: Coalesce(F(name), 0, output_field=IntegerField()) + amount
+                for name, amount in counts.items()
+                if amount
+            }
+            for name, value in latest.items():
+                changes[name] = Greatest(Coalesce(F(name), Value(value)), Value(value))
+            if changes:
+                model = apps.get_model(label)
+                updated += model._default_manager.filter(pk=pk).update(**changes)
+    incr_if_enabled("counter_buffer.rows_flushed", updated)
+    return updated
+
+
+def _flush_memory() -> int:
+    """Write the changes buffered in this process."""
+    global _memory_changes
+
+    with _memory_lock:
+        pending, _memory_changes = _memory_changes, {}
+    if not pending:
+        return 0
+    try:
+        return _write_changes(pending)
+    except Exception:
+        # Put the changes back, to retry on the next flush
+        with _memory_lock:
+            for (label, pk), (counts, latest) in pending.items():
+                _add_change(_memory_changes, (label, pk, dict(counts), latest))
+        raise
+
+
+def _append_to_cache(change: BufferedChange) -> None:
+    """Store a buffered change as the next numbered entry in the cache."""
+    buffer_cache = caches[settings.COUNTER_BUFFER_CACHE]
+    buffer_cache.add(_SEQUENCE_KEY, 0, timeout=None)
+    try:
+        number = buffer_cache.incr(_SEQUENCE_KEY)
+    except ValueError:
+        # The sequence was evicted after the add
+        buffer_cache.add(_SEQUENCE_KEY, 0, timeout=None)
+        number = buffer_cache.incr(_SEQUENCE_KEY)
+    buffer_cache.set(_entry_key(number), change, timeout=_ENTRY_SECONDS)
+
+
+def _entry_key(number: int) -> str:
+    return f"{_CACHE_KEY_PREFIX}entry:{number}"
+
+
+def _flush_cache() -> int:
+    """
+    Write the changes buffered in the cache.
+
+    A process numbers an entry before it stores it, so an entry may be missing
+    because it is not stored yet. A missing entry is waited for until the next
+    flush, and then skipped. An entry is deleted after the changes are written, so
+    it can be written twice if the flush stops between the two steps.
+    """
+    buffer_cache = caches[settings.COUNTER_BUFFER_CACHE]
+    if not buffer_cache.add(_LOCK_KEY, True, timeout=_LOCK_SECONDS):
+        return 0  # Another process is flushing
+    try:
+        sequence = buffer_cache.get(_SEQUENCE_KEY, 0)
+        cursor = buffer_cache.get(_CURSOR_KEY, 0)
+        seen = buffer_cache.get(_SEEN_KEY, 0)
+        if sequence < cursor:
+            # The sequence was evicted and restarted
+            cursor = seen = 0
+        last = min(sequence, cursor + _CACHE_MAX_ENTRIES_PER_FLUSH)
+
+        pending: PendingChanges = {}
+        found_keys: list[str] = []
+        first_waiting = None
+        for start in range(cursor + 1, last + 1, _CACHE_BATCH_SIZE):
+            numbers = range(start, min(start + _CACHE_BATCH_SIZE, last + 1))
+            entries = buffer_cache.get_many([_entry_key(num) for num in numbers])
+            for number in numbers:
+                key = _entry_key(number)
+                if key in entries:
+                    _add_change(pending, entries[key])
+                    found_keys.append(key)
+                elif number > seen and first_waiting is None:
+                    first_waiting = number
+
+        updated = _write_changes(pending) if pending else 0
+        buffer_cache.delete_many(found_keys)
+        buffer_cache.set_many(
+            {
+                _CURSOR_KEY: last if first_waiting is None else first_waiting - 1,
+                _SEEN_KEY: last,
+            },
+            timeout=None,
+        )
+        return updated
+    finally:
+        buffer_cache.delete(_LOCK_KEY)
@@ -0,0 +1,600 @@
+"""
+Benchmark the email pipeline with local stand-ins for AWS.
+
+A corpus of SES notifications ("Received", "Bounce", and "Complaint") is signed
+like SNS messages and loaded into an in-memory SQS queue. The queue is processed
+with the batch code of process_emails_from_sqs, with each message processed in
+this process instead of a worker process. The emails app uses in-memory fakes for
+its S3 and SES clients. A Relay user with a mask receives the emails, and a second
+user receives the bounces and complaints, so that a hard bounce or complaint does
+not change how the emails are forwarded. Both users are deleted at the end.
+
+The report includes messages per second, p50 / p95 / p99 latency for each stage,
+and the peak RSS. The stages are:
+* verify: Parsing and verifying the SNS notification
+* The stages timed by _handle_received, such as s3_load, parse, convert, and
+  ses_send. These exclude the stages nested inside them, and have millisecond
+  precision.
+* db: Running database queries, during any stage
+* total: Processing the message
+
+Run against a development database, such as:
+
+./manage.py bench_email_pipeline --messages 500
+"""
+
+from __future__ import annotations
+
+import base64
+import json
+import logging
+import resource
+import statistics
+import sys
+import time
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+from datetime import UTC, datetime
+from email import message_from_bytes
+from email.utils import parseaddr
+from io import BytesIO
+from pathlib import Path
+from typing import Any
+from uuid import uuid4
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.core.management.base import BaseCommand, CommandError, CommandParser
+from django.db import connection
+from django.http import HttpResponse
+from django.test import override_settings
+
+from allauth.socialaccount.models import SocialAccount
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import padding, rsa
+
+from emails.apps import emails_config
+from emails.management.commands import process_emails_from_sqs
+from emails.models import RelayAddress
+from emails.sns import _get_hash_format
+
+FIXTURES_PATH = Path(__file__).parents[2] / "tests" / "fixtures"
+
+BENCH_REGION = "us-east-1"
+BENCH_TOPIC_ARN = f"arn:aws:sns:{BENCH_REGION}:000000000000:bench-email-pipeline"
+BENCH_QUEUE_URL = (
+    f"https://sqs.{BENCH_REGION}.amazonaws.com/000000000000/bench-email-pipeline"
+)
+BENCH_CERT_URL = (
+    f"https://sns.{BENCH_REGION}.amazonaws.com/SimpleNotificationService-bench.pem"
+)
+BENCH_BUCKET = "bench-email-pipeline"
+
+DEFAULT_MIX = "received:8,bounce:1,complaint:1"
+
+
+class FakeMessage:
+    """An SQS message, with the attributes used by process_emails_from_sqs."""
+
+    def __init__(self, queue_url: str, body: str) -> None:
+        self.queue_url = queue_url
+        self.message_id = str(uuid4())
+        self.receipt_handle = f"bench-{self.message_id}"
+        self.body = body
+        self.attributes = {"ApproximateReceiveCount": "1"}
+
+
+class FakeQueue:
+    """An in-memory SQS queue, with the methods used by process_emails_from_sqs."""
+
+    def __init__(self, url: str, bodies: list[str]) -> None:
+        self.url = url
+        self.messages = [FakeMessage(url, body) for body in bodies]
+        self.attributes: dict[str, str] = {}
+        self.load()
+
+    def load(self) -> None:
+        self.attributes = {
+            "ApproximateNumberOfMessages": str(len(self.messages)),
+            "ApproximateNumberOfMessagesDelayed": "0",
+            "ApproximateNumberOfMessagesNotVisible": "0",
+        }
+
+    def receive_messages(
+        self, MaxNumberOfMessages: int = 1, **kwargs: Any
+    ) -> list[FakeMessage]:
+        batch = self.messages[:MaxNumberOfMessages]
+        del self.messages[:MaxNumberOfMessages]
+        return batch
+
+    def _all_successful(self, Entries: list[dict[str, Any]]) -> dict[str, Any]:
+        return {"Successful": [{"Id": entry["Id"]} for entry in Entries]}
+
+    def delete_messages(self, Entries: list[dict[str, Any]]) -> dict[str, Any]:
+        return self._all_successful(Entries)
+
+    def change_message_visibility_batch(
+        self, Entries: list[dict[str, Any]]
+    ) -> dict[str, Any]:
+        return self._all_successful(Entries)
+
+
+class FakeS3Client:
+    """An in-memory S3 client, for the calls in emails.utils"""
+
+    def __init__(self) -> None:
+        self.objects: dict[tuple[str, str], bytes] = {}
+
+    def get_object(self, Bucket: str, Key: str) -> dict[str, Any]:
+        return {"Body": BytesIO(self.objects[(Bucket, Key)])}
+
+    def delete_object(self, Bucket: str, Key: str) -> dict[str, Any]:
+        self.objects.pop((Bucket, Key), None)
+        return {"DeleteMarker": True}
+
+
+class FakeSESClient:
+    """An SES client that accepts and discards emails"""
+
+    def send_raw_email(self, **kwargs: Any) -> dict[str, Any]:
+        return {"MessageId": f"{uuid4()}-000000"}
+
+
+class InlineResult:
+    """A finished result, like multiprocessing.pool.AsyncResult"""
+
+    def ready(self) -> bool:
+        return True
+
+    def wait(self, timeout: float | None = None) -> None:
+        return None
+
+
+class InlinePool:
+    """A worker pool that runs each task in this process when it is submitted."""
+
+    def apply_async(
+        self,
+        func: Callable[..., Any],
+        args: tuple[Any, ...] = (),
+        callback: Callable[[Any], None] | None = None,
+        error_callback: Callable[[BaseException], None] | None = None,
+    ) -> InlineResult:
+        try:
+            result = func(*args)
+        except Exception as e:
+            if error_callback:
+                error_callback(e)
+        else:
+            if callback:
+                callback(result)
+        return InlineResult()
+
+
+class StageSamples:
+    """Collect the time spent in each stage, per message."""
+
+    def __init__(self) -> None:
+        self.samples: dict[str, list[float]] = {}
+        self.current: dict[str, float] = {}
+
+    def add(self, stage: str, seconds: float) -> None:
+        self.current[stage] = self.current.get(stage, 0.0) + seconds
+
+    def time_query(
+        self,
+        execute: Callable[..., Any],
+        sql: str,
+        params: Any,
+        many: bool,
+        context: dict[str, Any],
+    ) -> Any:
+        """Database execute wrapper, to time queries"""
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.add("db", time.perf_counter() - start)
+
+    @contextmanager
+    def message(self) -> Iterator[None]:
+        """Time processing one message, and record the stages it used."""
+        self.current = {}
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add("total", time.perf_counter() - start)
+            for stage, seconds in self.current.items():
+                self.samples.setdefault(stage, []).append(seconds)
+
+    def report(self) -> dict[str, dict[str, float | int]]:
+        """Return the count and percentiles for each stage, in milliseconds."""
+        report: dict[str, dict[str, float | int]] = {}
+        # Stages in the order first seen, then the database and total
+        stages = [stage for stage in self.samples if stage not in ("db", "total")]
+        for stage in [*stages, "db", "total"]:
+            samples = self.samples.get(stage)
+            if not samples:
+                continue
+            if len(samples) > 1:
+                cuts = statistics.quantiles(samples, n=100, method="inclusive")
+                p50, p95, p99 = cuts[49], cuts[94], cuts[98]
+            else:
+                p50 = p95 = p99 = samples[0]
+            report[stage] = {
+                "count": len(samples),
+                "p50_ms": round(p50 * 1000, 3),
+                "p95_ms": round(p95 * 1000, 3),
+                "p99_ms": round(p99 * 1000, 3),
+            }
+        return report
+
+
+class BenchCommand(process_emails_from_sqs.Command):
+    """process_emails_from_sqs, recording the stage times of each message."""
+
+    def __init__(self, stage_samples: StageSamples) -> None:
+        super().__init__()
+        self.stage_samples = stage_samples
+
+    def start_message(self, message: Any) -> process_emails_from_sqs.InFlightMessage:
+        with self.stage_samples.message():
+            return super().start_message(message)
+
+    def parse_message(
+        self, message: Any
+    ) -> tuple[dict[str, Any], process_emails_from_sqs.InboundArgs | None]:
+        start = time.perf_counter()
+        try:
+            return super().parse_message(message)
+        finally:
+            self.stage_samples.add("verify", time.perf_counter() - start)
+
+    def record_message_result(
+        self, results: dict[str, Any], response: HttpResponse
+    ) -> None:
+        super().record_message_result(results, response)
+        for stage, seconds in results.get("stage_times_s", {}).items():
+            self.stage_samples.add(stage, seconds)
+
+
+@contextmanager
+def use_aws_clients(s3: FakeS3Client, ses: FakeSESClient) -> Iterator[None]:
+    """Set the AWS clients of the emails app, and restore them on exit."""
+    config = emails_config()
+    names = ("s3_client", "ses_client")
+    saved: dict[str, Any] = {
+        name: config.__dict__[name] for name in names if name in config.__dict__
+    }
+    # The clients are cached properties, so they are stored on the instance
+    config.__dict__.update(s3_client=s3, ses_client=ses)
+    try:
+        yield
+    finally:
+        for name in names:
+            config.__dict__.pop(name, None)
+        config.__dict__.update(saved)
+
+
+def parse_mix(value: str) -> dict[str, int]:
+    """Parse a mix like 'received:8,bounce:1' to weights by notification type."""
+    mix: dict[str, int] = {}
+    for part in value.split(","):
+        name, _, weight = part.partition(":")
+        name = name.strip().lower()
+        if name not in ("received", "bounce", "complaint"):
+            raise CommandError(f"Unknown notification type {name!r} in --mix.")
+        try:
+            mix[name] = int(weight or 1)
+        except ValueError as e:
+            raise CommandError(f"Invalid weight {weight!r} in --mix.") from e
+    if not any(mix.values()):
+        raise CommandError("--mix needs at least one positive weight.")
+    return mix
+
+
+def peak_rss_mb() -> float:
+    """Return the peak resident set size of this process, in megabytes."""
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS reports bytes
+    divisor = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return round(max_rss / divisor, 1)
+
+
+class Command(BaseCommand):
+    help = "Benchmark processing SES notifications with local stand-ins for AWS."
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument(
+            "--messages",
+            type=int,
+            default=200,
+            help="The number of notifications to process (default 200)",
+        )
+        parser.add_argument(
+            "--mix",
+            default=DEFAULT_MIX,
+            help=f"Weights of notification types (default {DEFAULT_MIX})",
+        )
+        parser.add_argument(
+            "--corpus-dir",
+            type=Path,
+            default=FIXTURES_PATH,
+            help=(
+                "Folder with *_incoming.email and *_bounce_sns_body.json files"
+                " (default emails/tests/fixtures)"
+            ),
+        )
+        parser.add_argument(
+            "--json",
+            action="store_true",
+            dest="as_json",
+            help="Write the report as JSON",
+        )
+
+    def handle(
+        self,
+        *args: Any,
+        messages: int,
+        mix: str,
+        corpus_dir: Path,
+        as_json: bool = False,
+        verbosity: int = 1,
+        **kwargs: Any,
+    ) -> None:
+        if messages < 1:
+            raise CommandError("--messages must be at least 1.")
+        weights = parse_mix(mix)
+        emails = sorted(corpus_dir.glob("*_incoming.email"))
+        bounces = sorted(corpus_dir.glob("*_bounce_sns_body.json"))
+        if weights.get("received") and not emails:
+            raise CommandError(f"No *_incoming.email files in {corpus_dir}.")
+        if weights.get("bounce") and not bounces:
+            raise CommandError(f"No *_bounce_sns_body.json files in {corpus_dir}.")
+        self.corpus_emails = [path.read_bytes() for path in emails]
+        self.corpus_bounces = [
+            json.loads(path.read_text(encoding="utf-8"))["Message"] for path in bounces
+        ]
+
+        if verbosity < 2:
+            # Forwarding logs each message, and errors are counted in the report
+            logging.disable(logging.CRITICAL)
+        try:
+            with override_settings(
+                AWS_REGION=BENCH_REGION,
+                AWS_SNS_TOPIC={BENCH_TOPIC_ARN},
+                AWS_SQS_EMAIL_QUEUE_URL=BENCH_QUEUE_URL,
+            ):
+                report = self.run_benchmark(messages, weights)
+        finally:
+            logging.disable(logging.NOTSET)
+
+        if as_json:
+            self.stdout.write(json.dumps(report, indent=2))
+        else:
+            self.write_report(report)
+
+    def run_benchmark(self, count: int, weights: dict[str, int]) -> dict[str, Any]:
+        """Seed the database, process the corpus, and return the report."""
+        self.private_key = rsa.generate_private_key(
+            public_exponent=65537, key_size=2048
+        )
+        public_pem = self.private_key.public_key().public_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PublicFormat.SubjectPublicKeyInfo,
+        )
+        caches[settings.AWS_SNS_KEY_CACHE].set(
+            f"{BENCH_CERT_URL}:public_key", public_pem
+        )
+        self.s3 = FakeS3Client()
+        users = self.seed_users()
+        try:
+            bodies = self.build_corpus(count, weights)
+            return self.process_corpus(bodies)
+        finally:
+            for user in users:
+                user.delete()
+
+    def seed_users(self) -> list[User]:
+        """Create a user with a mask, and a user for bounces and complaints."""
+        run_id = uuid4().hex[:12]
+        users = []
+        for role in ("forward", "feedback"):
+            user = User.objects.create(
+                username=f"bench-{role}-{run_id}",
+                email=f"bench-{role}-{run_id}@example.com",
+            )
+            users.append(user)
+            SocialAccount.objects.create(user=user, provider="fxa", uid=str(uuid4()))
+            profile = user.profile
+            profile.last_engagement = datetime.now(UTC)
+            profile.server_storage = True
+            profile.save()
+        self.forward_user, self.feedback_user = users
+        self.forward_mask = RelayAddress.objects.create(user=self.forward_user)
+        self.feedback_mask = RelayAddress.objects.create(user=self.feedback_user)
+        return users
+
+    def build_corpus(self, count: int, weights: dict[str, int]) -> list[str]:
+        """Return signed SNS notifications, following the mix of types."""
+        kinds = [kind for kind, weight in weights.items() for _ in range(weight)]
+        builders = {
+            "received": self.received_message,
+            "bounce": self.bounce_message,
+            "complaint": self.complaint_message,
+        }
+        bodies = []
+        for index in range(count):
+            subject, message = builders[kinds[index % len(kinds)]](index)
+            bodies.append(self.sign_notification(subject, message))
+        return bodies
+
+    def received_message(self, index: int) -> tuple[str, dict[str, Any]]:
+        """Return a Received notification, with the email content stored in S3."""
+        raw_email = self.corpus_emails[index % len(self.corpus_emails)]
+        email = message_from_bytes(raw_email)
+        mask = self.forward_mask.full_address
+        mail_id = f"bench{uuid4().hex}"
+        object_key = f"emails/{mail_id}"
+        self.s3.objects[(BENCH_BUCKET, object_key)] = raw_email
+        from_header = str(email["From"] or "sender@example.com")
+        timestamp = datetime.now(UTC).isoformat()
+        message = {
+            "notificationType": "Received",
+            "mail": {
+                "timestamp": timestamp,
+                "source": parseaddr(from_header)[1] or "sender@example.com",
+                "messageId": mail_id,
+                "destination": [mask],
+                "headersTruncated": False,
+                "headers": [
+                    {"name": name, "value": str(value)} for name, value in email.items()
+                ],
+                "commonHeaders": {
+                    "from": [from_header],
+                    "to": [mask],
+                    "messageId": str(email["Message-ID"] or f"<{mail_id}@example.com>"),
+                    "subject": str(email["Subject"] or ""),
+                },
+            },
+            "receipt": {
+                "timestamp": timestamp,
+                "processingTimeMillis": 100,
+                "recipients": [mask],
+                "spamVerdict": {"status": "PASS"},
+                "virusVerdict": {"status": "PASS"},
+                "spfVerdict": {"status": "PASS"},
+                "dkimVerdict": {"status": "PASS"},
+                "dmarcVerdict": {"status": "PASS"},
+                "action": {
+                    "type": "S3",
+                    "topicArn": BENCH_TOPIC_ARN,
+                    "bucketName": BENCH_BUCKET,
+                    "objectKeyPrefix": "emails",
+                    "objectKey": object_key,
+                },
+            },
+        }
+        return "Amazon SES Email Receipt Notification", message
+
+    def bounce_message(self, index: int) -> tuple[str, dict[str, Any]]:
+        """Return a Bounce notification, to the user for bounces and complaints."""
+        message = json.loads(self.corpus_bounces[index % len(self.corpus_bounces)])
+        email = self.feedback_user.email
+        for recipient in message["bounce"]["bouncedRecipients"]:
+            recipient["emailAddress"] = email
+        message["mail"]["messageId"] = f"bench{uuid4().hex}"
+        message["mail"]["destination"] = [email]
+        message["mail"]["commonHeaders"]["to"] = [email]
+        return "Amazon SES Email Bounce Notification", message
+
+    def complaint_message(self, index: int) -> tuple[str, dict[str, Any]]:
+        """Return a Complaint notification about an email forwarded to a user."""
+        timestamp = datetime.now(UTC).isoformat()
+        email = self.feedback_user.email
+        from_header = (
+            f'"sender@example.com [via Relay]" <{self.feedback_mask.full_address}>'
+        )
+        message = {
+            "notificationType": "Complaint",
+            "complaint": {
+                "userAgent": "Bench Feedback Loop",
+                "complainedRecipients": [{"emailAddress": email}],
+                "complaintFeedbackType": "abuse",
+                "arrivalDate": timestamp,
+                "timestamp": timestamp,
+                "feedbackId": f"bench{uuid4().hex}",
+            },
+            "mail": {
+                "timestamp": timestamp,
+                "source": settings.RELAY_FROM_ADDRESS,
+                "messageId": f"bench{uuid4().hex}",
+                "destination": [email],
+                "headersTruncated": False,
+                "headers": [
+                    {"name": "From", "value": from_header},
+                    {"name": "To", "value": email},
+                    {"name": "Subject", "value": "Benchmark"},
+                ],
+                "commonHeaders": {
+                    "from": [from_header],
+                    "to": [email],
+                    "subject": "Benchmark",
+                },
+            },
+        }
+        return "Amazon SES Email Complaint Notification", message
+
+    def sign_notification(self, subject: str, message: dict[str, Any]) -> str:
+        """Return an SNS notification body, signed with the benchmark key."""
+        notification = {
+            "Type": "Notification",
+            "MessageId": str(uuid4()),
+            "TopicArn": BENCH_TOPIC_ARN,
+            "Subject": subject,
+            "Message": json.dumps(message),
+            "Timestamp": datetime.now(UTC).isoformat(),
+            "SignatureVersion": "1",
+            "SigningCertURL": BENCH_CERT_URL,
+        }
+        signed_text = _get_hash_format(notification).format(**notification).encode()
+        signature = self.private_key.sign(
+            signed_text,
+            padding.PKCS1v15(),
+            hashes.SHA1(),  # noqa: S303  # Use of insecure hash SHA1
+        )
+        notification["Signature"] = base64.b64encode(signature).decode()
+        return json.dumps(notification)
+
+    def process_corpus(self, bodies: list[str]) -> dict[str, Any]:
+        """Process the SNS notifications with process_emails_from_sqs batches."""
+        stage_samples = StageSamples()
+        command = BenchCommand(stage_samples)
+        command.init_from_settings(verbosity=0)
+        command.init_locals()
+        command.queue = FakeQueue(BENCH_QUEUE_URL, bodies)  # type: ignore[assignment]
+        command.pool = InlinePool()  # type: ignore[assignment]
+        command.healthcheck_seconds = float("inf")
+        command.next_healthcheck = float("inf")
+
+        processed = failed = 0
+        with (
+            use_aws_clients(self.s3, FakeSESClient()),
+            connection.execute_wrapper(stage_samples.time_query),
+        ):
+            start = time.perf_counter()
+            while True:
+                batch, _ = command.poll_queue_for_messages()
+                if not batch:
+                    break
+                batch_data = command.process_message_batch(batch)
+                processed += len(batch)
+                failed += batch_data.get("failed_count", 0)
+            elapsed = time.perf_counter() - start
+
+        return {
+            "messages": processed,
+            "failed": failed,
+            "elapsed_s": round(elapsed, 3),
+            "messages_per_s": round(processed / elapsed, 1) if elapsed else 0.0,
+            "stages": stage_samples.report(),
+            "peak_rss_mb": peak_rss_mb(),
+        }
+
+    def write_report(self, report: dict[str, Any]) -> None:
+        """Write the report as a table."""
+        self.stdout.write(
+            f"{report['messages']} messages ({report['failed']} failed) in"
+            f" {report['elapsed_s']:.3f}s: {report['messages_per_s']:.1f} messages/s"
+        )
+        self.stdout.write(
+            f"{'stage':<16} {'count':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}"
+        )
+        for stage, data in report["stages"].items():
+            self.stdout.write(
+                f"{stage:<16} {data['count']:>6} {data['p50_ms']:>9.3f}"
+                f" {data['p95_ms']:>9.3f} {data['p99_ms']:>9.3f}"
+            )
+        self.stdout.write(f"Peak RSS: {report['peak_rss_mb']:.1f} MB")
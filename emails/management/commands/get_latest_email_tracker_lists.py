@@ -2,7 +2,12 @@ import pathlib
 
 from django.core.management.base import BaseCommand
 
-from emails.utils import download_trackers, shavar_prod_lists_url, store_trackers
+from emails.utils import (
+    download_trackers,
+    shavar_prod_lists_url,
+    store_tracker_index,
+    store_trackers,
+)
 
 EMAILS_FOLDER_PATH = pathlib.Path(__file__).parents[2]
 TRACKER_FOLDER_PATH = EMAILS_FOLDER_PATH / "tracker_lists"
@@ -24,8 +29,24 @@ class Command(BaseCommand):
             choices=[1, 2],
             help="Choose the level of tracker list desired",
         )
+        parser.add_argument(
+            "--index-only",
+            action="store_true",
+            help="Rebuild the tracker index from the stored lists, without a download",
+        )
 
     def handle(self, *args, **options):
+        if not options["index_only"]:
+            self.store_tracker_list(options)
+
+        index = store_tracker_index(TRACKER_FOLDER_PATH)
+        print(
+            f"Updated tracker index version {index['version']} in"
+            f" {TRACKER_FOLDER_PATH}, with {len(index['level_one'])} level one and"
+            f" {len(index['level_two'])} level two trackers"
+        )
+
+    def store_tracker_list(self, options):
         repo_url = options["repo_url"]
         tracker_level = options["tracker_level"]
 
@@ -9,18 +9,24 @@ https://docs.aws.amazon.com/AWSSimpleQueueService/latest/SQSDeveloperGuide/sqs-s
 https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs.html#SQS.Queue.receive_messages
 """
 
+import asyncio
 import gc
 import json
 import logging
+import os
 import shlex
+import tempfile
 import time
+from collections.abc import Callable
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import UTC, datetime
-from multiprocessing import Pool
-from typing import Any, cast
+from multiprocessing.pool import AsyncResult, Pool
+from typing import Any, NamedTuple, cast
 from urllib.parse import urlsplit
 
 from django import setup
-from django.core.management.base import CommandError
+from django.conf import settings
+from django.core.management.base import CommandError, CommandParser
 from django.db import connection
 from django.http import HttpResponse
 
@@ -30,8 +36,14 @@ from codetiming import Timer
 from markus.utils import generate_tag
 from mypy_boto3_sqs.service_resource import Message as SQSMessage
 from mypy_boto3_sqs.service_resource import Queue as SQSQueue
+from mypy_boto3_sqs.type_defs import (
+    ChangeMessageVisibilityBatchResultTypeDef,
+    DeleteMessageBatchResultTypeDef,
+)
 from sentry_sdk import capture_exception
 
+from emails.apps import s3_client, ses_client
+from emails.counter_buffer import flush_counter_buffer, flush_counter_buffer_if_due
 from emails.management.command_from_django_settings import (
     CommandFromDjangoSettings,
     SettingToLocal,
@@ -42,6 +54,37 @@ from emails.views import _sns_inbound_logic, validate_sns_arn_and_type
 
 logger = logging.getLogger("eventsinfo.process_emails_from_sqs")
 
+# The most entries allowed in a DeleteMessageBatch or ChangeMessageVisibilityBatch
+SQS_MAX_BATCH_ENTRIES = 10
+
+# The permissions of the healthcheck file, readable by other users
+HEALTHCHECK_FILE_MODE = 0o644
+
+# With --async, how often to check on messages in flight while waiting for a thread
+ASYNC_TICK_SECONDS = 1.0
+
+SQSBatchResult = (
+    DeleteMessageBatchResultTypeDef | ChangeMessageVisibilityBatchResultTypeDef
+)
+
+# A batch of messages and logging context, returned by poll_queue_for_messages
+PollResult = tuple[list[SQSMessage], dict[str, Any]]
+
+# Arguments for run_sns_inbound_logic: topic ARN, type, and verified body
+InboundArgs = tuple[str, str, Any]
+
+# A processed message and logging context, returned by run_message_async
+MessageResult = tuple[SQSMessage, dict[str, Any]]
+
+
+class InFlightMessage(NamedTuple):
+    """An SQS message that is being processed."""
+
+    message: SQSMessage
+    results: dict[str, Any]
+    future: AsyncResult | None
+    start_time: float | None
+
 
 class Command(CommandFromDjangoSettings):
     help = "Fetch email tasks from SQS and process them."
@@ -59,6 +102,28 @@ class Command(CommandFromDjangoSettings):
             "Time to wait for messages with long polling.",
             lambda wait_seconds: wait_seconds > 0,
         ),
+        SettingToLocal(
+            "PROCESS_EMAIL_ADAPTIVE_POLLING",
+            "adaptive_polling",
+            (
+                "Adjust the batch size and wait time to the queue depth. A deep queue"
+                " is polled at the maximum batch size without waiting, and an idle"
+                " queue backs off to the maximum wait time."
+            ),
+            lambda adaptive_polling: adaptive_polling in (True, False),
+        ),
+        SettingToLocal(
+            "PROCESS_EMAIL_MIN_BATCH_SIZE",
+            "min_batch_size",
+            "With adaptive polling, the smallest number of SQS messages to fetch.",
+            lambda min_batch_size: 0 < min_batch_size <= 10,
+        ),
+        SettingToLocal(
+            "PROCESS_EMAIL_MIN_WAIT_SECONDS",
+            "min_wait_seconds",
+            "With adaptive polling, the shortest time to wait for messages.",
+            lambda min_wait_seconds: min_wait_seconds >= 0,
+        ),
         SettingToLocal(
             "PROCESS_EMAIL_VISIBILITY_SECONDS",
             "visibility_seconds",
@@ -71,6 +136,18 @@ class Command(CommandFromDjangoSettings):
             "Path to file to write healthcheck data.",
             lambda healthcheck_path: healthcheck_path is not None,
         ),
+        SettingToLocal(
+            "PROCESS_EMAIL_HEALTHCHECK_SECONDS",
+            "healthcheck_seconds",
+            "Minimum time between writes to the healthcheck file.",
+            lambda healthcheck_seconds: healthcheck_seconds >= 0.0,
+        ),
+        SettingToLocal(
+            "PROCESS_EMAIL_QUEUE_REFRESH_SECONDS",
+            "queue_refresh_seconds",
+            "Minimum time between loading the SQS queue attributes.",
+            lambda queue_refresh_seconds: queue_refresh_seconds >= 0.0,
+        ),
         SettingToLocal(
             "PROCESS_EMAIL_DELETE_FAILED_MESSAGES",
             "delete_failed_messages",
@@ -80,6 +157,15 @@ class Command(CommandFromDjangoSettings):
             ),
             lambda delete_failed_messages: delete_failed_messages in (True, False),
         ),
+        SettingToLocal(
+            "PROCESS_EMAIL_RETRY_BACKOFF_SECONDS",
+            "retry_backoff_seconds",
+            (
+                "Initial time before a failed message is visible in the queue again."
+                " It doubles with each receive, up to the visibility time."
+            ),
+            lambda retry_backoff_seconds: retry_backoff_seconds >= 0,
+        ),
         SettingToLocal(
             "PROCESS_EMAIL_MAX_SECONDS",
             "max_seconds",
@@ -92,6 +178,22 @@ class Command(CommandFromDjangoSettings):
             "Maximum time to process a message before cancelling.",
             lambda max_seconds: max_seconds > 0.0,
         ),
+        SettingToLocal(
+            "PROCESS_EMAIL_CONCURRENCY",
+            "concurrency",
+            "Number of messages to process at the same time.",
+            lambda concurrency: concurrency > 0,
+        ),
+        SettingToLocal(
+            "PROCESS_EMAIL_PREFETCH",
+            "prefetch",
+            (
+                "Poll for the next batch of messages while processing the current"
+                " batch. A prefetched batch is released back to the queue if it is"
+                " older than half the visibility time."
+            ),
+            lambda prefetch: prefetch in (True, False),
+        ),
         SettingToLocal(
             "AWS_REGION",
             "aws_region",
@@ -115,17 +217,45 @@ class Command(CommandFromDjangoSettings):
     # Added by CommandFromDjangoSettings.init_from_settings
     batch_size: int
     wait_seconds: int
+    adaptive_polling: bool
+    min_batch_size: int
+    min_wait_seconds: int
     visibility_seconds: int
     healthcheck_path: str
+    healthcheck_seconds: float
+    queue_refresh_seconds: float
     delete_failed_messages: bool
+    retry_backoff_seconds: int
     max_seconds: float | None
     max_seconds_per_message: float
+    concurrency: int
+    prefetch: bool
     aws_region: str
     sqs_url: str
     verbosity: int
 
-    def handle(self, verbosity: int, *args: Any, **kwargs: Any) -> None:
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument(
+            "--async",
+            action="store_true",
+            dest="use_async",
+            help=(
+                "Process messages in an event loop with a thread executor, instead of"
+                " with worker processes."
+            ),
+        )
+
+    def handle(
+        self, verbosity: int, *args: Any, use_async: bool = False, **kwargs: Any
+    ) -> None:
         """Handle call from command line (called by BaseCommand)"""
+        if settings.COUNTER_BUFFER == "memory" and not use_async:
+            # Each worker process would buffer counters, and the pool terminates the
+            # workers without flushing them.
+            raise CommandError(
+                "COUNTER_BUFFER='memory' requires --async. Use COUNTER_BUFFER='cache'"
+                " with worker processes."
+            )
         self.init_from_settings(verbosity)
         self.init_locals()
         logger.info(
@@ -133,14 +263,23 @@ class Command(CommandFromDjangoSettings):
             extra={
                 "batch_size": self.batch_size,
                 "wait_seconds": self.wait_seconds,
+                "adaptive_polling": self.adaptive_polling,
+                "min_batch_size": self.min_batch_size,
+                "min_wait_seconds": self.min_wait_seconds,
                 "visibility_seconds": self.visibility_seconds,
                 "healthcheck_path": self.healthcheck_path,
+                "healthcheck_seconds": self.healthcheck_seconds,
+                "queue_refresh_seconds": self.queue_refresh_seconds,
                 "delete_failed_messages": self.delete_failed_messages,
+                "retry_backoff_seconds": self.retry_backoff_seconds,
                 "max_seconds": self.max_seconds,
                 "max_seconds_per_message": self.max_seconds_per_message,
+                "concurrency": self.concurrency,
+                "prefetch": self.prefetch,
                 "aws_region": self.aws_region,
                 "sqs_url": self.sqs_url,
                 "verbosity": self.verbosity,
+                "use_async": use_async,
             },
         )
 
@@ -149,7 +288,15 @@ class Command(CommandFromDjangoSettings):
         except ClientError as e:
             raise CommandError("Unable to connect to SQS") from e
 
-        process_data = self.process_queue()
+        if use_async:
+            process_data = asyncio.run(self.process_queue_async())
+        else:
+            self.pool = self.create_worker_pool()
+            try:
+                process_data = self.process_queue()
+            finally:
+                self.pool.terminate()
+        flush_counter_buffer()
         logger.info("Exiting process_emails_from_sqs", extra=process_data)
 
     def init_locals(self) -> None:
@@ -164,6 +311,14 @@ class Command(CommandFromDjangoSettings):
         self.queue_count: int = 0
         self.queue_count_delayed: int = 0
         self.queue_count_not_visible: int = 0
+        self.next_queue_refresh: float = 0.0
+        self.poll_batch_size: int = self.batch_size
+        self.poll_wait_seconds: int = self.wait_seconds
+        self.next_healthcheck: float = 0.0
+        self.prefetch_executor: ThreadPoolExecutor | None = None
+        self.prefetch_future: Future[PollResult] | None = None
+        self.prefetch_start_time: float = 0.0
+        self.batch_received_at: float | None = None
 
     def create_client(self) -> SQSQueue:
         """Create the SQS client."""
@@ -174,6 +329,16 @@ class Command(CommandFromDjangoSettings):
         sqs_client = boto3.resource("sqs", region_name=self.aws_region)
         return sqs_client.Queue(self.sqs_url)
 
+    def create_worker_pool(self) -> Pool:
+        """
+        Create the long-lived pool of worker processes.
+
+        Each worker runs django.setup() and creates the AWS clients once, when the
+        worker starts, rather than once per message. If a message times out, the pool
+        is replaced by replace_worker_pool.
+        """
+        return Pool(self.concurrency, initializer=setup_worker)
+
     def process_queue(self) -> dict[str, Any]:
         """
         Process the SQS email queue until an exit condition is reached.
@@ -200,48 +365,291 @@ class Command(CommandFromDjangoSettings):
                     "cycle_num": self.cycles,
                     "cycle_s": 0.0,
                 }
-                cycle_data.update(self.refresh_and_emit_queue_count_metrics())
-                self.write_healthcheck()
+                now = time.monotonic()
+                if now >= self.next_queue_refresh:
+                    cycle_data.update(self.refresh_and_emit_queue_count_metrics())
+                    self.next_queue_refresh = now + self.queue_refresh_seconds
+                self.write_healthcheck(now)
 
                 # Check if we should exit due to time limit
                 if self.max_seconds is not None:
-                    elapsed = time.monotonic() - self.start_time
+                    elapsed = now - self.start_time
                     if elapsed >= self.max_seconds:
                         exit_on = "max_seconds"
                         break
 
                 # Request and process a chunk of messages
                 with Timer(logger=None) as cycle_timer:
-                    message_batch, queue_data = self.poll_queue_for_messages()
+                    message_batch, queue_data = self.get_message_batch()
                     cycle_data.update(queue_data)
-                    cycle_data.update(self.process_message_batch(message_batch))
-
-                # Collect data and log progress
-                self.total_messages += len(message_batch)
-                self.failed_messages += int(cycle_data.get("failed_count", 0))
-                self.pause_count += int(cycle_data.get("pause_count", 0))
-                cycle_data["message_total"] = self.total_messages
-                cycle_data["cycle_s"] = round(cycle_timer.last, 3)
-                logger.log(
-                    (
-                        logging.INFO
-                        if (message_batch or self.verbosity > 1)
-                        else logging.DEBUG
-                    ),
-                    (
-                        f"Cycle {self.cycles}: processed"
-                        f" {self.pluralize(len(message_batch), 'message')}"
-                    ),
-                    extra=cycle_data,
-                )
-
-                self.cycles += 1
-                gc.collect()  # Force garbage collection of boto3 SQS client resources
+                    if self.prefetch and message_batch:
+                        self.start_prefetch()
+                    cycle_data.update(
+                        self.process_message_batch(
+                            message_batch, self.batch_received_at
+                        )
+                    )
+
+                if self.adaptive_polling:
+                    cycle_data.update(self.adapt_polling(len(message_batch)))
+                self.end_cycle(cycle_data, len(message_batch), cycle_timer.last)
 
             except KeyboardInterrupt:
                 self.halt_requested = True
                 exit_on = "interrupt"
 
+        self.stop_prefetch()
+        return self.exit_data(exit_on)
+
+    async def process_queue_async(self) -> dict[str, Any]:
+        """
+        Process the SQS email queue in an event loop, until an exit condition.
+
+        Messages are processed by _sns_inbound_logic in a thread executor with
+        self.concurrency threads. SQS requests run in a separate thread, since a boto3
+        resource can not be shared between threads. Each poll requests no more
+        messages than there are free threads. Messages that finished during the poll
+        are deleted or scheduled for a retry at the end of the cycle.
+
+        While waiting for a free thread, the loop wakes every ASYNC_TICK_SECONDS to
+        write the healthcheck file and extend the visibility timeout of messages in
+        flight, as in process_message_batch.
+
+        A thread can not be killed, so a message that times out is logged, but stays
+        reserved for this process until _sns_inbound_logic returns. It is then deleted
+        or retried based on the result, so that it is not processed twice at the same
+        time.
+
+        Return is the same as process_queue.
+        """
+        loop = asyncio.get_running_loop()
+        message_executor = ThreadPoolExecutor(
+            max_workers=self.concurrency, thread_name_prefix="sns_inbound"
+        )
+        sqs_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqs")
+        exit_on = "unknown"
+        self.start_time = time.monotonic()
+        # Messages in flight, with when to next extend their visibility timeout
+        in_flight: dict[asyncio.Task[MessageResult], tuple[SQSMessage, float]] = {}
+
+        while not self.halt_requested:
+            try:
+                cycle_data: dict[str, Any] = {
+                    "cycle_num": self.cycles,
+                    "cycle_s": 0.0,
+                }
+                now = time.monotonic()
+                if now >= self.next_queue_refresh:
+                    cycle_data.update(
+                        await loop.run_in_executor(
+                            sqs_executor, self.refresh_and_emit_queue_count_metrics
+                        )
+                    )
+                    self.next_queue_refresh = now + self.queue_refresh_seconds
+                self.write_healthcheck(now)
+
+                # Check if we should exit due to time limit
+                if self.max_seconds is not None:
+                    if now - self.start_time >= self.max_seconds:
+                        exit_on = "max_seconds"
+                        break
+
+                # Request messages for free threads, and settle finished messages
+                with Timer(logger=None) as cycle_timer:
+                    extended_count = await self.extend_in_flight_async(
+                        in_flight, sqs_executor
+                    )
+                    running = {task for task in in_flight if not task.done()}
+                    while len(running) >= self.concurrency:
+                        await asyncio.wait(
+                            running,
+                            timeout=ASYNC_TICK_SECONDS,
+                            return_when=asyncio.FIRST_COMPLETED,
+                        )
+                        self.write_healthcheck(time.monotonic())
+                        extended_count += await self.extend_in_flight_async(
+                            in_flight, sqs_executor
+                        )
+                        running = {task for task in running if not task.done()}
+                    message_batch, queue_data = await loop.run_in_executor(
+                        sqs_executor,
+                        self.poll_queue_for_messages,
+                        None,
+                        self.concurrency - len(running),
+                    )
+                    cycle_data.update(queue_data)
+                    extend_at = time.monotonic() + self.visibility_seconds / 2
+                    for message in message_batch:
+                        task = asyncio.create_task(
+                            self.run_message_async(message, message_executor)
+                        )
+                        in_flight[task] = (message, extend_at)
+                    # Let messages that failed validation finish
+                    await asyncio.sleep(0)
+                    done = {task for task in in_flight if task.done()}
+                    for task in done:
+                        del in_flight[task]
+                    cycle_data.update(
+                        await self.settle_messages_async(done, sqs_executor)
+                    )
+                    if extended_count:
+                        cycle_data["visibility_extended_count"] = extended_count
+
+                if self.adaptive_polling:
+                    cycle_data.update(self.adapt_polling(len(message_batch)))
+                self.end_cycle(cycle_data, len(done), cycle_timer.last)
+
+            except (KeyboardInterrupt, asyncio.CancelledError):
+                self.halt_requested = True
+                exit_on = "interrupt"
+
+        # Finish the messages that are still in flight
+        if in_flight:
+            tasks = set(in_flight)
+            while not all(task.done() for task in tasks):
+                await asyncio.wait(tasks, timeout=ASYNC_TICK_SECONDS)
+                self.write_healthcheck(time.monotonic())
+                await self.extend_in_flight_async(in_flight, sqs_executor)
+            finish_data = await self.settle_messages_async(tasks, sqs_executor)
+            self.total_messages += len(tasks)
+            self.failed_messages += int(finish_data.get("failed_count", 0))
+        message_executor.shutdown(wait=False, cancel_futures=True)
+        sqs_executor.shutdown()
+        return self.exit_data(exit_on)
+
+    async def extend_in_flight_async(
+        self,
+        in_flight: dict[asyncio.Task[MessageResult], tuple[SQSMessage, float]],
+        sqs_executor: ThreadPoolExecutor,
+    ) -> int:
+        """
+        Extend the visibility timeout of unfinished messages, when half has passed.
+
+        Return is 1 if the visibility timeout was extended, or 0 if not.
+        """
+        now = time.monotonic()
+        due = [
+            task
+            for task, (_, extend_at) in in_flight.items()
+            if now >= extend_at and not task.done()
+        ]
+        if not due:
+            return 0
+        await asyncio.get_running_loop().run_in_executor(
+            sqs_executor, self.extend_visibility, [in_flight[task][0] for task in due]
+        )
+        next_extend_at = now + self.visibility_seconds / 2
+        for task in due:
+            in_flight[task] = (in_flight[task][0], next_extend_at)
+        return 1
+
+    async def run_message_async(
+        self, message: SQSMessage, executor: ThreadPoolExecutor
+    ) -> MessageResult:
+        """
+        Process an SQS message in the event loop.
+
+        The message body is parsed and verified in the event loop thread. If it is
+        valid, _sns_inbound_logic runs in the executor. If it takes longer than
+        max_seconds_per_message, the timeout is logged, and the message is finished
+        when _sns_inbound_logic returns.
+
+        Return is the message and a dict suitable for logging context, with the same
+        keys as finish_message, except worker_killed, and with timed_out set to True
+        if the message took longer than max_seconds_per_message.
+        """
+        results, inbound_args = self.parse_message(message)
+        if inbound_args is None:
+            results["message_process_time_s"] = 0.0
+            return message, results
+
+        loop = asyncio.get_running_loop()
+        start_time = time.monotonic()
+        future = loop.run_in_executor(executor, run_sns_inbound_logic, *inbound_args)
+        done, _ = await asyncio.wait({future}, timeout=self.max_seconds_per_message)
+        if not done:
+            results["timed_out"] = True
+            incr_if_enabled("message_from_sqs_timeout")
+            logger.warning(
+                "Message timed out",
+                extra={
+                    "sqs_message_id": message.message_id,
+                    "max_seconds_per_message": self.max_seconds_per_message,
+                },
+            )
+        try:
+            response = await future
+        except Exception as e:
+            self.record_message_error(results, e)
+        else:
+            self.record_message_result(results, response)
+        results["message_process_time_s"] = round(time.monotonic() - start_time, 3)
+        return message, results
+
+    async def settle_messages_async(
+        self, tasks: set[asyncio.Task[MessageResult]], sqs_executor: ThreadPoolExecutor
+    ) -> dict[str, Any]:
+        """
+        Log finished messages, then delete them or schedule a retry.
+
+        Return is a dict suitable for logging context, with these keys:
+        * failed_count: How many messages failed to process, omitted if 0
+        * delete_failed_count: How many messages could not be deleted, omitted if 0
+        * retry_failed_count: How many failed messages could not be scheduled for a
+          retry, omitted if 0
+        """
+        loop = asyncio.get_running_loop()
+        to_delete: list[SQSMessage] = []
+        to_retry: list[tuple[SQSMessage, int]] = []
+        failed_count = 0
+        for task in tasks:
+            message, message_data = task.result()
+            if not message_data["success"]:
+                failed_count += 1
+            self.settle_message(message, message_data, to_delete, to_retry)
+
+        settle_data = {}
+        if failed_count:
+            settle_data["failed_count"] = failed_count
+        if to_delete:
+            delete_failed_count = await loop.run_in_executor(
+                sqs_executor, self.delete_messages, to_delete
+            )
+            if delete_failed_count:
+                settle_data["delete_failed_count"] = delete_failed_count
+        if to_retry:
+            retry_failed_count = await loop.run_in_executor(
+                sqs_executor, self.change_message_visibility, to_retry
+            )
+            if retry_failed_count:
+                settle_data["retry_failed_count"] = retry_failed_count
+        return settle_data
+
+    def end_cycle(
+        self, cycle_data: dict[str, Any], message_count: int, cycle_s: float
+    ) -> None:
+        """Update the totals and log the cycle data."""
+        self.total_messages += message_count
+        self.failed_messages += int(cycle_data.get("failed_count", 0))
+        self.pause_count += int(cycle_data.get("pause_count", 0))
+        cycle_data["message_total"] = self.total_messages
+        cycle_data["cycle_s"] = round(cycle_s, 3)
+        if counter_rows := flush_counter_buffer_if_due():
+            cycle_data["counter_rows_flushed"] = counter_rows
+        logger.log(
+            (logging.INFO if (message_count or self.verbosity > 1) else logging.DEBUG),
+            (
+                f"Cycle {self.cycles}: processed"
+                f" {self.pluralize(message_count, 'message')}"
+            ),
+            extra=cycle_data,
+        )
+
+        self.cycles += 1
+        gc.collect()  # Force garbage collection of boto3 SQS client resources
+
+    def exit_data(self, exit_on: str) -> dict[str, Any]:
+        """Return the logging context for the exit log, described in process_queue."""
         process_data = {
             "exit_on": exit_on,
             "cycles": self.cycles,
@@ -298,11 +706,55 @@ class Command(CommandFromDjangoSettings):
             "queue_count_not_visible": self.queue_count_not_visible,
         }
 
+    def adapt_polling(self, message_count: int) -> dict[str, int]:
+        """
+        Adjust the batch size and wait time for the next poll to the queue depth.
+
+        * If the last poll returned a full batch, or the queue has at least a full
+          batch waiting, poll at the maximum batch size without waiting.
+        * If the last poll returned no messages, double the wait time, and poll at
+          the maximum batch size, so that a burst after an idle period is received
+          in full batches.
+        * Otherwise, size the batch to the messages that are waiting.
+
+        Changes stay between PROCESS_EMAIL_MIN_* and PROCESS_EMAIL_BATCH_SIZE /
+        PROCESS_EMAIL_WAIT_SECONDS.
+
+        Return is a dict suitable for logging context, with these keys:
+        * poll_batch_size: The new batch size, omitted if unchanged
+        * poll_wait_s: The new wait time in seconds, omitted if unchanged
+        """
+        min_batch_size = min(self.min_batch_size, self.batch_size)
+        min_wait_seconds = min(self.min_wait_seconds, self.wait_seconds)
+        backlog = max(self.queue_count, message_count)
+        if message_count >= self.poll_batch_size or backlog >= self.batch_size:
+            batch_size = self.batch_size
+            wait_seconds = min_wait_seconds
+        elif message_count == 0:
+            batch_size = self.batch_size
+            wait_seconds = max(1, self.poll_wait_seconds * 2)
+        else:
+            batch_size = backlog
+            wait_seconds = self.poll_wait_seconds
+        batch_size = min(max(batch_size, min_batch_size), self.batch_size)
+        wait_seconds = min(max(wait_seconds, min_wait_seconds), self.wait_seconds)
+
+        changes = {}
+        if batch_size != self.poll_batch_size:
+            self.poll_batch_size = changes["poll_batch_size"] = batch_size
+        if wait_seconds != self.poll_wait_seconds:
+            self.poll_wait_seconds = changes["poll_wait_s"] = wait_seconds
+        return changes
+
     def poll_queue_for_messages(
-        self,
-    ) -> tuple[list[SQSMessage], dict[str, float | int]]:
+        self, queue: SQSQueue | None = None, max_messages: int | None = None
+    ) -> PollResult:
         """Request a batch of messages, using the long-poll method.
 
+        Arguments:
+        * queue - the SQS queue to poll, or None for self.queue
+        * max_messages - the most messages to request, if less than the batch size
+
         Return is a tuple:
         * message_batch: a list of messages, which may be empty
         * data: A dict suitable for logging context, with these keys:
@@ -310,10 +762,13 @@ class Command(CommandFromDjangoSettings):
             - sqs_poll_s: The poll time, in seconds with millisecond precision
         """
         with Timer(logger=None) as poll_timer:
-            message_batch = self.queue.receive_messages(
-                MaxNumberOfMessages=self.batch_size,
+            message_batch = (queue or self.queue).receive_messages(
+                MaxNumberOfMessages=min(
+                    self.poll_batch_size, max_messages or self.poll_batch_size
+                ),
                 VisibilityTimeout=self.visibility_seconds,
-                WaitTimeSeconds=self.wait_seconds,
+                WaitTimeSeconds=self.poll_wait_seconds,
+                MessageSystemAttributeNames=["ApproximateReceiveCount"],
             )
         return (
             message_batch,
@@ -323,18 +778,202 @@ class Command(CommandFromDjangoSettings):
             },
         )
 
-    def process_message_batch(self, message_batch: list[SQSMessage]) -> dict[str, Any]:
+    def get_message_batch(self) -> PollResult:
+        """
+        Get the next batch of messages, from the prefetch buffer or by polling.
+
+        A prefetched batch is used if its messages are still reserved for this process
+        long enough to extend their visibility timeout. Otherwise, the messages are
+        released back to the queue, and the queue is polled again.
+
+        self.batch_received_at is set to the time a prefetched batch was requested, or
+        None for a polled batch.
+
+        Return is the same as poll_queue_for_messages, with these additional keys:
+        * prefetched: True if the batch was prefetched, omitted if polled
+        * prefetch_released: The number of prefetched messages released, omitted if 0
+        """
+        self.batch_received_at = None
+        if self.prefetch_future is None:
+            return self.poll_queue_for_messages()
+
+        future, self.prefetch_future = self.prefetch_future, None
+        message_batch, queue_data = future.result()
+        age = time.monotonic() - self.prefetch_start_time
+        if age <= self.prefetch_max_age():
+            self.batch_received_at = self.prefetch_start_time
+            queue_data["prefetched"] = True
+            return message_batch, queue_data
+
+        self.release_messages(message_batch)
+        released_count = len(message_batch)
+        message_batch, queue_data = self.poll_queue_for_messages()
+        queue_data["prefetch_released"] = released_count
+        return message_batch, queue_data
+
+    def prefetch_max_age(self) -> float:
+        """
+        Return the maximum age of a prefetched batch, in seconds.
+
+        The visibility timeout of unfinished messages is extended when half of it has
+        passed, so an older batch could become visible to other processes.
+        """
+        return self.visibility_seconds / 2
+
+    def start_prefetch(self) -> None:
+        """Start polling for the next batch of messages in a background thread."""
+        if self.prefetch_executor is None:
+            self.prefetch_executor = ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="sqs_prefetch"
+            )
+            # boto3 resources are not thread-safe, so the thread gets its own
+            self.prefetch_queue = self.create_client()
+        self.prefetch_start_time = time.monotonic()
+        self.prefetch_future = self.prefetch_executor.submit(
+            self.poll_queue_for_messages, self.prefetch_queue
+        )
+
+    def stop_prefetch(self) -> None:
+        """Stop prefetching, and release any prefetched messages to the queue."""
+        if self.prefetch_future is not None:
+            future, self.prefetch_future = self.prefetch_future, None
+            try:
+                message_batch, _ = future.result()
+            except (Exception, KeyboardInterrupt):
+                message_batch = []
+            self.release_messages(message_batch)
+        if self.prefetch_executor is not None:
+            self.prefetch_executor.shutdown()
+            self.prefetch_executor = None
+
+    def release_messages(self, message_batch: list[SQSMessage]) -> None:
+        """Make messages visible in the queue again, so they can be processed."""
+        self.change_message_visibility([(message, 0) for message in message_batch])
+
+    def delete_messages(self, messages: list[SQSMessage]) -> int:
+        """
+        Delete messages from the queue, using DeleteMessageBatch.
+
+        Return is the number of messages that could not be deleted.
+        """
+        entries = [
+            {"Id": str(num), "ReceiptHandle": message.receipt_handle}
+            for num, message in enumerate(messages)
+        ]
+        return self.send_batch_entries(
+            self.queue.delete_messages, entries, "sqs_delete_messages_error"
+        )
+
+    def change_message_visibility(self, changes: list[tuple[SQSMessage, int]]) -> int:
+        """
+        Change when messages are visible again, using ChangeMessageVisibilityBatch.
+
+        Arguments:
+        * changes - a list of (message, visibility timeout in seconds)
+
+        Return is the number of messages that could not be changed.
+        """
+        entries = [
+            {
+                "Id": str(num),
+                "ReceiptHandle": message.receipt_handle,
+                "VisibilityTimeout": visibility_timeout,
+            }
+            for num, (message, visibility_timeout) in enumerate(changes)
+        ]
+        return self.send_batch_entries(
+            self.queue.change_message_visibility_batch,
+            entries,
+            "sqs_change_message_visibility_error",
+        )
+
+    def send_batch_entries(
+        self,
+        batch_call: Callable[..., SQSBatchResult],
+        entries: list[dict[str, Any]],
+        error_log: str,
+    ) -> int:
+        """
+        Send entries to an SQS batch API, handling partial failures.
+
+        Entries are sent in groups of up to 10. A batch call can succeed for some
+        entries and fail for others. Entries that failed due to an SQS error are tried
+        again once. Entries that failed due to a sender error, such as an expired
+        receipt handle, are not. Remaining failures are logged.
+
+        Return is the number of entries that failed.
+        """
+        failed_count = 0
+        for start in range(0, len(entries), SQS_MAX_BATCH_ENTRIES):
+            pending = entries[start : start + SQS_MAX_BATCH_ENTRIES]
+            for attempt in range(2):
+                try:
+                    response = batch_call(Entries=pending)
+                except ClientError as e:
+                    logger.error(error_log, extra=e.response["Error"])
+                    failed_count += len(pending)
+                    break
+                failures = response.get("Failed", [])
+                retry_ids = {
+                    failure["Id"] for failure in failures if not failure["SenderFault"]
+                }
+                if attempt == 0 and retry_ids:
+                    for failure in failures:
+                        if failure["SenderFault"]:
+                            logger.error(error_log, extra=dict(failure))
+                    failed_count += len(failures) - len(retry_ids)
+                    pending = [entry for entry in pending if entry["Id"] in retry_ids]
+                    continue
+                for failure in failures:
+                    logger.error(error_log, extra=dict(failure))
+                failed_count += len(failures)
+                break
+        return failed_count
+
+    def retry_backoff(self, message: SQSMessage) -> int:
+        """
+        Return the seconds until a failed message should be visible again.
+
+        The delay doubles with each time the message was received, and is never more
+        than the visibility time, which was the delay before batching.
+        """
+        attributes = message.attributes or {}
+        receive_count = int(attributes.get("ApproximateReceiveCount", 1))
+        backoff: int = self.retry_backoff_seconds * 2 ** min(receive_count - 1, 16)
+        return min(backoff, self.visibility_seconds)
+
+    def process_message_batch(
+        self, message_batch: list[SQSMessage], received_at: float | None = None
+    ) -> dict[str, Any]:
         """
         Process a batch of messages.
 
+        Up to self.concurrency messages are processed at the same time.
+
         Arguments:
         * messages - a list of SQS messages, possibly empty
+        * received_at - when the batch was requested, or None if just received
 
         Return is a dict suitable for logging context, with these keys:
         * process_s: How long processing took, omitted if no messages
         * pause_count: How many pauses were taken for temporary errors, omitted if 0
         * pause_s: How long pauses took, omitted if no pauses
         * failed_count: How many messages failed to process, omitted if 0
+        * delete_failed_count: How many messages could not be deleted, omitted if 0
+        * retry_failed_count: How many failed messages could not be scheduled for a
+          retry, omitted if 0
+        * visibility_extended_count: How many times the visibility timeout was
+          extended for unfinished messages, omitted if 0
+
+        Processed messages are deleted, and failed messages are made visible again after
+        a backoff, with batch requests. A batch request is sent when there are 10
+        messages for it, when the visibility timeout is extended, and at the end of the
+        batch.
+
+        When half the visibility time has passed, the visibility timeout of unfinished
+        messages is extended, so that other processes do not receive them. Finished
+        messages are deleted or scheduled for a retry first, so they are not held past
+        their visibility timeout while a slow message runs.
 
         Times are in seconds, with millisecond precision
         """
@@ -343,44 +982,163 @@ class Command(CommandFromDjangoSettings):
         failed_count = 0
         pause_time = 0.0
         pause_count = 0
-        process_time = 0.0
-        for message in message_batch:
-            self.write_healthcheck()
-            with Timer(logger=None) as message_timer:
-                message_data = self.process_message(message)
-                if not message_data["success"]:
-                    failed_count += 1
-                if message_data["success"] or self.delete_failed_messages:
-                    message.delete()
-                pause_time += message_data.get("pause_s", 0.0)
-                pause_count += message_data.get("pause_count", 0)
-
-            message_data["message_process_time_s"] = round(message_timer.last, 3)
-            process_time += message_timer.last
-            logger.log(logging.INFO, "Message processed", extra=message_data)
-
-        batch_data = {"process_s": round((process_time - pause_time), 3)}
+        waiting = list(message_batch)
+        in_flight: list[InFlightMessage] = []
+        to_delete: list[SQSMessage] = []
+        to_retry: list[tuple[SQSMessage, int]] = []
+        delete_failed_count = 0
+        retry_failed_count = 0
+        visibility_extended_count = 0
+        extend_at = None
+        if received_at is not None:
+            extend_at = received_at + self.visibility_seconds / 2
+        with Timer(logger=None) as batch_timer:
+            while waiting or in_flight:
+                while waiting and len(in_flight) < self.concurrency:
+                    in_flight.append(self.start_message(waiting.pop(0)))
+                self.wait_for_messages(in_flight)
+
+                now = self.now_if_running(in_flight)
+                if now:
+                    self.write_healthcheck(now)
+                if extend_at is None and now:
+                    # The first worker started just after the batch was received
+                    batch_start = min(
+                        item.start_time for item in in_flight if item.start_time
+                    )
+                    extend_at = batch_start + self.visibility_seconds / 2
+                still_running = []
+                timed_out = False
+                for item in in_flight:
+                    if not self.is_message_done(item, now):
+                        still_running.append(item)
+                        continue
+                    message_data = self.finish_message(item, now)
+                    timed_out = timed_out or message_data.get("worker_killed", False)
+                    if not message_data["success"]:
+                        failed_count += 1
+                    pause_time += message_data.get("pause_s", 0.0)
+                    pause_count += message_data.get("pause_count", 0)
+                    self.settle_message(item.message, message_data, to_delete, to_retry)
+                in_flight = still_running
+                if timed_out:
+                    in_flight = self.replace_worker_pool(in_flight)
+
+                extend_due = bool(now and extend_at is not None and now >= extend_at)
+                if extend_due or len(to_delete) >= SQS_MAX_BATCH_ENTRIES:
+                    delete_failed_count += self.send_deletes(to_delete)
+                if extend_due or len(to_retry) >= SQS_MAX_BATCH_ENTRIES:
+                    retry_failed_count += self.send_retries(to_retry)
+                if extend_due and (waiting or in_flight):
+                    self.extend_visibility(
+                        waiting + [item.message for item in in_flight]
+                    )
+                    visibility_extended_count += 1
+                    extend_at = now + self.visibility_seconds / 2
+            delete_failed_count += self.send_deletes(to_delete)
+            retry_failed_count += self.send_retries(to_retry)
+
+        batch_data = {"process_s": round((batch_timer.last - pause_time), 3)}
         if pause_count:
             batch_data["pause_count"] = pause_count
             batch_data["pause_s"] = round(pause_time, 3)
         if failed_count:
             batch_data["failed_count"] = failed_count
+        if visibility_extended_count:
+            batch_data["visibility_extended_count"] = visibility_extended_count
+        if delete_failed_count:
+            batch_data["delete_failed_count"] = delete_failed_count
+        if retry_failed_count:
+            batch_data["retry_failed_count"] = retry_failed_count
         return batch_data
 
-    def process_message(self, message: SQSMessage) -> dict[str, Any]:
+    def settle_message(
+        self,
+        message: SQSMessage,
+        message_data: dict[str, Any],
+        to_delete: list[SQSMessage],
+        to_retry: list[tuple[SQSMessage, int]],
+    ) -> None:
+        """Log a processed message, and add it to the deletes or retries."""
+        if message_data["success"] or self.delete_failed_messages:
+            to_delete.append(message)
+        else:
+            retry_s = self.retry_backoff(message)
+            message_data["retry_after_s"] = retry_s
+            to_retry.append((message, retry_s))
+        logger.log(logging.INFO, "Message processed", extra=message_data)
+
+    def send_deletes(self, to_delete: list[SQSMessage]) -> int:
         """
-        Process an SQS message, which may include sending an email.
+        Delete the settled messages, and empty the list.
 
-        Return is a dict suitable for logging context, with these keys:
-        * success: True if message was processed successfully
-        * error: The processing error, omitted on success
-        * message_body_quoted: Set if the message was non-JSON, omitted for valid JSON
-        * pause_count: Set to 1 if paused due to temporary error, or omitted
-          with no error
-        * pause_s: The pause in seconds (ms precision) for temp error, or omitted
-        * pause_error: The temporary error, or omitted if no temp error
-        * client_error_code: The error code for non-temp or retry error,
-          omitted on success
+        Return is the number of messages that could not be deleted.
+        """
+        if not to_delete:
+            return 0
+        failed_count = self.delete_messages(to_delete)
+        to_delete.clear()
+        return failed_count
+
+    def send_retries(self, to_retry: list[tuple[SQSMessage, int]]) -> int:
+        """
+        Schedule retries for the failed messages, and empty the list.
+
+        Return is the number of messages that could not be scheduled for a retry.
+        """
+        if not to_retry:
+            return 0
+        failed_count = self.change_message_visibility(to_retry)
+        to_retry.clear()
+        return failed_count
+
+    def extend_visibility(self, messages: list[SQSMessage]) -> None:
+        """Reserve unfinished messages for this process for another visibility time."""
+        self.change_message_visibility(
+            [(message, self.visibility_seconds) for message in messages]
+        )
+        incr_if_enabled("sqs_visibility_extended", len(messages))
+
+    def start_message(self, message: SQSMessage) -> InFlightMessage:
+        """
+        Start processing an SQS message.
+
+        The message body is parsed and verified in this process. If it is valid, it is
+        sent to a worker process, and the returned item includes the future result.
+        If not, the item's results include the error, and the future is None.
+        """
+        results, inbound_args = self.parse_message(message)
+        if inbound_args is None:
+            return InFlightMessage(message, results, None, None)
+
+        def success_callback(result: HttpResponse) -> None:
+            """Handle return from successful call to _sns_inbound_logic"""
+            self.record_message_result(results, result)
+
+        def error_callback(exc_info: BaseException) -> None:
+            """Handle exception raised by _sns_inbound_logic"""
+            self.record_message_error(results, exc_info)
+
+        # Run in the worker pool
+        # The worker process already ran django.setup
+        # The benefit is that a hung worker can be stopped, by replacing the pool
+        future = self.pool.apply_async(
+            run_sns_inbound_logic,
+            inbound_args,
+            callback=success_callback,
+            error_callback=error_callback,
+        )
+        return InFlightMessage(message, results, future, time.monotonic())
+
+    def parse_message(
+        self, message: SQSMessage
+    ) -> tuple[dict[str, Any], InboundArgs | None]:
+        """
+        Parse and verify the body of an SQS message.
+
+        Return is a tuple:
+        * results: A dict suitable for logging context, with the error if invalid
+        * inbound_args: The arguments for run_sns_inbound_logic, or None if invalid
         """
         incr_if_enabled("process_message_from_sqs", 1)
         results = {"success": True, "sqs_message_id": message.message_id}
@@ -391,14 +1149,14 @@ class Command(CommandFromDjangoSettings):
             results["success"] = False
             results["error"] = f"Failed to load message.body: {e}"
             results["message_body_quoted"] = shlex.quote(raw_body)
-            return results
+            return results, None
         try:
             verified_json_body = verify_from_sns(json_body)
         except (KeyError, VerificationFailed) as e:
             logger.error("Failed SNS verification", extra={"error": str(e)})
             results["success"] = False
             results["error"] = f"Failed SNS verification: {e}"
-            return results
+            return results, None
 
         topic_arn = verified_json_body["TopicArn"]
         message_type = verified_json_body["Type"]
@@ -406,61 +1164,135 @@ class Command(CommandFromDjangoSettings):
         if error_details:
             results["success"] = False
             results.update(error_details)
-            return results
+            return results, None
+        return results, (topic_arn, message_type, verified_json_body)
 
-        def success_callback(result: HttpResponse) -> None:
-            """Handle return from successful call to _sns_inbound_logic"""
-            # TODO: extract data from _sns_inbound_logic return
-            pass
+    def record_message_result(
+        self, results: dict[str, Any], response: HttpResponse
+    ) -> None:
+        """Add the stage times from _sns_inbound_logic to the message results."""
+        stage_times_s = getattr(response, "stage_times_s", None)
+        if isinstance(stage_times_s, dict) and stage_times_s:
+            results["stage_times_s"] = stage_times_s
 
-        def error_callback(exc_info: BaseException) -> None:
-            """Handle exception raised by _sns_inbound_logic"""
-            capture_exception(exc_info)
-            results["success"] = False
-            if isinstance(exc_info, ClientError):
-                incr_if_enabled("message_from_sqs_error")
-                err = exc_info.response["Error"]
-                logger.error("sqs_client_error", extra=err)
-                results["error"] = err
-                results["client_error_code"] = err["Code"].lower()
-            else:
-                incr_if_enabled("email_processing_failure")
-                results["error"] = str(exc_info)
-                results["error_type"] = type(exc_info).__name__
-
-        # Run in a multiprocessing Pool
-        # This will start a subprocess, which needs to run django.setup
-        # The benefit is that the subprocess can be terminated
-        # The penalty is that is is slower to start
-        pool_start_time = time.monotonic()
-        with Pool(1, initializer=setup) as pool:
-            future = pool.apply_async(
-                run_sns_inbound_logic,
-                [topic_arn, message_type, verified_json_body],
-                callback=success_callback,
-                error_callback=error_callback,
-            )
-            setup_time = time.monotonic() - pool_start_time
-            results["subprocess_setup_time_s"] = round(setup_time, 3)
-
-            message_start_time = time.monotonic()
-            message_duration = 0.0
-            while message_duration < self.max_seconds_per_message:
-                self.write_healthcheck()
-                future.wait(1.0)
-                message_duration = time.monotonic() - message_start_time
-                if future.ready():
-                    break
+    def record_message_error(
+        self, results: dict[str, Any], exc_info: BaseException
+    ) -> None:
+        """Add an exception raised by _sns_inbound_logic to the message results."""
+        capture_exception(exc_info)
+        results["success"] = False
+        if isinstance(exc_info, ClientError):
+            incr_if_enabled("message_from_sqs_error")
+            err = exc_info.response["Error"]
+            logger.error("sqs_client_error", extra=err)
+            results["error"] = err
+            results["client_error_code"] = err["Code"].lower()
+        else:
+            incr_if_enabled("email_processing_failure")
+            results["error"] = str(exc_info)
+            results["error_type"] = type(exc_info).__name__
+
+    def wait_for_messages(self, in_flight: list[InFlightMessage]) -> None:
+        """
+        Wait for the oldest running message to complete.
 
-            results["message_process_time_s"] = round(message_duration, 3)
-            if not future.ready():
-                error = f"Timed out after {self.max_seconds_per_message:0.1f} seconds."
-                results["success"] = False
-                results["error"] = error
+        With one running message, this waits up to a second. With more, it waits up to
+        a tenth of a second, so that a completed message soon frees its worker.
+        """
+        running = [item.future for item in in_flight if item.future is not None]
+        running = [future for future in running if not future.ready()]
+        if running:
+            running[0].wait(1.0 if len(running) == 1 else 0.1)
+
+    def now_if_running(self, in_flight: list[InFlightMessage]) -> float:
+        """Return the monotonic time, or 0.0 if no messages were sent to workers."""
+        if any(item.start_time is not None for item in in_flight):
+            return time.monotonic()
+        return 0.0
+
+    def is_message_done(self, item: InFlightMessage, now: float) -> bool:
+        """Return True if a message is complete, failed, or timed out."""
+        if item.future is None or item.start_time is None:
+            return True
+        return (
+            item.future.ready()
+            or (now - item.start_time) >= self.max_seconds_per_message
+        )
+
+    def finish_message(self, item: InFlightMessage, now: float) -> dict[str, Any]:
+        """
+        Finish processing an SQS message.
+
+        If the message timed out, it is reported as failed. The caller then replaces
+        the worker pool, to stop the worker.
+
+        Return is a dict suitable for logging context, with these keys:
+        * success: True if message was processed successfully
+        * error: The processing error, omitted on success
+        * message_body_quoted: Set if the message was non-JSON, omitted for valid JSON
+        * pause_count: Set to 1 if paused due to temporary error, or omitted
+          with no error
+        * pause_s: The pause in seconds (ms precision) for temp error, or omitted
+        * pause_error: The temporary error, or omitted if no temp error
+        * client_error_code: The error code for non-temp or retry error,
+          omitted on success
+        * message_process_time_s: How long processing took, in seconds with
+          millisecond precision
+        * stage_times_s: How long each stage of processing a received email took,
+          in seconds with millisecond precision, or omitted
+        * worker_killed: Set to True if the message timed out, and the worker pool
+          must be replaced, or omitted
+        """
+        results = item.results
+        if item.future is None or item.start_time is None:
+            results["message_process_time_s"] = 0.0
+            return results
+
+        results["message_process_time_s"] = round(now - item.start_time, 3)
+        if not item.future.ready():
+            error = f"Timed out after {self.max_seconds_per_message:0.1f} seconds."
+            results["success"] = False
+            results["error"] = error
+            results["worker_killed"] = True
         return results
 
-    def write_healthcheck(self) -> None:
-        """Update the healthcheck file with operations data, if path is set."""
+    def replace_worker_pool(
+        self, in_flight: list[InFlightMessage]
+    ) -> list[InFlightMessage]:
+        """
+        Replace the worker pool after a message timed out, and restart its messages.
+
+        A single worker can not be killed safely. It may hold the lock for returning
+        results, which would block the other workers, or it may have moved on to
+        another message. A timed out message may also still be waiting for a worker,
+        and would run after it was retried. Instead, all the workers are terminated,
+        which drops the queued messages, and a new pool is created.
+
+        Return is the in-flight messages, with the unfinished ones started again in
+        the new pool.
+        """
+        unfinished = [
+            item.future is not None and not item.future.ready() for item in in_flight
+        ]
+        self.pool.terminate()
+        self.pool = self.create_worker_pool()
+        incr_if_enabled("worker_pool_replaced")
+        return [
+            self.start_message(item.message) if restart else item
+            for item, restart in zip(in_flight, unfinished)
+        ]
+
+    def write_healthcheck(self, now: float) -> None:
+        """
+        Update the healthcheck file with operations data, if it is due.
+
+        The file is written to a temporary file and renamed, so that the healthcheck
+        never reads a partially written file. The temporary file is removed if the
+        write fails.
+        """
+        if now < self.next_healthcheck:
+            return
+        self.next_healthcheck = now + self.healthcheck_seconds
         data: dict[str, str | int] = {
             "timestamp": datetime.now(tz=UTC).isoformat(),
             "cycles": self.cycles,
@@ -475,8 +1307,24 @@ class Command(CommandFromDjangoSettings):
                 self.queue.attributes["ApproximateNumberOfMessagesNotVisible"]
             ),
         }
-        with open(self.healthcheck_path, "w", encoding="utf-8") as healthcheck_file:
-            json.dump(data, healthcheck_file)
+        healthcheck_dir = os.path.dirname(self.healthcheck_path) or "."
+        with tempfile.NamedTemporaryFile(
+            "w", encoding="utf-8", dir=healthcheck_dir, suffix=".tmp", delete=False
+        ) as healthcheck_file:
+            temp_path = healthcheck_file.name
+            try:
+                json.dump(data, healthcheck_file)
+            except BaseException:
+                healthcheck_file.close()
+                os.unlink(temp_path)
+                raise
+        try:
+            # The temporary file is only readable by its owner
+            os.chmod(temp_path, HEALTHCHECK_FILE_MODE)
+            os.replace(temp_path, self.healthcheck_path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
 
     def pluralize(self, value: int, singular: str, plural: str | None = None) -> str:
         """Returns 's' suffix to make plural, like 's' in tasks"""
@@ -486,6 +1334,14 @@ class Command(CommandFromDjangoSettings):
             return f"{value} {plural or (singular + 's')}"
 
 
+def setup_worker() -> None:
+    """Initialize a worker process, before it processes any messages."""
+    setup()
+    # Create the AWS clients now, instead of while processing the first message
+    ses_client()
+    s3_client()
+
+
 def run_sns_inbound_logic(
     topic_arn: str, message_type: str, json_body: str
 ) -> HttpResponse:
@@ -14,6 +14,8 @@ from django.core.validators import MinLengthValidator
 from django.db import models, transaction
 from django.db.models.base import ModelBase
 
+from privaterelay.utils import update_counters
+
 from .exceptions import (
     DomainAddrDuplicateException,
     DomainAddrUnavailableException,
@@ -398,9 +400,7 @@ class Reply(models.Model):
         address = self.relay_address or self.domain_address
         if not address:
             raise ValueError("address must be truthy value")
-        address.num_replied += 1
-        address.last_used_at = datetime.now(UTC)
-        address.save(update_fields=["num_replied", "last_used_at"])
+        update_counters(address, {"num_replied": 1}, last_used_at=datetime.now(UTC))
         return address.num_replied
 
 
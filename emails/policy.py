@@ -7,7 +7,9 @@ headers as well.
 
 The main change is to use a custom header_factory, which:
 
-* For each header, adds the UnstructuredHeader variant as .as_unstructured
+* For each header, adds the UnstructuredHeader variant as .as_unstructured, which is
+  created when first used
+* Reuses the header classes, instead of creating new classes for each header
 * Handles non-compliant Message-IDs generated by Microsoft alerts
 
 See:
@@ -24,6 +26,7 @@ from email.headerregistry import BaseHeader, UnstructuredHeader
 from email.headerregistry import HeaderRegistry as PythonHeaderRegistry
 from email.headerregistry import MessageIDHeader as PythonMessageIDHeader
 from email.policy import EmailPolicy, Policy
+from functools import cache, cached_property
 from typing import TYPE_CHECKING, cast
 
 if TYPE_CHECKING:
@@ -61,18 +64,55 @@ class RelayMessageIDHeader(PythonMessageIDHeader):
         kwds["defects"].extend(parse_tree.all_defects)
 
 
+@cache
+def _unstructured_header_class(base_class: type[BaseHeader]) -> type[BaseHeader]:
+    """Return the UnstructuredHeader class for a header base class."""
+    return cast(
+        type[BaseHeader],
+        type("_UnstructuredHeader", (UnstructuredHeader, base_class), {}),
+    )
+
+
+class RelayHeaderMixin:
+    """Add the unstructured header as .as_unstructured, when first used."""
+
+    # Set by RelayHeaderRegistry
+    as_raw: str
+    name: str
+
+    @cached_property
+    def as_unstructured(self) -> BaseHeader:
+        # The header class bases are (header class, RelayHeaderMixin, base class)
+        base_class = type(self).__bases__[-1]
+        return _unstructured_header_class(base_class)(self.name, self.as_raw)
+
+
+@cache
+def _relay_header_class(cls: type, base_class: type[BaseHeader]) -> type[BaseHeader]:
+    """Return the header class for a header parser class and base class."""
+    return cast(
+        type[BaseHeader],
+        type("_" + cls.__name__, (cls, RelayHeaderMixin, base_class), {}),
+    )
+
+
 class RelayHeaderRegistry(PythonHeaderRegistry):
     """Extend the HeaderRegistry to store the unstructured header."""
 
+    def __getitem__(self, name: str) -> type[BaseHeader]:
+        """
+        Return the header class for a header name.
+
+        The Python registry creates a new class for every header. This reuses a class
+        for each parser class, and adds RelayHeaderMixin.
+        """
+        cls = self.registry.get(name.lower(), self.default_class)
+        return _relay_header_class(cls, self.base_class)
+
     def __call__(self, name: str, value: str) -> BaseHeader:
-        """Add the unstructured header as .as_unstructured."""
-        header_instance = super().__call__(name, value)
-        as_unstructured_cls = type(
-            "_UnstructuredHeader", (UnstructuredHeader, self.base_class), {}
-        )
-        as_unstructured = as_unstructured_cls(name, value)
+        """Add the raw value as .as_raw, for .as_unstructured."""
+        header_instance = self[name](name, value)
         # Avoid mypy attr-defined error for setting a dynamic attribute
-        setattr(header_instance, "as_unstructured", as_unstructured)
         setattr(header_instance, "as_raw", value)
         return header_instance
 
@@ -0,0 +1,30 @@
+from typing import Any
+
+from django.core.exceptions import ObjectDoesNotExist
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+
+from .models import DomainAddress, RelayAddress
+from .utils import forget_cached_mask
+
+
+@receiver(post_delete, sender=RelayAddress, dispatch_uid="emails_forget_relay_address")
+def forget_relay_address(
+    sender: type[RelayAddress], instance: RelayAddress, **kwargs: Any
+) -> None:
+    forget_cached_mask(instance.full_address)
+
+
+@receiver(
+    post_delete, sender=DomainAddress, dispatch_uid="emails_forget_domain_address"
+)
+def forget_domain_address(
+    sender: type[DomainAddress], instance: DomainAddress, **kwargs: Any
+) -> None:
+    try:
+        full_address = instance.full_address
+    except ObjectDoesNotExist:
+        # The profile was deleted first, when deleting the user. The cache entry
+        # does not match the mask, so it is removed when next read.
+        return
+    forget_cached_mask(full_address)
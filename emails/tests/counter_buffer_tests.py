@@ -0,0 +1,209 @@
+from collections.abc import Iterator
+from datetime import UTC, datetime, timedelta
+from unittest.mock import patch
+
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.db import DatabaseError
+
+import pytest
+from model_bakery import baker
+from pytest_django.fixtures import SettingsWrapper
+
+from emails import counter_buffer
+from emails.counter_buffer import (
+    buffer_counters,
+    flush_counter_buffer,
+    flush_counter_buffer_if_due,
+)
+from emails.models import RelayAddress
+from privaterelay.models import Profile
+
+EARLIER = datetime(2024, 1, 1, tzinfo=UTC)
+LATER = EARLIER + timedelta(hours=1)
+
+
+@pytest.fixture(autouse=True)
+def counter_buffer_settings(settings: SettingsWrapper) -> Iterator[SettingsWrapper]:
+    """Start with an empty buffer, and flush only when the test calls for it."""
+    settings.COUNTER_BUFFER_CACHE = "default"
+    settings.COUNTER_BUFFER_FLUSH_SECONDS = 60
+    caches["default"].clear()
+    with (
+        patch.object(counter_buffer, "_memory_changes", {}),
+        patch.object(counter_buffer, "_next_flush_check", float("inf")),
+    ):
+        yield settings
+    caches["default"].clear()
+
+
+@pytest.fixture
+def address(db: None) -> RelayAddress:
+    user = baker.make(User)
+    address: RelayAddress = baker.make(RelayAddress, user=user, num_forwarded=5)
+    return address
+
+
+def test_buffer_counters_without_buffer_writes_now(
+    counter_buffer_settings: SettingsWrapper, address: RelayAddress
+) -> None:
+    counter_buffer_settings.COUNTER_BUFFER = ""
+    buffer_counters(address, {"num_forwarded": 1}, last_used_at=EARLIER)
+
+    address.refresh_from_db()
+    assert address.num_forwarded == 6
+    assert address.last_used_at == EARLIER
+
+
+@pytest.mark.parametrize("mode", ("memory", "cache"))
+def test_buffer_counters_adds_up_changes_until_flushed(
+    counter_buffer_settings: SettingsWrapper, address: RelayAddress, mode: str
+) -> None:
+    counter_buffer_settings.COUNTER_BUFFER = mode
+    profile = address.user.profile
+    Profile.objects.filter(id=profile.id).update(last_engagement=None)
+    buffer_counters(address, {"num_forwarded": 1}, last_used_at=LATER)
+    buffer_counters(
+        address,
+        {"num_forwarded": 1, "num_level_one_trackers_blocked": 2},
+        last_used_at=EARLIER,
+    )
+    buffer_counters(address, {"num_blocked": 1})
+    buffer_counters(profile, last_engagement=EARLIER)
+    assert address.num_forwarded == 7
+
+    stored = RelayAddress.objects.get(id=address.id)
+    assert stored.num_forwarded == 5
+    assert stored.num_blocked == 0
+
+    assert flush_counter_buffer() == 2
+    stored.refresh_from_db()
+    assert stored.num_forwarded == 7
+    assert stored.num_blocked == 1
+    assert stored.num_level_one_trackers_blocked == 2
+    assert stored.last_used_at == LATER
+    assert Profile.objects.get(id=profile.id).last_engagement == EARLIER
+
+    assert flush_counter_buffer() == 0
+    stored.refresh_from_db()
+    assert stored.num_forwarded == 7
+
+
+@pytest.mark.parametrize("mode", ("memory", "cache"))
+def test_flush_keeps_later_stored_timestamp(
+    counter_buffer_settings: SettingsWrapper, address: RelayAddress, mode: str
+) -> None:
+    counter_buffer_settings.COUNTER_BUFFER = mode
+    RelayAddress.objects.filter(id=address.id).update(last_used_at=LATER)
+    buffer_counters(address, last_used_at=EARLIER)
+
+    assert flush_counter_buffer() == 1
+    address.refresh_from_db()
+    assert address.last_used_at == LATER
+
+
+def test_flush_memory_failure_keeps_changes(
+    counter_buffer_settings: SettingsWrapper, address: RelayAddress
+) -> None:
+    counter_buffer_settings.COUNTER_BUFFER = "memory"
+    buffer_counters(address, {"num_forwarded": 1})
+    with (
+        patch.object(
+            counter_buffer, "_write_changes", side_effect=DatabaseError("down")
+        ),
+        pytest.raises(DatabaseError),
+    ):
+        flush_counter_buffer()
+    buffer_counters(address, {"num_forwarded": 1})
+
+    assert flush_counter_buffer() == 1
+    address.refresh_from_db()
+    assert address.num_forwarded == 7
+
+
+def test_flush_cache_waits_one_flush_for_missing_entry(
+    counter_buffer_settings: SettingsWrapper, address: RelayAddress
+) -> None:
+    counter_buffer_settings.COUNTER_BUFFER = "cache"
+    buffer_cache = caches["default"]
+    buffer_counters(address, {"num_forwarded": 1})
+    # Another process has numbered an entry, but not stored it yet
+    buffer_cache.incr(counter_buffer._SEQUENCE_KEY)
+    buffer_counters(address, {"num_forwarded": 1})
+
+    assert flush_counter_buffer() == 1
+    address.refresh_from_db()
+    assert address.num_forwarded == 7
+    assert buffer_cache.get(counter_buffer._CURSOR_KEY) == 1
+
+    buffer_cache.set(
+        counter_buffer._entry_key(2),
+        ("emails.relayaddress", address.id, {"num_forwarded": 1}, {}),
+    )
+    assert flush_counter_buffer() == 1
+    address.refresh_from_db()
+    assert address.num_forwarded == 8
+    assert buffer_cache.get(counter_buffer._CURSOR_KEY) == 3
+
+
+def test_flush_cache_skips_entry_missing_after_a_flush(
+    counter_buffer_settings: SettingsWrapper, address: RelayAddress
+) -> None:
+    counter_buffer_settings.COUNTER_BUFFER = "cache"
+    buffer_cache = caches["default"]
+    buffer_cache.add(counter_buffer._SEQUENCE_KEY, 0, timeout=None)
+    # An entry was numbered by a process that stopped before storing it
+    buffer_cache.incr(counter_buffer._SEQUENCE_KEY)
+
+    assert flush_counter_buffer() == 0
+    assert buffer_cache.get(counter_buffer._CURSOR_KEY) == 0
+    assert flush_counter_buffer() == 0
+    assert buffer_cache.get(counter_buffer._CURSOR_KEY) == 1
+
+    buffer_counters(address, {"num_forwarded": 1})
+    assert flush_counter_buffer() == 1
+    address.refresh_from_db()
+    assert address.num_forwarded == 6
+
+
+def test_flush_cache_skipped_while_another_process_flushes(
+    counter_buffer_settings: SettingsWrapper, address: RelayAddress
+) -> None:
+    counter_buffer_settings.COUNTER_BUFFER = "cache"
+    buffer_counters(address, {"num_forwarded": 1})
+    caches["default"].add(counter_buffer._LOCK_KEY, True)
+
+    assert flush_counter_buffer() == 0
+    caches["default"].delete(counter_buffer._LOCK_KEY)
+    assert flush_counter_buffer() == 1
+
+
+@pytest.mark.parametrize("mode", ("memory", "cache"))
+def test_buffer_counters_flushes_when_due(
+    counter_buffer_settings: SettingsWrapper, address: RelayAddress, mode: str
+) -> None:
+    counter_buffer_settings.COUNTER_BUFFER = mode
+    counter_buffer._next_flush_check = 0.0
+    buffer_counters(address, {"num_forwarded": 1})
+    buffer_counters(address, {"num_forwarded": 1})
+
+    address.refresh_from_db()
+    assert address.num_forwarded == 6
+    assert flush_counter_buffer_if_due() == 0
+
+
+def test_flush_counter_buffer_if_due_logs_failure(
+    counter_buffer_settings: SettingsWrapper,
+    address: RelayAddress,
+    caplog: pytest.LogCaptureFixture,
+) -> None:
+    counter_buffer_settings.COUNTER_BUFFER = "memory"
+    buffer_counters(address, {"num_forwarded": 1})
+    counter_buffer._next_flush_check = 0.0
+    with patch.object(
+        counter_buffer, "_write_changes", side_effect=DatabaseError("down")
+    ):
+        assert flush_counter_buffer_if_due() == 0
+    assert caplog.records[-1].msg == "counter_buffer_flush_failed"
+
+    assert flush_counter_buffer() == 1
@@ -0,0 +1,71 @@
+import json
+from io import StringIO
+from typing import Any
+
+from django.contrib.auth.models import User
+from django.core.management import CommandError, call_command
+
+import pytest
+
+from emails.apps import emails_config
+from emails.models import RelayAddress
+
+
+def run_bench(*args: str) -> dict[str, Any]:
+    """Run the benchmark with JSON output, and return the report."""
+    out = StringIO()
+    call_command("bench_email_pipeline", "--json", *args, stdout=out)
+    report: dict[str, Any] = json.loads(out.getvalue())
+    return report
+
+
+@pytest.mark.django_db(transaction=True)
+def test_bench_email_pipeline_report() -> None:
+    report = run_bench("--messages", "10")
+    assert report["messages"] == 10
+    assert report["messages_per_s"] > 0
+    assert report["peak_rss_mb"] > 0
+    stages = report["stages"]
+    assert stages["verify"]["count"] == 10
+    assert stages["total"]["count"] == 10
+    assert 0 < stages["s3_load"]["count"] <= 8
+    # Parsing is timed separately from the conversion that calls it
+    assert stages["parse"]["count"] == stages["convert"]["count"]
+    assert list(stages)[0] == "verify"
+    assert list(stages)[-2:] == ["db", "total"]
+    assert set(stages["total"]) == {"count", "p50_ms", "p95_ms", "p99_ms"}
+    assert stages["total"]["p50_ms"] <= stages["total"]["p99_ms"]
+
+
+@pytest.mark.django_db(transaction=True)
+def test_bench_email_pipeline_bounces_and_complaints() -> None:
+    report = run_bench("--messages", "4", "--mix", "bounce:1,complaint:1")
+    assert report["messages"] == 4
+    assert report["failed"] == 0
+    assert "s3_load" not in report["stages"]
+    assert report["stages"]["db"]["count"] == 4
+
+
+@pytest.mark.django_db(transaction=True)
+def test_bench_email_pipeline_deletes_seeded_users() -> None:
+    run_bench("--messages", "2")
+    assert not User.objects.filter(username__startswith="bench-").exists()
+    assert not RelayAddress.objects.exists()
+
+
+@pytest.mark.django_db(transaction=True)
+def test_bench_email_pipeline_restores_aws_clients() -> None:
+    config = emails_config()
+    config.__dict__["s3_client"] = s3_client = object()
+    config.__dict__.pop("ses_client", None)
+    try:
+        run_bench("--messages", "2")
+        assert config.s3_client is s3_client
+        assert "ses_client" not in config.__dict__
+    finally:
+        config.__dict__.pop("s3_client", None)
+
+
+def test_bench_email_pipeline_bad_mix() -> None:
+    with pytest.raises(CommandError, match="Unknown notification type 'reply'"):
+        call_command("bench_email_pipeline", "--mix", "reply:1")
@@ -1,4 +1,7 @@
 import json
+import os
+import stat
+import threading
 from collections.abc import Callable, Iterator
 from datetime import UTC, datetime
 from pathlib import Path
@@ -16,6 +19,7 @@ from markus.testing import MetricsMock
 from pytest import LogCaptureFixture
 from pytest_django.fixtures import SettingsWrapper
 
+from emails.management.commands.process_emails_from_sqs import Command, setup_worker
 from emails.sns import VerificationFailed
 from emails.tests.views_tests import EMAIL_SNS_BODIES
 from privaterelay.tests.utils import log_extra, omit_markus_logs
@@ -109,13 +113,21 @@ def test_settings(settings: SettingsWrapper, tmp_path: Path) -> SettingsWrapper:
         "https://sqs.us-east-1.amazonaws.example.com/111222333/queue-name"
     )
     settings.PROCESS_EMAIL_BATCH_SIZE = 10
+    settings.PROCESS_EMAIL_ADAPTIVE_POLLING = False
+    settings.PROCESS_EMAIL_MIN_BATCH_SIZE = 1
+    settings.PROCESS_EMAIL_MIN_WAIT_SECONDS = 0
     settings.PROCESS_EMAIL_DELETE_FAILED_MESSAGES = False
+    settings.PROCESS_EMAIL_RETRY_BACKOFF_SECONDS = 15
     settings.PROCESS_EMAIL_HEALTHCHECK_PATH = str(tmp_path / "healthcheck.json")
+    settings.PROCESS_EMAIL_HEALTHCHECK_SECONDS = 0
+    settings.PROCESS_EMAIL_QUEUE_REFRESH_SECONDS = 0
     settings.PROCESS_EMAIL_MAX_SECONDS = 3
     settings.PROCESS_EMAIL_VERBOSITY = 2
     settings.PROCESS_EMAIL_VISIBILITY_SECONDS = 120
     settings.PROCESS_EMAIL_WAIT_SECONDS = 5
     settings.PROCESS_EMAIL_MAX_SECONDS_PER_MESSAGE = 3
+    settings.PROCESS_EMAIL_CONCURRENCY = 1
+    settings.PROCESS_EMAIL_PREFETCH = False
     return settings
 
 
@@ -140,26 +152,43 @@ def mock_sqs_client() -> Iterator[Mock]:
 @pytest.fixture(autouse=True)
 def mock_process_pool_future() -> Iterator[Mock]:
     """
-    Replace multiprocessing.Pool with a mock, return mocked future.
+    Replace multiprocessing.Pool with a mock, return a mocked future controller.
 
-    The mocked pool.apply_async returns a mocked future that does not start a
-    new subproccess. By default, running ".wait()" runs the (mocked) _sns_inbound_logic.
-    The timeout is appended to future._timeouts, and future.ready() will return True.
+    The mocked pool.apply_async returns a new mocked future that does not start a
+    new subproccess. Each task is for the SQS message that was last parsed. By
+    default, running ".wait()" runs the (mocked) _sns_inbound_logic. The timeout is
+    appended to controller._timeouts, and future.ready() will return True.
 
-    If mock_future.stalled returns False, then future.wait() will return without
-    running _sns_inbound_logic. This can emulate a slow-running process (use a
-    side_effect to return False then True) or a hung process (always return False).
+    If controller._is_stalled(message_id) returns True, then future.wait() will return
+    without running _sns_inbound_logic. This can emulate a slow-running process (use a
+    side_effect to return True then False) or a hung process (always return True).
+
+    If controller._complete_on_ready is True, future.ready() also runs the task,
+    emulating work that completes in the background while another task is waited on.
+
+    The mocked pool class is available as controller._pool_cls, and the futures
+    returned by apply_async are in controller._futures.
     """
 
-    with patch(MOCK_BASE + ".Pool", spec=True) as mock_pool_cls:
-        mock_pool = Mock(spec_set=["__enter__", "__exit__", "apply_async", "terminate"])
-        mock_pool.__enter__ = Mock(return_value=mock_pool)
-        mock_pool.__exit__ = Mock(side_effect=mock_pool.terminate())
+    parse_message = Command.parse_message
+    parsed_ids: list[str] = []
+
+    def record_parse_message(self: Command, message: Any) -> Any:
+        parsed_ids.append(message.message_id)
+        return parse_message(self, message)
+
+    with (
+        patch(MOCK_BASE + ".Pool", spec=True) as mock_pool_cls,
+        patch.object(Command, "parse_message", record_parse_message),
+    ):
+        mock_pool = Mock(spec_set=["apply_async", "terminate"])
 
-        mock_future = Mock()
-        mock_future._timeouts = []
-        mock_future._is_stalled.return_value = False
-        mock_future._ready = False
+        controller = Mock()
+        controller._timeouts = []
+        controller._is_stalled.return_value = False
+        controller._pool_cls = mock_pool_cls
+        controller._futures = []
+        controller._complete_on_ready = False
 
         def mock_apply_async(
             func: Callable[[str, str, Any], HttpResponse],
@@ -168,9 +197,12 @@ def mock_process_pool_future() -> Iterator[Mock]:
             callback: Callable[[Any], None] | None = None,
             error_callback: Callable[[BaseException], None] | None = None,
         ) -> Mock:
-            def call_wait(timeout: float) -> None:
-                mock_future._timeouts.append(timeout)
-                if not mock_future._is_stalled():
+            message_id = parsed_ids[-1]
+            mock_future = Mock(spec_set=["wait", "ready", "_ready"])
+            mock_future._ready = False
+
+            def run_unless_stalled() -> None:
+                if not controller._is_stalled(message_id):
                     mock_future._ready = True
                     try:
                         ret = func(*args)
@@ -181,16 +213,23 @@ def mock_process_pool_future() -> Iterator[Mock]:
                         if callback:
                             callback(ret)
 
+            def call_wait(timeout: float) -> None:
+                controller._timeouts.append(timeout)
+                run_unless_stalled()
+
             def call_ready() -> bool:
+                if controller._complete_on_ready and not mock_future._ready:
+                    run_unless_stalled()
                 return bool(mock_future._ready)
 
             mock_future.wait.side_effect = call_wait
             mock_future.ready.side_effect = call_ready
+            controller._futures.append(mock_future)
             return mock_future
 
         mock_pool_cls.return_value = mock_pool
         mock_pool.apply_async.side_effect = mock_apply_async
-        yield mock_future
+        yield controller
 
 
 def fake_queue(*message_lists: list[Mock] | BaseException) -> Mock:
@@ -200,7 +239,15 @@ def fake_queue(*message_lists: list[Mock] | BaseException) -> Mock:
     Arguments:
     message_lists: A list of lists of messages, None if no messages
     """
-    queue = Mock(spec_set=("receive_messages", "load", "attributes"))
+    queue = Mock(
+        spec_set=(
+            "receive_messages",
+            "load",
+            "attributes",
+            "delete_messages",
+            "change_message_visibility_batch",
+        )
+    )
     queue.attributes = {
         "ApproximateNumberOfMessages": 1,
         "ApproximateNumberOfMessagesDelayed": 2,
@@ -210,9 +257,33 @@ def fake_queue(*message_lists: list[Mock] | BaseException) -> Mock:
         queue.receive_messages.side_effect = message_lists
     else:
         queue.receive_messages.return_value = []
+
+    def all_successful(Entries: list[dict[str, Any]]) -> dict[str, Any]:
+        return {"Successful": [{"Id": entry["Id"]} for entry in Entries], "Failed": []}
+
+    queue.delete_messages.side_effect = all_successful
+    queue.change_message_visibility_batch.side_effect = all_successful
     return queue
 
 
+def deleted_handles(queue: Mock) -> list[str]:
+    """Get the receipt handles of messages deleted with DeleteMessageBatch"""
+    return [
+        entry["ReceiptHandle"]
+        for call in queue.delete_messages.call_args_list
+        for entry in call.kwargs["Entries"]
+    ]
+
+
+def visibility_changes(queue: Mock) -> dict[str, int]:
+    """Get the new visibility timeouts set with ChangeMessageVisibilityBatch"""
+    return {
+        entry["ReceiptHandle"]: entry["VisibilityTimeout"]
+        for call in queue.change_message_visibility_batch.call_args_list
+        for entry in call.kwargs["Entries"]
+    }
+
+
 def fake_sqs_message(body: str) -> Mock:
     """
     Create a fake SQS message
@@ -220,13 +291,22 @@ def fake_sqs_message(body: str) -> Mock:
     Only includes some attributes. For full spec, see:
     https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs.html#message
     """
-    msg = Mock(spec_set=("queue_url", "receipt_handle", "body", "message_id", "delete"))
+    msg = Mock(
+        spec_set=(
+            "queue_url",
+            "receipt_handle",
+            "body",
+            "message_id",
+            "attributes",
+        )
+    )
     msg.queue_url = (
         "https://sqs.us-east-1.amazonaws.example.com/123456789012/queue-name"
     )
     msg.receipt_handle = str(uuid4())
     msg.body = body
     msg.message_id = str(uuid4())
+    msg.attributes = {"ApproximateReceiveCount": "1"}
     return msg
 
 
@@ -254,13 +334,22 @@ def test_no_messages(caplog: LogCaptureFixture, test_settings: SettingsWrapper)
     rec1, rec2, rec3, rec4 = omit_markus_logs(caplog)
     assert rec1.getMessage() == "Starting process_emails_from_sqs"
     assert log_extra(rec1) == {
+        "adaptive_polling": False,
         "aws_region": "us-east-1",
         "batch_size": 10,
+        "concurrency": 1,
         "delete_failed_messages": False,
+        "retry_backoff_seconds": 15,
         "healthcheck_path": test_settings.PROCESS_EMAIL_HEALTHCHECK_PATH,
+        "healthcheck_seconds": 0,
+        "queue_refresh_seconds": 0,
         "max_seconds": 3,
         "max_seconds_per_message": 3,
+        "min_batch_size": 1,
+        "min_wait_seconds": 0,
+        "prefetch": False,
         "sqs_url": "https://sqs.us-east-1.amazonaws.example.com/111222333/queue-name",
+        "use_async": False,
         "verbosity": 2,
         "visibility_seconds": 120,
         "wait_seconds": 5,
@@ -321,7 +410,6 @@ def test_one_message(
         "message_process_time_s",
         "sqs_message_id",
         "success",
-        "subprocess_setup_time_s",
     }
     assert msg_extra["success"]
 
@@ -338,6 +426,34 @@ def test_one_message(
     mock_django_db_connection.close.assert_not_called()
 
 
+@pytest.mark.parametrize("use_async", (False, True))
+def test_message_stage_times(
+    use_async: bool,
+    test_settings: SettingsWrapper,
+    mock_sns_inbound_logic: Mock,
+    mock_sqs_client: Mock,
+    mock_db_connection_all_threads: Mock,
+    caplog: LogCaptureFixture,
+) -> None:
+    """The stage times of a processed email are added to the message log."""
+    test_settings.PROCESS_EMAIL_MAX_SECONDS = None
+    response = HttpResponse("Sent email to final recipient.")
+    response.stage_times_s = {"parse": 0.002, "ses_send": 0.05}  # type: ignore[attr-defined]
+    mock_sns_inbound_logic.return_value = response
+    msg = fake_sqs_message(json.dumps(TEST_SNS_MESSAGE))
+    mock_sqs_client.return_value = fake_queue([msg], KeyboardInterrupt())
+    call_command(COMMAND_NAME, *(["--async"] if use_async else []))
+
+    msg_logs = [
+        log_extra(rec)
+        for rec in omit_markus_logs(caplog)
+        if rec.msg == "Message processed"
+    ]
+    assert len(msg_logs) == 1
+    assert msg_logs[0]["success"]
+    assert msg_logs[0]["stage_times_s"] == {"parse": 0.002, "ses_send": 0.05}
+
+
 def test_keyboard_interrupt(
     mock_sqs_client: Mock, caplog: LogCaptureFixture, test_settings: SettingsWrapper
 ) -> None:
@@ -358,7 +474,7 @@ def test_no_body(mock_sqs_client: Mock, caplog: LogCaptureFixture) -> None:
     summary = summary_from_exit_log(caplog)
     assert summary["failed_messages"] == 1
     assert summary["cycles"] == 2
-    msg.delete.assert_not_called()
+    assert msg.receipt_handle not in deleted_handles(mock_sqs_client.return_value)
 
 
 def test_no_body_deleted(
@@ -372,7 +488,7 @@ def test_no_body_deleted(
     summary = summary_from_exit_log(caplog)
     assert summary["failed_messages"] == 1
     assert summary["cycles"] == 2
-    msg.delete.assert_called_once_with()
+    assert deleted_handles(mock_sqs_client.return_value).count(msg.receipt_handle) == 1
 
 
 def test_ses_temp_failure(
@@ -398,7 +514,7 @@ def test_ses_temp_failure(
     summary = summary_from_exit_log(caplog)
     assert summary["total_messages"] == 1
     assert summary["failed_messages"] == 1
-    msg.delete.assert_not_called()
+    assert msg.receipt_handle not in deleted_handles(mock_sqs_client.return_value)
 
 
 def test_ses_generic_failure(
@@ -413,7 +529,8 @@ def test_ses_generic_failure(
     summary = summary_from_exit_log(caplog)
     assert summary["total_messages"] == 1
     assert summary["failed_messages"] == 1
-    msg.delete.assert_not_called()
+    assert msg.receipt_handle not in deleted_handles(mock_sqs_client.return_value)
+    assert visibility_changes(mock_sqs_client.return_value) == {msg.receipt_handle: 15}
 
 
 def test_ses_python_error(
@@ -431,7 +548,7 @@ def test_ses_python_error(
     summary = summary_from_exit_log(caplog)
     assert summary["total_messages"] == 1
     assert summary["failed_messages"] == 1
-    msg.delete.assert_not_called()
+    assert msg.receipt_handle not in deleted_handles(mock_sqs_client.return_value)
     rec2 = omit_markus_logs(caplog)[1]
     assert rec2.msg == "Message processed"
     rec2_extra = log_extra(rec2)
@@ -454,13 +571,12 @@ def test_ses_slow(
     call_command(COMMAND_NAME)
     summary = summary_from_exit_log(caplog)
     assert summary["total_messages"] == 1
-    msg.delete.assert_called()
+    assert deleted_handles(mock_sqs_client.return_value).count(msg.receipt_handle) == 1
     rec2 = omit_markus_logs(caplog)[1]
     assert rec2.msg == "Message processed"
     rec2_extra = log_extra(rec2)
     assert rec2_extra["success"] is True
     assert rec2_extra["message_process_time_s"] < 120.0
-    assert rec2_extra["subprocess_setup_time_s"] == 1.0
     # future.wait(1.0) was called 3 times, was ready after the 3rd call.
     assert mock_process_pool_future._timeouts == [1.0] * 3
 
@@ -480,15 +596,64 @@ def test_ses_timeout(
     summary = summary_from_exit_log(caplog)
     assert summary["total_messages"] == 1
     assert summary["failed_messages"] == 1
-    msg.delete.assert_not_called()
+    assert msg.receipt_handle not in deleted_handles(mock_sqs_client.return_value)
     rec2 = omit_markus_logs(caplog)[1]
     assert rec2.msg == "Message processed"
     rec2_extra = log_extra(rec2)
     assert rec2_extra["success"] is False
     assert rec2_extra["error"] == "Timed out after 120.0 seconds."
     assert rec2_extra["message_process_time_s"] >= 120.0
-    assert rec2_extra["subprocess_setup_time_s"] == 1.0
+    assert rec2_extra["worker_killed"] is True
     assert mock_process_pool_future._timeouts == [1.0] * 120
+    # The pool was replaced, and the message was not started again
+    mock_pool_cls = mock_process_pool_future._pool_cls
+    assert mock_pool_cls.call_count == 2
+    assert mock_pool_cls.return_value.terminate.call_count == 2
+    assert mock_pool_cls.return_value.apply_async.call_count == 1
+
+
+def test_timeout_before_start_does_not_run_later(
+    mock_sns_inbound_logic: Mock,
+    mock_sqs_client: Mock,
+    mock_process_pool_future: Mock,
+    test_settings: SettingsWrapper,
+    caplog: LogCaptureFixture,
+) -> None:
+    """
+    A message that times out before a worker starts it is dropped with the pool, so
+    it is not processed after it is scheduled for a retry.
+    """
+    test_settings.PROCESS_EMAIL_MAX_SECONDS_PER_MESSAGE = 2
+    msg = fake_sqs_message(json.dumps(TEST_SNS_MESSAGE))
+    queue = fake_queue([msg], [], [])
+    mock_sqs_client.return_value = queue
+    mock_pool = mock_process_pool_future._pool_cls.return_value
+    # The task waits for a worker until the pool is terminated
+    mock_process_pool_future._is_stalled.side_effect = (
+        lambda message_id: not mock_pool.terminate.called
+    )
+    call_command(COMMAND_NAME)
+
+    assert summary_from_exit_log(caplog)["failed_messages"] == 1
+    mock_sns_inbound_logic.assert_not_called()
+    assert msg.receipt_handle in visibility_changes(queue)
+    assert msg.receipt_handle not in deleted_handles(queue)
+
+
+def test_worker_pool_created_once(
+    mock_sqs_client: Mock, mock_process_pool_future: Mock, caplog: LogCaptureFixture
+) -> None:
+    """The worker pool is created once, and used for every message."""
+    msgs = [fake_sqs_message(json.dumps(TEST_SNS_MESSAGE)) for _ in range(3)]
+    mock_sqs_client.return_value = fake_queue(msgs, [])
+    call_command(COMMAND_NAME)
+    summary = summary_from_exit_log(caplog)
+    assert summary["total_messages"] == 3
+    mock_pool_cls = mock_process_pool_future._pool_cls
+    mock_pool_cls.assert_called_once()
+    assert mock_pool_cls.call_args.kwargs["initializer"] is setup_worker
+    assert mock_pool_cls.return_value.apply_async.call_count == 3
+    mock_pool_cls.return_value.terminate.assert_called_once_with()
 
 
 def test_db_is_unusable_is_closed(
@@ -501,7 +666,7 @@ def test_db_is_unusable_is_closed(
     call_command(COMMAND_NAME)
     summary = summary_from_exit_log(caplog)
     assert summary["total_messages"] == 1
-    msg.delete.assert_called()
+    assert deleted_handles(mock_sqs_client.return_value).count(msg.receipt_handle) == 1
     rec2 = omit_markus_logs(caplog)[1]
     assert rec2.msg == "Message processed"
     rec2_extra = log_extra(rec2)
@@ -569,6 +734,58 @@ def test_writes_healthcheck_file(test_settings: SettingsWrapper) -> None:
     ts = datetime.fromisoformat(content["timestamp"])
     duration = (datetime.now(tz=UTC) - ts).total_seconds()
     assert 0.0 < duration < 0.5
+    # The temporary file was renamed to the healthcheck path
+    assert os.listdir(os.path.dirname(healthcheck_path)) == ["healthcheck.json"]
+
+
+def test_healthcheck_file_readable_by_others(test_settings: SettingsWrapper) -> None:
+    """The healthcheck file can be read by a healthcheck running as another user."""
+    call_command("process_emails_from_sqs")
+    mode = os.stat(test_settings.PROCESS_EMAIL_HEALTHCHECK_PATH).st_mode
+    assert stat.S_IMODE(mode) == 0o644
+
+
+@pytest.mark.parametrize("failing_call", ("json.dump", "os.replace"))
+def test_healthcheck_temp_file_removed_on_failure(
+    test_settings: SettingsWrapper, failing_call: str
+) -> None:
+    """If writing the healthcheck file fails, the temporary file is removed."""
+    healthcheck_path = test_settings.PROCESS_EMAIL_HEALTHCHECK_PATH
+    with (
+        patch(f"{MOCK_BASE}.{failing_call}", side_effect=OSError("disk full")),
+        pytest.raises(OSError, match="disk full"),
+    ):
+        call_command("process_emails_from_sqs")
+    assert os.listdir(os.path.dirname(healthcheck_path)) == []
+
+
+def test_healthcheck_file_throttled(test_settings: SettingsWrapper) -> None:
+    """The healthcheck file is not rewritten until PROCESS_EMAIL_HEALTHCHECK_SECONDS."""
+    test_settings.PROCESS_EMAIL_HEALTHCHECK_SECONDS = 10
+    with patch(f"{MOCK_BASE}.os.replace", side_effect=os.replace) as mock_replace:
+        call_command("process_emails_from_sqs")
+    mock_replace.assert_called_once()
+    with open(test_settings.PROCESS_EMAIL_HEALTHCHECK_PATH) as healthcheck_file:
+        content = json.load(healthcheck_file)
+    assert content["cycles"] == 0
+
+
+def test_queue_attributes_throttled(
+    test_settings: SettingsWrapper, mock_sqs_client: Mock, caplog: LogCaptureFixture
+) -> None:
+    """Queue attributes are loaded at most every PROCESS_EMAIL_QUEUE_REFRESH_SECONDS."""
+    test_settings.PROCESS_EMAIL_QUEUE_REFRESH_SECONDS = 10
+    test_settings.PROCESS_EMAIL_MAX_SECONDS = 4
+    queue = fake_queue()
+    mock_sqs_client.return_value = queue
+    call_command(COMMAND_NAME)
+
+    assert summary_from_exit_log(caplog)["cycles"] == 3
+    queue.load.assert_called_once_with()
+    cycle0, cycle1, cycle2 = cycle_logs(caplog)
+    assert cycle0["queue_count"] == 1
+    assert "queue_count" not in cycle1
+    assert "queue_load_s" not in cycle2
 
 
 def test_connection_closed_after_message_processed(
@@ -598,3 +815,634 @@ def test_command_sqs_client_error(
         call_command(COMMAND_NAME)
     assert str(err.value) == "Unable to connect to SQS"
     mock_sqs_client.assert_called_once_with(test_settings.AWS_SQS_EMAIL_QUEUE_URL)
+
+
+def test_concurrent_messages(
+    test_settings: SettingsWrapper,
+    mock_sqs_client: Mock,
+    mock_process_pool_future: Mock,
+    caplog: LogCaptureFixture,
+) -> None:
+    """With PROCESS_EMAIL_CONCURRENCY, several messages are sent to workers at once."""
+    test_settings.PROCESS_EMAIL_CONCURRENCY = 3
+    test_settings.PROCESS_EMAIL_MAX_SECONDS_PER_MESSAGE = 60
+    msgs = [fake_sqs_message(json.dumps(TEST_SNS_MESSAGE)) for _ in range(4)]
+    mock_sqs_client.return_value = fake_queue(msgs, [])
+    call_command(COMMAND_NAME)
+
+    summary = summary_from_exit_log(caplog)
+    assert summary["total_messages"] == 4
+    assert "failed_messages" not in summary
+    mock_pool_cls = mock_process_pool_future._pool_cls
+    assert mock_pool_cls.call_args.args == (3,)
+    for msg in msgs:
+        assert (
+            deleted_handles(mock_sqs_client.return_value).count(msg.receipt_handle) == 1
+        )
+    # Three messages were started before the first wait
+    first_future = mock_process_pool_future._futures[0]
+    assert len(mock_process_pool_future._futures) == 4
+    assert first_future.wait.call_args_list[0].args == (0.1,)
+    msg_logs = [
+        rec for rec in omit_markus_logs(caplog) if rec.msg == "Message processed"
+    ]
+    assert len(msg_logs) == 4
+
+
+def test_concurrent_message_timeout(
+    test_settings: SettingsWrapper,
+    mock_sqs_client: Mock,
+    mock_process_pool_future: Mock,
+    caplog: LogCaptureFixture,
+) -> None:
+    """A hung message times out, while other messages complete."""
+    test_settings.PROCESS_EMAIL_CONCURRENCY = 2
+    test_settings.PROCESS_EMAIL_MAX_SECONDS = None
+    hung_msg, ok_msg = (fake_sqs_message(json.dumps(TEST_SNS_MESSAGE)) for _ in "ab")
+    mock_sqs_client.return_value = fake_queue([hung_msg, ok_msg], KeyboardInterrupt())
+    mock_process_pool_future._complete_on_ready = True
+    mock_process_pool_future._is_stalled.side_effect = (
+        lambda message_id: message_id == hung_msg.message_id
+    )
+    call_command(COMMAND_NAME)
+
+    summary = summary_from_exit_log(caplog)
+    assert summary["total_messages"] == 2
+    assert summary["failed_messages"] == 1
+    assert hung_msg.receipt_handle not in deleted_handles(mock_sqs_client.return_value)
+    assert (
+        deleted_handles(mock_sqs_client.return_value).count(ok_msg.receipt_handle) == 1
+    )
+    # The finished message was not started again in the new pool
+    mock_pool_cls = mock_process_pool_future._pool_cls
+    assert mock_pool_cls.call_count == 2
+    assert mock_pool_cls.return_value.apply_async.call_count == 2
+    ok_log, hung_log = (
+        log_extra(rec)
+        for rec in omit_markus_logs(caplog)
+        if rec.msg == "Message processed"
+    )
+    assert ok_log["sqs_message_id"] == ok_msg.message_id
+    assert ok_log["success"] is True
+    assert hung_log["sqs_message_id"] == hung_msg.message_id
+    assert hung_log["error"] == "Timed out after 3.0 seconds."
+
+
+def test_message_timeout_restarts_unfinished_messages(
+    test_settings: SettingsWrapper,
+    mock_sqs_client: Mock,
+    mock_sns_inbound_logic: Mock,
+    mock_process_pool_future: Mock,
+    caplog: LogCaptureFixture,
+) -> None:
+    """When the pool is replaced, an unfinished message is started in the new pool."""
+    test_settings.PROCESS_EMAIL_CONCURRENCY = 2
+    test_settings.PROCESS_EMAIL_MAX_SECONDS = None
+    test_settings.PROCESS_EMAIL_MAX_SECONDS_PER_MESSAGE = 3
+    hung_msg, fast_msg, slow_msg = (
+        fake_sqs_message(json.dumps(TEST_SNS_MESSAGE)) for _ in "abc"
+    )
+    queue = fake_queue([hung_msg, fast_msg, slow_msg], KeyboardInterrupt())
+    mock_sqs_client.return_value = queue
+    mock_pool = mock_process_pool_future._pool_cls.return_value
+    mock_process_pool_future._complete_on_ready = True
+    # The slow message starts after the fast one, and only finishes in the new pool
+    mock_process_pool_future._is_stalled.side_effect = lambda message_id: (
+        message_id == hung_msg.message_id
+        or (message_id == slow_msg.message_id and not mock_pool.terminate.called)
+    )
+    call_command(COMMAND_NAME)
+
+    summary = summary_from_exit_log(caplog)
+    assert summary["total_messages"] == 3
+    assert summary["failed_messages"] == 1
+    assert mock_pool.apply_async.call_count == 4
+    assert mock_sns_inbound_logic.call_count == 2
+    assert deleted_handles(queue) == [fast_msg.receipt_handle, slow_msg.receipt_handle]
+    assert hung_msg.receipt_handle in visibility_changes(queue)
+
+
+def cycle_logs(caplog_fixture: LogCaptureFixture) -> list[dict[str, Any]]:
+    """Get the extra data from the cycle log messages"""
+    return [
+        log_extra(rec)
+        for rec in omit_markus_logs(caplog_fixture)
+        if rec.getMessage().startswith("Cycle ")
+    ]
+
+
+def test_prefetch_next_batch(
+    test_settings: SettingsWrapper,
+    mock_sqs_client: Mock,
+    mock_process_pool_future: Mock,
+    caplog: LogCaptureFixture,
+) -> None:
+    """With PROCESS_EMAIL_PREFETCH, the next batch is polled during processing."""
+    test_settings.PROCESS_EMAIL_PREFETCH = True
+    test_settings.PROCESS_EMAIL_MAX_SECONDS = 10
+    msg1, msg2 = (fake_sqs_message(json.dumps(TEST_SNS_MESSAGE)) for _ in "ab")
+    mock_sqs_client.return_value = fake_queue([msg1], [msg2], [])
+    call_command(COMMAND_NAME)
+
+    assert summary_from_exit_log(caplog)["total_messages"] == 2
+    assert deleted_handles(mock_sqs_client.return_value).count(msg1.receipt_handle) == 1
+    assert deleted_handles(mock_sqs_client.return_value).count(msg2.receipt_handle) == 1
+    assert msg2.receipt_handle not in visibility_changes(mock_sqs_client.return_value)
+    cycle1, cycle2 = cycle_logs(caplog)[:2]
+    assert "prefetched" not in cycle1
+    assert cycle2["prefetched"] is True
+    assert cycle2["message_count"] == 1
+    # One queue for the main loop, and one for the prefetch thread
+    assert mock_sqs_client.call_count == 2
+
+
+def test_prefetch_expired_batch_is_released(
+    test_settings: SettingsWrapper,
+    mock_sqs_client: Mock,
+    mock_process_pool_future: Mock,
+    caplog: LogCaptureFixture,
+) -> None:
+    """A prefetched batch that could exceed the visibility timeout is released."""
+    test_settings.PROCESS_EMAIL_PREFETCH = True
+    test_settings.PROCESS_EMAIL_MAX_SECONDS = 10
+    test_settings.PROCESS_EMAIL_VISIBILITY_SECONDS = 3
+    msg1, msg2 = (fake_sqs_message(json.dumps(TEST_SNS_MESSAGE)) for _ in "ab")
+    mock_sqs_client.return_value = fake_queue([msg1], [msg2], [msg2], [])
+    call_command(COMMAND_NAME)
+
+    assert visibility_changes(mock_sqs_client.return_value)[msg2.receipt_handle] == 0
+    assert deleted_handles(mock_sqs_client.return_value).count(msg2.receipt_handle) == 1
+    cycle2 = cycle_logs(caplog)[1]
+    assert "prefetched" not in cycle2
+    assert cycle2["prefetch_released"] == 1
+
+
+def test_prefetch_released_on_exit(
+    test_settings: SettingsWrapper,
+    mock_sqs_client: Mock,
+    mock_process_pool_future: Mock,
+    caplog: LogCaptureFixture,
+) -> None:
+    """Prefetched messages are released when the command exits."""
+    test_settings.PROCESS_EMAIL_PREFETCH = True
+    test_settings.PROCESS_EMAIL_MAX_SECONDS = 2
+    msg1, msg2 = (fake_sqs_message(json.dumps(TEST_SNS_MESSAGE)) for _ in "ab")
+    mock_sqs_client.return_value = fake_queue([msg1], [msg2])
+    call_command(COMMAND_NAME)
+
+    summary = summary_from_exit_log(caplog)
+    assert summary["exit_on"] == "max_seconds"
+    assert summary["cycles"] == 1
+    assert summary["total_messages"] == 1
+    assert deleted_handles(mock_sqs_client.return_value).count(msg1.receipt_handle) == 1
+    assert msg2.receipt_handle not in deleted_handles(mock_sqs_client.return_value)
+    assert visibility_changes(mock_sqs_client.return_value)[msg2.receipt_handle] == 0
+
+
+def test_messages_deleted_in_one_batch(
+    mock_sqs_client: Mock, mock_process_pool_future: Mock
+) -> None:
+    """Processed messages are deleted with one DeleteMessageBatch call."""
+    msgs = [fake_sqs_message(json.dumps(TEST_SNS_MESSAGE)) for _ in range(3)]
+    queue = fake_queue(msgs, [])
+    mock_sqs_client.return_value = queue
+    call_command(COMMAND_NAME)
+
+    queue.delete_messages.assert_called_once_with(
+        Entries=[
+            {"Id": str(num), "ReceiptHandle": msg.receipt_handle}
+            for num, msg in enumerate(msgs)
+        ]
+    )
+    queue.change_message_visibility_batch.assert_not_called()
+
+
+@pytest.mark.parametrize(
+    "receive_count,retry_after_s", (("1", 15), ("3", 60), ("5", 120), ("40", 120))
+)
+def test_failed_message_retry_backoff(
+    mock_sns_inbound_logic: Mock,
+    mock_sqs_client: Mock,
+    caplog: LogCaptureFixture,
+    receive_count: str,
+    retry_after_s: int,
+) -> None:
+    """A failed message is visible again after a backoff, up to the visibility time."""
+    mock_sns_inbound_logic.side_effect = make_client_error(code="InternalError")
+    msg = fake_sqs_message(json.dumps(TEST_SNS_MESSAGE))
+    msg.attributes = {"ApproximateReceiveCount": receive_count}
+    mock_sqs_client.return_value = fake_queue([msg], [])
+    call_command(COMMAND_NAME)
+
+    changes = visibility_changes(mock_sqs_client.return_value)
+    assert changes == {msg.receipt_handle: retry_after_s}
+    msg_log = next(
+        rec for rec in omit_markus_logs(caplog) if rec.msg == "Message processed"
+    )
+    assert log_extra(msg_log)["retry_after_s"] == retry_after_s
+
+
+def test_delete_partial_failure(
+    mock_sqs_client: Mock, mock_process_pool_future: Mock, caplog: LogCaptureFixture
+) -> None:
+    """Deletes that fail on the SQS side are retried, and others are logged."""
+    msgs = [fake_sqs_message(json.dumps(TEST_SNS_MESSAGE)) for _ in range(3)]
+    queue = fake_queue(msgs, [])
+    queue.delete_messages.side_effect = [
+        {
+            "Successful": [{"Id": "0"}],
+            "Failed": [
+                {"Id": "1", "SenderFault": False, "Code": "InternalError"},
+                {"Id": "2", "SenderFault": True, "Code": "ReceiptHandleIsInvalid"},
+            ],
+        },
+        {"Successful": [{"Id": "1"}], "Failed": []},
+    ]
+    mock_sqs_client.return_value = queue
+    call_command(COMMAND_NAME)
+
+    assert queue.delete_messages.call_count == 2
+    retry_call = queue.delete_messages.call_args_list[1]
+    assert retry_call.kwargs == {
+        "Entries": [{"Id": "1", "ReceiptHandle": msgs[1].receipt_handle}]
+    }
+    error_logs = [
+        rec for rec in caplog.records if rec.msg == "sqs_delete_messages_error"
+    ]
+    assert len(error_logs) == 1
+    assert log_extra(error_logs[0])["Code"] == "ReceiptHandleIsInvalid"
+    cycle_log = next(
+        rec for rec in omit_markus_logs(caplog) if rec.msg.startswith("Cycle 0")
+    )
+    assert log_extra(cycle_log)["delete_failed_count"] == 1
+
+
+def test_delete_client_error(
+    mock_sqs_client: Mock, mock_process_pool_future: Mock, caplog: LogCaptureFixture
+) -> None:
+    """If DeleteMessageBatch fails, the error is logged, and the command continues."""
+    msg = fake_sqs_message(json.dumps(TEST_SNS_MESSAGE))
+    queue = fake_queue([msg], [])
+    queue.delete_messages.side_effect = make_client_error(code="InternalError")
+    mock_sqs_client.return_value = queue
+    call_command(COMMAND_NAME)
+
+    summary = summary_from_exit_log(caplog)
+    assert summary["total_messages"] == 1
+    error_logs = [
+        rec for rec in caplog.records if rec.msg == "sqs_delete_messages_error"
+    ]
+    assert len(error_logs) == 1
+
+
+def test_visibility_extended_for_slow_messages(
+    test_settings: SettingsWrapper,
+    mock_sqs_client: Mock,
+    mock_process_pool_future: Mock,
+    caplog: LogCaptureFixture,
+) -> None:
+    """The visibility timeout is extended for messages still in the batch."""
+    test_settings.STATSD_ENABLED = True
+    test_settings.PROCESS_EMAIL_VISIBILITY_SECONDS = 4
+    test_settings.PROCESS_EMAIL_MAX_SECONDS_PER_MESSAGE = 60
+    test_settings.PROCESS_EMAIL_MAX_SECONDS = 10
+    slow_msg, next_msg = (fake_sqs_message(json.dumps(TEST_SNS_MESSAGE)) for _ in "ab")
+    queue = fake_queue([slow_msg, next_msg], [])
+    mock_sqs_client.return_value = queue
+    stall_count = 0
+
+    def is_stalled(message_id: str) -> bool:
+        nonlocal stall_count
+        if message_id != slow_msg.message_id or stall_count >= 3:
+            return False
+        stall_count += 1
+        return True
+
+    mock_process_pool_future._is_stalled.side_effect = is_stalled
+    with MetricsMock() as mm:
+        call_command(COMMAND_NAME)
+
+    assert summary_from_exit_log(caplog)["total_messages"] == 2
+    extend_calls = queue.change_message_visibility_batch.call_args_list
+    assert extend_calls[0].kwargs == {
+        "Entries": [
+            {
+                "Id": "0",
+                "ReceiptHandle": next_msg.receipt_handle,
+                "VisibilityTimeout": 4,
+            },
+            {
+                "Id": "1",
+                "ReceiptHandle": slow_msg.receipt_handle,
+                "VisibilityTimeout": 4,
+            },
+        ]
+    }
+    mm.assert_incr("sqs_visibility_extended", 2)
+    cycle_log = cycle_logs(caplog)[0]
+    assert cycle_log["visibility_extended_count"] == len(extend_calls)
+    assert deleted_handles(queue) == [slow_msg.receipt_handle, next_msg.receipt_handle]
+
+
+def test_finished_messages_deleted_while_slow_message_runs(
+    test_settings: SettingsWrapper,
+    mock_sqs_client: Mock,
+    mock_process_pool_future: Mock,
+    caplog: LogCaptureFixture,
+) -> None:
+    """Finished messages are deleted before the visibility timeout of the batch."""
+    test_settings.PROCESS_EMAIL_VISIBILITY_SECONDS = 4
+    test_settings.PROCESS_EMAIL_MAX_SECONDS_PER_MESSAGE = 60
+    test_settings.PROCESS_EMAIL_MAX_SECONDS = None
+    test_settings.PROCESS_EMAIL_CONCURRENCY = 3
+    slow_msg, fast_msg1, fast_msg2 = (
+        fake_sqs_message(json.dumps(TEST_SNS_MESSAGE)) for _ in "abc"
+    )
+    queue = fake_queue([slow_msg, fast_msg1, fast_msg2], KeyboardInterrupt())
+    mock_sqs_client.return_value = queue
+    mock_process_pool_future._complete_on_ready = True
+    stall_count = 0
+
+    def is_stalled(message_id: str) -> bool:
+        """The slow message runs for longer than the visibility timeout."""
+        nonlocal stall_count
+        if message_id != slow_msg.message_id or stall_count >= 10:
+            return False
+        stall_count += 1
+        return True
+
+    mock_process_pool_future._is_stalled.side_effect = is_stalled
+    call_command(COMMAND_NAME)
+
+    assert summary_from_exit_log(caplog)["total_messages"] == 3
+    delete_calls = [
+        [entry["ReceiptHandle"] for entry in call.kwargs["Entries"]]
+        for call in queue.delete_messages.call_args_list
+    ]
+    assert delete_calls == [
+        [fast_msg1.receipt_handle, fast_msg2.receipt_handle],
+        [slow_msg.receipt_handle],
+    ]
+    extend_calls = [
+        [entry["ReceiptHandle"] for entry in call.kwargs["Entries"]]
+        for call in queue.change_message_visibility_batch.call_args_list
+    ]
+    assert len(extend_calls) > 1
+    assert all(handles == [slow_msg.receipt_handle] for handles in extend_calls)
+
+
+def test_settled_messages_sent_in_full_batches(
+    test_settings: SettingsWrapper,
+    mock_sqs_client: Mock,
+    mock_process_pool_future: Mock,
+) -> None:
+    """Deletes are sent when there are 10, rather than at the end of the batch."""
+    test_settings.PROCESS_EMAIL_MAX_SECONDS = None
+    msgs = [fake_sqs_message(json.dumps(TEST_SNS_MESSAGE)) for _ in range(10)]
+    last_msg = fake_sqs_message(json.dumps(TEST_SNS_MESSAGE))
+    queue = fake_queue([*msgs, last_msg], KeyboardInterrupt())
+    mock_sqs_client.return_value = queue
+    call_command(COMMAND_NAME)
+
+    delete_calls = [
+        [entry["ReceiptHandle"] for entry in call.kwargs["Entries"]]
+        for call in queue.delete_messages.call_args_list
+    ]
+    assert delete_calls == [
+        [msg.receipt_handle for msg in msgs],
+        [last_msg.receipt_handle],
+    ]
+
+
+def test_memory_counter_buffer_rejected_with_worker_pool(
+    test_settings: SettingsWrapper, mock_process_pool_future: Mock
+) -> None:
+    """Worker processes can not buffer counters in memory, they are not flushed."""
+    test_settings.COUNTER_BUFFER = "memory"
+    with pytest.raises(CommandError, match="COUNTER_BUFFER='memory' requires --async"):
+        call_command(COMMAND_NAME)
+    mock_process_pool_future._pool_cls.assert_not_called()
+
+
+def test_cache_counter_buffer_flushed_with_worker_pool(
+    test_settings: SettingsWrapper,
+    mock_sqs_client: Mock,
+    mock_process_pool_future: Mock,
+) -> None:
+    """With worker processes, the command flushes counters buffered in the cache."""
+    test_settings.COUNTER_BUFFER = "cache"
+    msg = fake_sqs_message(json.dumps(TEST_SNS_MESSAGE))
+    mock_sqs_client.return_value = fake_queue([msg], [])
+    with (
+        patch(f"{MOCK_BASE}.flush_counter_buffer_if_due", return_value=0) as mock_due,
+        patch(f"{MOCK_BASE}.flush_counter_buffer", return_value=0) as mock_flush,
+    ):
+        call_command(COMMAND_NAME)
+
+    mock_process_pool_future._pool_cls.assert_called_once()
+    mock_due.assert_called_with()
+    mock_flush.assert_called_once_with()
+
+
+def test_adaptive_polling(
+    test_settings: SettingsWrapper,
+    mock_sqs_client: Mock,
+    mock_process_pool_future: Mock,
+    caplog: LogCaptureFixture,
+) -> None:
+    """
+    With adaptive polling, a full batch skips the wait, a partial batch sizes the
+    next poll, and idle polls back off at the maximum batch size.
+    """
+    test_settings.PROCESS_EMAIL_ADAPTIVE_POLLING = True
+    test_settings.PROCESS_EMAIL_MAX_SECONDS = None
+    test_settings.PROCESS_EMAIL_WAIT_SECONDS = 4
+    test_settings.PROCESS_EMAIL_BATCH_SIZE = 4
+    test_settings.PROCESS_EMAIL_CONCURRENCY = 4
+    msgs = [fake_sqs_message(json.dumps(TEST_SNS_MESSAGE)) for _ in range(5)]
+    queue = fake_queue(msgs[:4], msgs[4:], [], [], [], KeyboardInterrupt())
+    queue.attributes["ApproximateNumberOfMessages"] = 0
+    mock_sqs_client.return_value = queue
+    call_command(COMMAND_NAME)
+
+    polls = [
+        (call.kwargs["MaxNumberOfMessages"], call.kwargs["WaitTimeSeconds"])
+        for call in queue.receive_messages.call_args_list
+    ]
+    assert polls == [(4, 4), (4, 0), (1, 0), (4, 1), (4, 2), (4, 4)]
+    changes = [
+        {key: log[key] for key in ("poll_batch_size", "poll_wait_s") if key in log}
+        for log in cycle_logs(caplog)
+    ]
+    assert changes == [
+        {"poll_wait_s": 0},
+        {"poll_batch_size": 1},
+        {"poll_batch_size": 4, "poll_wait_s": 1},
+        {"poll_wait_s": 2},
+        {"poll_wait_s": 4},
+    ]
+
+
+def test_adaptive_polling_deep_queue(
+    test_settings: SettingsWrapper,
+    mock_sqs_client: Mock,
+    mock_process_pool_future: Mock,
+    caplog: LogCaptureFixture,
+) -> None:
+    """With adaptive polling, a deep queue is polled at the maximum batch size."""
+    test_settings.PROCESS_EMAIL_ADAPTIVE_POLLING = True
+    test_settings.PROCESS_EMAIL_MAX_SECONDS = None
+    test_settings.PROCESS_EMAIL_MIN_WAIT_SECONDS = 1
+    msg = fake_sqs_message(json.dumps(TEST_SNS_MESSAGE))
+    queue = fake_queue([msg], [], KeyboardInterrupt())
+    queue.attributes["ApproximateNumberOfMessages"] = 100
+    mock_sqs_client.return_value = queue
+    call_command(COMMAND_NAME)
+
+    second_poll = queue.receive_messages.call_args_list[1]
+    assert second_poll.kwargs["MaxNumberOfMessages"] == 10
+    assert second_poll.kwargs["WaitTimeSeconds"] == 1
+    assert cycle_logs(caplog)[0]["poll_wait_s"] == 1
+
+
+@pytest.fixture
+def mock_db_connection_all_threads(mock_django_db_connection: Mock) -> Iterator[Mock]:
+    """Mock django.db.connection for all threads, as used by --async."""
+    mock_cursor = Mock()
+    mock_cursor.__enter__ = Mock(return_value=mock_cursor)
+    mock_cursor.__exit__ = Mock(return_value=False)
+    mock_cursor.db = mock_django_db_connection
+
+    with patch(f"{MOCK_BASE}.connection", spec_set=["cursor", "close"]) as mock_conn:
+        mock_conn.cursor.return_value = mock_cursor
+        yield mock_conn
+
+
+def test_async_messages(
+    test_settings: SettingsWrapper,
+    mock_sqs_client: Mock,
+    mock_sns_inbound_logic: Mock,
+    mock_db_connection_all_threads: Mock,
+    caplog: LogCaptureFixture,
+) -> None:
+    """With --async, messages are processed in threads, polling for free threads."""
+    test_settings.PROCESS_EMAIL_MAX_SECONDS = None
+    test_settings.PROCESS_EMAIL_MAX_SECONDS_PER_MESSAGE = 60
+    test_settings.PROCESS_EMAIL_CONCURRENCY = 2
+    msgs = [fake_sqs_message(json.dumps(TEST_SNS_MESSAGE)) for _ in range(3)]
+    queue = fake_queue(msgs[:2], msgs[2:], [], KeyboardInterrupt())
+    mock_sqs_client.return_value = queue
+    call_command(COMMAND_NAME, "--async")
+
+    summary = summary_from_exit_log(caplog)
+    assert summary["exit_on"] == "interrupt"
+    assert summary["total_messages"] == 3
+    assert "failed_messages" not in summary
+    assert mock_sns_inbound_logic.call_count == 3
+    assert sorted(deleted_handles(queue)) == sorted(msg.receipt_handle for msg in msgs)
+    first_poll = queue.receive_messages.call_args_list[0]
+    assert first_poll.kwargs["MaxNumberOfMessages"] == 2
+    msg_logs = [
+        log_extra(rec)
+        for rec in omit_markus_logs(caplog)
+        if rec.msg == "Message processed"
+    ]
+    assert len(msg_logs) == 3
+    assert all(msg_log["success"] for msg_log in msg_logs)
+
+
+def test_async_failed_messages(
+    test_settings: SettingsWrapper,
+    mock_sqs_client: Mock,
+    mock_sns_inbound_logic: Mock,
+    mock_db_connection_all_threads: Mock,
+    caplog: LogCaptureFixture,
+) -> None:
+    """With --async, invalid and failed messages are retried after a backoff."""
+    test_settings.PROCESS_EMAIL_MAX_SECONDS = None
+    test_settings.PROCESS_EMAIL_MAX_SECONDS_PER_MESSAGE = 60
+    mock_sns_inbound_logic.side_effect = make_client_error(code="InternalError")
+    bad_msg = fake_sqs_message("I am not JSON")
+    failed_msg = fake_sqs_message(json.dumps(TEST_SNS_MESSAGE))
+    queue = fake_queue([bad_msg, failed_msg], [], KeyboardInterrupt())
+    mock_sqs_client.return_value = queue
+    call_command(COMMAND_NAME, "--async")
+
+    summary = summary_from_exit_log(caplog)
+    assert summary["total_messages"] == 2
+    assert summary["failed_messages"] == 2
+    assert deleted_handles(queue) == []
+    assert visibility_changes(queue) == {
+        bad_msg.receipt_handle: 15,
+        failed_msg.receipt_handle: 15,
+    }
+
+
+def test_async_message_timeout(
+    test_settings: SettingsWrapper,
+    mock_sqs_client: Mock,
+    mock_sns_inbound_logic: Mock,
+    mock_db_connection_all_threads: Mock,
+    caplog: LogCaptureFixture,
+) -> None:
+    """
+    With --async, a slow message is reported as timed out, but is kept reserved
+    until it finishes, and then deleted rather than retried.
+    """
+    test_settings.PROCESS_EMAIL_MAX_SECONDS = None
+    test_settings.PROCESS_EMAIL_MAX_SECONDS_PER_MESSAGE = 2
+    test_settings.PROCESS_EMAIL_VISIBILITY_SECONDS = 4
+    finished = threading.Event()
+    mock_sns_inbound_logic.side_effect = lambda *args: finished.wait(1)
+    msg = fake_sqs_message(json.dumps(TEST_SNS_MESSAGE))
+    queue = fake_queue([msg], KeyboardInterrupt())
+    mock_sqs_client.return_value = queue
+    call_command(COMMAND_NAME, "--async")
+
+    summary = summary_from_exit_log(caplog)
+    assert summary["total_messages"] == 1
+    assert "failed_messages" not in summary
+    records = omit_markus_logs(caplog)
+    assert any(rec.msg == "Message timed out" for rec in records)
+    msg_log = next(log_extra(rec) for rec in records if rec.msg == "Message processed")
+    assert msg_log["success"] is True
+    assert msg_log["timed_out"] is True
+    assert deleted_handles(queue) == [msg.receipt_handle]
+    # The visibility was extended while it ran, not reset for a retry
+    assert visibility_changes(queue) == {msg.receipt_handle: 4}
+
+
+def test_async_healthcheck_written_while_messages_run(
+    test_settings: SettingsWrapper,
+    mock_sqs_client: Mock,
+    mock_sns_inbound_logic: Mock,
+    mock_db_connection_all_threads: Mock,
+) -> None:
+    """With --async, the healthcheck is written while waiting for a free thread."""
+    test_settings.PROCESS_EMAIL_MAX_SECONDS = None
+    finished = threading.Event()
+    mock_sns_inbound_logic.side_effect = lambda *args: finished.wait(1)
+    msg = fake_sqs_message(json.dumps(TEST_SNS_MESSAGE))
+    mock_sqs_client.return_value = fake_queue([msg], KeyboardInterrupt())
+    with patch.object(
+        Command, "write_healthcheck", autospec=True
+    ) as mock_write_healthcheck:
+        call_command(COMMAND_NAME, "--async")
+
+    # Once per cycle for two cycles, and more while the message runs
+    assert mock_write_healthcheck.call_count > 2
+
+
+def test_memory_counter_buffer_flushed_with_async(
+    test_settings: SettingsWrapper,
+    mock_sqs_client: Mock,
+    mock_db_connection_all_threads: Mock,
+) -> None:
+    """With --async, counters buffered in memory are flushed on exit."""
+    test_settings.COUNTER_BUFFER = "memory"
+    test_settings.PROCESS_EMAIL_MAX_SECONDS = None
+    mock_sqs_client.return_value = fake_queue([], KeyboardInterrupt())
+    with patch(f"{MOCK_BASE}.flush_counter_buffer", return_value=0) as mock_flush:
+        call_command(COMMAND_NAME, "--async")
+
+    mock_flush.assert_called_once_with()
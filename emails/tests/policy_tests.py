@@ -1,5 +1,6 @@
 """Tests for emails.policy"""
 
+from copy import deepcopy
 from email import errors, message_from_string
 
 import pytest
@@ -102,3 +103,25 @@ def test_compliant_header_parsing(email_id: str) -> None:
     email = message_from_string(email_in_text, policy=relay_policy)
     for header_name, value in email.items():
         assert len(getattr(value, "defects")) == 0
+
+
+def test_header_classes_are_reused() -> None:
+    email = message_from_string(EMAIL_INCOMING["plain_text"], policy=relay_policy)
+    assert type(email["From"]) is type(email["To"])
+    assert type(email["Subject"]) is type(email["Subject"])
+
+
+def test_unstructured_header_created_when_used() -> None:
+    email = message_from_string(EMAIL_INCOMING["emperor_norton"], policy=relay_policy)
+    header = email["From"]
+    assert "as_unstructured" not in vars(header)
+    unstructured = getattr(header, "as_unstructured")
+    assert str(unstructured) == (
+        "Norton I., Emperor of the United States <norton@sf.us.example.com>"
+    )
+    assert getattr(header, "as_unstructured") is unstructured
+
+
+def test_parsed_email_can_be_copied() -> None:
+    email = message_from_string(EMAIL_INCOMING["inline_image"], policy=relay_policy)
+    assert deepcopy(email).as_string() == email.as_string()
@@ -1,27 +1,47 @@
 import base64
 import json
 import random
+import re
 import signal
 import zlib
 from base64 import b64encode
+from email import message_from_bytes
+from io import BytesIO
+from mmap import mmap
+from pathlib import Path
 from types import FrameType
 from typing import Literal, TypedDict
 from unittest.mock import patch
 from urllib.parse import quote_plus
 
+from django.http import HttpResponse
 from django.test import TestCase, override_settings
 
 import pytest
+from markus.testing import MetricsMock
+from pytest_django.fixtures import SettingsWrapper
 
+from emails.apps import TrackerLists, emails_config
+from emails.policy import relay_policy
 from emails.utils import (
     InvalidFromHeader,
+    TrackerIndex,
+    convert_domains_to_regex_patterns,
     decode_dict_gza85,
     encode_dict_gza85,
     generate_from_header,
     get_domains_from_settings,
     get_email_domain_from_settings,
+    get_tracker_index,
+    parse_email_bytes,
     parse_email_header,
     remove_trackers,
+    replace_trackers,
+    scan_trackers,
+    spool_email_content,
+    store_tracker_index,
+    time_stage,
+    time_stages,
 )
 
 
@@ -394,6 +414,35 @@ class RemoveTrackers(TestCase):
         assert general_removed == 0
         assert general_count == 0
 
+    def test_scan_trackers_counts_both_levels(self):
+        content = (
+            '<a href="https://open.tracker.com/foo/bar.html">A link</a>\n'
+            + '<img src="https://strict.tracker.com/foo/bar.jpg">An image</img>'
+        )
+        scan = scan_trackers(content)
+        assert scan.level_one == {"count": 1, "trackers": {"open.tracker.com": 1}}
+        assert scan.level_two == {"count": 1, "trackers": {"strict.tracker.com": 1}}
+
+        with patch("emails.utils.scan_trackers") as mock_scan:
+            changed_content, tracker_details = remove_trackers(
+                content, self.from_address, self.datetime_now, scan=scan
+            )
+        mock_scan.assert_not_called()
+        assert tracker_details == {"tracker_removed": 1, "level_one": scan.level_one}
+        assert (
+            changed_content
+            == remove_trackers(content, self.from_address, self.datetime_now)[0]
+        )
+
+    def test_scan_trackers_without_links_skips_index(self):
+        content = "Visit open.tracker.com or strict.tracker.com<br>Thanks!"
+        with patch("emails.utils.get_tracker_index") as mock_index:
+            scan = scan_trackers(content)
+        mock_index.assert_not_called()
+        assert scan.found == set()
+        assert scan.level_one == {"count": 0, "trackers": {}}
+        assert scan.level_two == {"count": 0, "trackers": {}}
+
 
 @override_settings(SITE_ORIGIN="https://test.com")
 def test_remove_trackers_does_not_backtrack_on_dotted_url() -> None:
@@ -425,6 +474,188 @@ def test_remove_trackers_does_not_backtrack_on_dotted_url() -> None:
     assert tracker_details["tracker_removed"] == 0
 
 
+def test_tracker_index_finds_domains_after_slash_or_dot() -> None:
+    index = TrackerIndex(["trckr.com", "open.tracker.com", "tracker.com"])
+    content = (
+        '<a href="https://foo.open.tracker.com/x">fooopen.tracker.com</a>'
+        "<img src='https://trckr.community/'> trckr.com"
+    )
+    assert index.find(content) == {"open.tracker.com", "tracker.com", "trckr.com"}
+    assert index.find("trckr.com xtracker.com") == set()
+
+
+def sequential_subn(
+    content: str, trackers: list[str], repl: str
+) -> tuple[str, int, dict[str, int]]:
+    """Replace trackers with a regex pass per tracker, the original algorithm."""
+    total = 0
+    details = {}
+    for tracker in trackers:
+        pattern = convert_domains_to_regex_patterns(tracker)
+        content, count = re.subn(pattern, repl, content)
+        if count:
+            total += count
+            details[tracker] = count
+    return content, total, details
+
+
+@pytest.mark.parametrize(
+    "content",
+    (
+        '<a href="https://open.tracker.com/a">A</a> <img src="https://trckr.com/b">',
+        "<a href='https://example.com/?u=https://x.tracker.com/'>A</a>",
+        "<a href='https://x.trckr.com.example.com/'>A</a>",
+        """<a href="https://open.tracker.com/'https://trckr.com/'">A</a>""",
+        "<a href='https://example.com/a.tracker.com'>A</a>",
+        "<a href='https://fooopen.tracker.com/'>A</a>",
+    ),
+)
+@pytest.mark.parametrize("repl", ("", "'https://example.com/?to=b.trckr.com'"))
+def test_replace_trackers_matches_sequential_subn(content: str, repl: str) -> None:
+    trackers = ["open.tracker.com", "trckr.com", "tracker.com", "com"]
+    expected = sequential_subn(content, trackers, repl)
+    assert replace_trackers(content, trackers, repl) == expected
+
+
+def test_get_tracker_index_cached_by_name() -> None:
+    general = ("open.tracker.com",)
+    strict = ("strict.tracker.com",)
+    index = get_tracker_index("test_all", general, strict)
+    assert index.trackers == general + strict
+    assert get_tracker_index("test_all", general, strict) is index
+
+    # Reloaded lists get a new index
+    reloaded = ("new.tracker.com",)
+    new_index = get_tracker_index("test_all", reloaded, strict)
+    assert new_index is not index
+    assert new_index.trackers == reloaded + strict
+
+
+def test_store_tracker_index(tmp_path: Path) -> None:
+    (tmp_path / "level-one-trackers.json").write_text('["b.com", "a.com"]')
+    index = store_tracker_index(tmp_path)
+    assert index["level_one"] == ["b.com", "a.com"]
+    assert index["level_two"] == []
+    assert len(index["version"]) == 16
+    stored = (tmp_path / "tracker-index.json").read_text()
+    assert json.loads(stored) == index
+    assert "\n" not in stored
+
+    (tmp_path / "level-two-trackers.json").write_text('["c.com"]')
+    new_index = store_tracker_index(tmp_path)
+    assert new_index["level_two"] == ["c.com"]
+    assert new_index["version"] != index["version"]
+
+
+def test_load_tracker_lists_from_index(
+    tmp_path: Path, settings: SettingsWrapper
+) -> None:
+    folder = tmp_path / "emails" / "tracker_lists"
+    folder.mkdir(parents=True)
+    (folder / "level-one-trackers.json").write_text('["b.com", "a.com"]')
+    (folder / "level-two-trackers.json").write_text('["c.com"]')
+    settings.BASE_DIR = str(tmp_path)
+    config = emails_config()
+
+    assert config._load_tracker_lists() == TrackerLists(
+        "", ("b.com", "a.com"), ("c.com",)
+    )
+    index = store_tracker_index(folder)
+    (folder / "level-one-trackers.json").unlink()
+    assert config._load_tracker_lists() == TrackerLists(
+        index["version"], ("b.com", "a.com"), ("c.com",)
+    )
+
+
+def test_load_tracker_lists_missing(
+    tmp_path: Path, settings: SettingsWrapper, caplog: pytest.LogCaptureFixture
+) -> None:
+    settings.BASE_DIR = str(tmp_path)
+    with patch("emails.utils.download_trackers") as mock_download:
+        tracker_lists = emails_config()._load_tracker_lists()
+    assert tracker_lists == TrackerLists("", (), ())
+    mock_download.assert_not_called()
+    assert [record.msg for record in caplog.records] == [
+        "tracker_list_missing",
+        "tracker_list_missing",
+    ]
+
+
+INCOMING_EMAIL_PATHS = sorted(
+    (Path(__file__).parent / "fixtures").glob("*_incoming.email")
+)
+
+
+@pytest.mark.parametrize("path", INCOMING_EMAIL_PATHS, ids=lambda path: path.stem)
+@pytest.mark.parametrize("newline", (b"\n", b"\r\n"))
+def test_parse_email_bytes_matches_message_from_bytes(
+    path: Path, newline: bytes
+) -> None:
+    email_bytes = path.read_bytes().replace(b"\n", newline)
+    expected = message_from_bytes(email_bytes, policy=relay_policy)
+    # A small chunk size splits lines, including CR LF pairs
+    with patch("emails.utils.EMAIL_PARSE_CHUNK_SIZE", 7):
+        email = parse_email_bytes(email_bytes)
+    assert email.as_string() == expected.as_string()
+    assert email.defects == expected.defects
+
+
+def test_spool_email_content_small_email_is_bytes() -> None:
+    email_bytes = INCOMING_EMAIL_PATHS[0].read_bytes()
+    content = spool_email_content(BytesIO(email_bytes))
+    assert isinstance(content, bytes)
+    assert content == email_bytes
+
+
+def test_spool_email_content_large_email_is_mapped() -> None:
+    email_bytes = INCOMING_EMAIL_PATHS[0].read_bytes()
+    with (
+        patch("emails.utils.EMAIL_SPOOL_MAX_SIZE", 100),
+        patch("emails.utils.EMAIL_PARSE_CHUNK_SIZE", 64),
+    ):
+        content = spool_email_content(BytesIO(email_bytes))
+    assert isinstance(content, mmap)
+    assert content[:] == email_bytes
+    email = parse_email_bytes(content)
+    expected = message_from_bytes(email_bytes, policy=relay_policy)
+    assert email.as_string() == expected.as_string()
+    content.close()
+
+
+def test_time_stages_excludes_nested_stages() -> None:
+    @time_stages("test.stage_ms")
+    def handle() -> HttpResponse:
+        with patch("emails.utils.time.perf_counter", side_effect=[0.0, 1.0, 1.5, 4.0]):
+            with time_stage("outer"):
+                with time_stage("inner"):
+                    pass
+        return HttpResponse("OK")
+
+    response = handle()
+    assert getattr(response, "stage_times_s") == {"inner": 0.5, "outer": 3.5}
+
+
+@override_settings(STATSD_ENABLED=True)
+def test_time_stages_emits_histograms() -> None:
+    @time_stages("test.stage_ms")
+    def handle() -> HttpResponse:
+        with patch("emails.utils.time.perf_counter", side_effect=[0.0, 0.25, 1.0, 1.5]):
+            for _ in range(2):
+                with time_stage("repeated"):
+                    pass
+        return HttpResponse("OK")
+
+    with MetricsMock() as mm:
+        response = handle()
+    assert getattr(response, "stage_times_s") == {"repeated": 0.75}
+    mm.assert_histogram_once("test.stage_ms", value=750.0, tags=["stage:repeated"])
+
+
+def test_time_stage_without_time_stages() -> None:
+    with time_stage("unused"):
+        pass
+
+
 def test_encode_dict_gza85() -> None:
     data = {"key": "value"}
     encoded = encode_dict_gza85(data)
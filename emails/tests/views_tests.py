@@ -5,7 +5,7 @@ import os
 import re
 from copy import deepcopy
 from datetime import UTC, datetime, timedelta
-from email import message_from_string
+from email import message_from_bytes, message_from_string
 from email.message import EmailMessage
 from typing import Any, cast
 from unittest._log import _LoggingWatcher
@@ -14,7 +14,10 @@ from uuid import uuid4
 
 from django.conf import settings
 from django.contrib.auth.models import User
+from django.core.cache import caches
 from django.core.exceptions import ObjectDoesNotExist
+from django.db import IntegrityError
+from django.db.models import QuerySet
 from django.http import HttpResponse
 from django.test import Client, SimpleTestCase, TestCase, override_settings
 
@@ -26,6 +29,8 @@ from markus.testing import MetricsMock
 from model_bakery import baker
 from waffle.testutils import override_flag
 
+from emails.counter_buffer import flush_counter_buffer
+from emails.exceptions import DomainAddrDuplicateException
 from emails.models import (
     DeletedAddress,
     DomainAddress,
@@ -36,14 +41,17 @@ from emails.models import (
 from emails.policy import relay_policy
 from emails.types import AWS_SNSMessageJSON, OutgoingHeaders
 from emails.utils import (
+    CachedMask,
     InvalidFromHeader,
     b64_lookup_key,
     decode_dict_gza85,
     decrypt_reply_metadata,
     derive_reply_keys,
     encrypt_reply_metadata,
+    get_cached_mask,
     get_domains_from_settings,
     get_message_id_bytes,
+    urlize_and_linebreaks,
 )
 from emails.views import (
     EmailDroppedReason,
@@ -52,20 +60,27 @@ from emails.views import (
     _build_disabled_mask_for_spam_email,
     _build_reply_requires_premium_email,
     _check_email_from_list,
+    _convert_html_content,
+    _convert_text_to_html_content,
+    _create_domain_address,
     _gather_complainers,
     _get_address,
     _get_address_if_exists,
     _get_complaint_data,
     _get_keys_from_headers,
     _get_mask_by_metrics_id,
+    _parse_email_with_headers,
     _record_receipt_verdicts,
     _replace_headers,
+    _replace_headers_in_bytes,
     _set_forwarded_first_reply,
     _sns_message,
     _sns_notification,
+    _wrapped_email_frame,
     log_email_dropped,
     reply_requires_premium_test,
     validate_sns_arn_and_type,
+    wrap_html_email,
     wrapped_email_test,
 )
 from privaterelay.ftl_bundles import main
@@ -136,6 +151,12 @@ SEND_RAW_EMAIL_FAILED = ClientError(
 )
 
 
+@pytest.fixture(autouse=True)
+def clear_sns_dedupe_cache() -> None:
+    """Forget processed notifications, so tests can reuse the SNS fixtures."""
+    caches[settings.AWS_SNS_DEDUPE_CACHE].clear()
+
+
 def create_email_from_notification(
     notification: AWS_SNSMessageJSON, text: str, html: str | None = None
 ) -> bytes:
@@ -2166,6 +2187,83 @@ class SNSNotificationRemoveEmailsInS3Test(TestCase):
         assert response.status_code == 404
 
 
+class SNSNotificationDedupeTest(TestCase):
+    def setUp(self) -> None:
+        sns_message_patcher = patch(
+            "emails.views._sns_message",
+            return_value=HttpResponse("Email Relayed", status=200),
+        )
+        self.mock_sns_message = sns_message_patcher.start()
+        self.addCleanup(sns_message_patcher.stop)
+
+        remove_s3_patcher = patch("emails.views.remove_message_from_s3")
+        self.mock_remove_message_from_s3 = remove_s3_patcher.start()
+        self.addCleanup(remove_s3_patcher.stop)
+
+    @override_settings(STATSD_ENABLED=True)
+    def test_redelivered_notification_suppressed(self) -> None:
+        notification = EMAIL_SNS_BODIES["s3_stored"]
+        assert _sns_notification(notification).status_code == 200
+        with self.assertLogs(INFO_LOG) as logs, MetricsMock() as mm:
+            response = _sns_notification(notification)
+        assert response.status_code == 200
+        assert response.content == b"Duplicate SNS notification suppressed"
+        self.mock_sns_message.assert_called_once()
+        self.mock_remove_message_from_s3.assert_called_once()
+        mm.assert_incr_once("duplicate_suppressed")
+        assert logs.records[0].msg == "Duplicate SNS notification suppressed"
+
+    def test_republished_email_suppressed(self) -> None:
+        """A new SNS MessageId with the same SES mail.messageId is a duplicate."""
+        notification = EMAIL_SNS_BODIES["s3_stored"]
+        _sns_notification(notification)
+        _sns_notification({**notification, "MessageId": str(uuid4())})
+        self.mock_sns_message.assert_called_once()
+
+    def test_failed_notification_not_marked(self) -> None:
+        self.mock_sns_message.return_value = HttpResponse("SES error", status=503)
+        notification = EMAIL_SNS_BODIES["s3_stored"]
+        _sns_notification(notification)
+        _sns_notification(notification)
+        assert self.mock_sns_message.call_count == 2
+
+    def test_bounce_for_same_mail_not_suppressed(self) -> None:
+        """A bounce of a sent email is not a duplicate of the received email."""
+        received = EMAIL_SNS_BODIES["s3_stored"]
+        bounce = deepcopy(BOUNCE_SNS_BODIES["soft"])
+        bounce_message = json.loads(bounce["Message"])
+        received_message = json.loads(received["Message"])
+        bounce_message["mail"]["messageId"] = received_message["mail"]["messageId"]
+        bounce["Message"] = json.dumps(bounce_message)
+        _sns_notification(received)
+        _sns_notification(bounce)
+        assert self.mock_sns_message.call_count == 2
+
+    def test_bounces_for_same_mail_not_suppressed(self) -> None:
+        """Each bounce of a sent email is processed, but not a redelivered one."""
+        mail_message_id = str(uuid4())
+        bounces = []
+        for bounce_type in ("soft", "hard"):
+            bounce = deepcopy(BOUNCE_SNS_BODIES[bounce_type])
+            bounce_message = json.loads(bounce["Message"])
+            bounce_message["mail"]["messageId"] = mail_message_id
+            bounce["Message"] = json.dumps(bounce_message)
+            bounce["MessageId"] = str(uuid4())
+            bounces.append(bounce)
+        soft_bounce, hard_bounce = bounces
+        _sns_notification(soft_bounce)
+        _sns_notification(hard_bounce)
+        _sns_notification(hard_bounce)
+        assert self.mock_sns_message.call_count == 2
+
+    @override_settings(AWS_SNS_DEDUPE_SECONDS=0)
+    def test_dedupe_disabled(self) -> None:
+        notification = EMAIL_SNS_BODIES["s3_stored"]
+        _sns_notification(notification)
+        _sns_notification(notification)
+        assert self.mock_sns_message.call_count == 2
+
+
 class SNSNotificationInvalidMessageTest(TestCase):
     def test_no_message(self):
         """An empty message returns a 400 error"""
@@ -2358,6 +2456,39 @@ class SNSNotificationValidUserEmailsInS3Test(TestCase):
         assert event == expected
         mm.assert_incr_once("email_for_disabled_address")
 
+    @override_settings(COUNTER_BUFFER="memory", COUNTER_BUFFER_FLUSH_SECONDS=60)
+    def test_relay_address_disabled_buffered_counters(self) -> None:
+        self.address.enabled = False
+        self.address.save()
+
+        with (
+            patch("emails.counter_buffer._memory_changes", {}),
+            patch("emails.counter_buffer._next_flush_check", float("inf")),
+        ):
+            response = _sns_notification(EMAIL_SNS_BODIES["s3_stored"])
+            assert response.content == b"Address is temporarily disabled."
+            self.address.refresh_from_db()
+            assert self.address.num_blocked == 0
+
+            assert flush_counter_buffer() == 2
+        self.address.refresh_from_db()
+        assert self.address.num_blocked == 1
+
+    @override_settings(STATSD_ENABLED=True)
+    def test_relay_address_disabled_stage_times(self) -> None:
+        self.address.enabled = False
+        self.address.save()
+
+        with MetricsMock() as mm:
+            response = _sns_notification(EMAIL_SNS_BODIES["s3_stored"])
+        assert response.status_code == 200
+        stages = {"address_lookup", "bounce_check", "reply_detection"}
+        assert set(getattr(response, "stage_times_s")) == stages
+        records = mm.filter_records("histogram", stat="relayed_email.stage_ms")
+        assert {record.tags[0] for record in records} == {
+            f"stage:{stage}" for stage in stages
+        }
+
     @patch("emails.views._check_email_from_list")
     def test_blocked_list_email_in_s3_deleted(
         self, mocked_email_is_from_list: Mock
@@ -2755,6 +2886,112 @@ class GetAddressTest(TestCase):
             _get_address("Unknown@subdomain.test.com", create=False)
         assert DomainAddress.objects.filter(user=self.user).count() == 1
 
+    def test_existing_domain_address_does_not_lock_profile(self) -> None:
+        with patch.object(QuerySet, "select_for_update") as mock_select_for_update:
+            assert _get_address("domain@subdomain.test.com") == self.domain_address
+        mock_select_for_update.assert_not_called()
+
+    def test_create_domain_address_made_by_other_email(self) -> None:
+        """If another email created the DomainAddress first, it is returned."""
+        other_address = baker.make(DomainAddress, user=self.user, address="racer")
+        with MetricsMock() as mm, self.assertNoLogs(GLEAN_LOG, "INFO"):
+            address = _create_domain_address(
+                self.user.profile, "racer", other_address.domain
+            )
+        assert address == other_address
+        mm.assert_incr_once("domainaddress.create_via_email_race")
+
+    def test_create_domain_address_unique_constraint_failed(self) -> None:
+        """If the unique constraint rejects the new DomainAddress, the other is used."""
+        other_address = baker.make(DomainAddress, user=self.user, address="racer")
+        with (
+            patch.object(
+                DomainAddress, "make_domain_address", side_effect=IntegrityError
+            ),
+            MetricsMock() as mm,
+            self.assertNoLogs(GLEAN_LOG, "INFO"),
+        ):
+            address = _create_domain_address(
+                self.user.profile, "racer", other_address.domain
+            )
+        assert address == other_address
+        mm.assert_incr_once("domainaddress.create_via_email_race")
+
+    def test_create_domain_address_duplicate_on_other_domain(self) -> None:
+        """If the other DomainAddress is on a different domain, the error is raised."""
+        other_address = baker.make(DomainAddress, user=self.user, address="racer")
+        with (
+            MetricsMock() as mm,
+            self.assertNoLogs(GLEAN_LOG, "INFO"),
+            pytest.raises(DomainAddrDuplicateException),
+        ):
+            _create_domain_address(self.user.profile, "racer", other_address.domain + 1)
+        mm.assert_not_incr("domainaddress.create_via_email_race")
+
+    def test_create_domain_address_integrity_error_without_other(self) -> None:
+        """If the create failed, but there is no other DomainAddress, it is raised."""
+        with (
+            patch.object(
+                DomainAddress, "make_domain_address", side_effect=IntegrityError
+            ),
+            MetricsMock() as mm,
+            pytest.raises(IntegrityError),
+        ):
+            _create_domain_address(self.user.profile, "racer", 2)
+        mm.assert_not_incr("domainaddress.create_via_email_race")
+
+    def test_existing_relay_address_from_cache(self) -> None:
+        assert get_cached_mask("relay123@test.com") is None
+        assert _get_address("relay123@test.com") == self.relay_address
+        assert get_cached_mask("relay123@test.com") == CachedMask(
+            "R", self.relay_address.id, self.user.id
+        )
+        with self.assertNumQueries(1):
+            address = _get_address("Relay123@test.com")
+            assert address.user.profile == self.user.profile
+        assert address == self.relay_address
+
+    def test_existing_domain_address_from_cache(self) -> None:
+        assert _get_address("domain@subdomain.test.com") == self.domain_address
+        DomainAddress.objects.filter(id=self.domain_address.id).update(
+            last_used_at=None
+        )
+        with self.assertNumQueries(2), self.assertNoLogs(GLEAN_LOG, "INFO"):
+            address = _get_address("domain@subdomain.test.com")
+            assert address.user.profile == self.user.profile
+        assert address == self.domain_address
+        self.domain_address.refresh_from_db()
+        assert self.domain_address.last_used_at == address.last_used_at
+        assert address.last_used_at is not None
+
+    @override_settings(MASK_CACHE_SECONDS=0)
+    def test_mask_cache_disabled(self) -> None:
+        assert _get_address("relay123@test.com") == self.relay_address
+        assert get_cached_mask("relay123@test.com") is None
+
+    def test_deleted_relay_address_is_removed_from_cache(self) -> None:
+        assert _get_address("relay123@test.com") == self.relay_address
+        self.relay_address.delete()
+        assert get_cached_mask("relay123@test.com") is None
+        with pytest.raises(RelayAddress.DoesNotExist):
+            _get_address("relay123@test.com")
+
+    def test_deleted_domain_address_is_removed_from_cache(self) -> None:
+        assert _get_address("domain@subdomain.test.com") == self.domain_address
+        self.domain_address.delete()
+        assert get_cached_mask("domain@subdomain.test.com") is None
+        with pytest.raises(DomainAddress.DoesNotExist):
+            _get_address("domain@subdomain.test.com", create=False)
+
+    def test_cached_domain_address_with_changed_subdomain(self) -> None:
+        """A cached mask that no longer has the address is not used."""
+        assert _get_address("domain@subdomain.test.com") == self.domain_address
+        Profile.objects.filter(user=self.user).update(subdomain="newsubdomain")
+        with pytest.raises(Profile.DoesNotExist):
+            _get_address("domain@subdomain.test.com")
+        assert get_cached_mask("domain@subdomain.test.com") is None
+        assert _get_address("domain@newsubdomain.test.com") == self.domain_address
+
 
 @override_settings(SITE_ORIGIN="https://test.com", STATSD_ENABLED=True)
 class GetAddressIfExistsTest(TestCase):
@@ -3040,6 +3277,7 @@ def test_wrapped_email_test(
     # Reload Fluent files to regenerate errors
     if language == "en":
         main.reload()
+        _wrapped_email_frame.cache_clear()
 
     data = {
         "language": language,
@@ -3073,6 +3311,61 @@ def test_wrapped_email_test(
         assert "/tracker-report/#" not in no_space_html
 
 
+@pytest.mark.parametrize(
+    "original_html,expected_html",
+    (
+        ("<p>Hello</p>", "          <p>Hello</p>\n"),
+        ("<p>Hello</p>\n", "          <p>Hello</p>\n"),
+        ("<p>One</p>\n\n \n<p>Two</p>\r\n", "          <p>One</p>\n<p>Two</p>\n"),
+        ("\n<p>Hello</p>", "<p>Hello</p>\n"),
+        (" \n", ""),
+    ),
+)
+@pytest.mark.django_db
+def test_wrap_html_email_removes_empty_lines(
+    original_html: str, expected_html: str
+) -> None:
+    wrapped = wrap_html_email(original_html, "en", False, "ebsbdsan7@test.com")
+    body_start = '<td width="100%" style="padding-left: 15px; padding-right: 15px;">\n'
+    assert body_start + expected_html + "        </td>\n" in wrapped
+    assert all(line.strip() for line in wrapped.splitlines())
+
+
+@pytest.mark.django_db
+def test_wrap_html_email_reuses_frame() -> None:
+    _wrapped_email_frame.cache_clear()
+    for has_premium in (False, True):
+        wrap_html_email("<p>Hello</p>", "en", has_premium, "ebsbdsan7@test.com")
+    wrap_html_email("<p>Bonjour</p>", "fr", False, "ebsbdsan7@test.com")
+    cache_info = _wrapped_email_frame.cache_info()
+    assert cache_info.hits == 1
+    assert cache_info.misses == 2
+
+
+@pytest.mark.parametrize(
+    "text_content,removed",
+    (
+        ("Hi,\nSee https://open.tracker.com/foo or www.open.tracker.com.", 2),
+        ("Hi,\nSee <https://strict.tracker.com/foo> and https://example.com/", 0),
+        ("Hi,\nSee open.tracker.com/foo", 1),
+        ("Hi,\nWrite to me@open.tracker.com", 0),
+    ),
+)
+@pytest.mark.django_db
+def test_convert_text_to_html_content(text_content: str, removed: int) -> None:
+    """The HTML from a text email has the same trackers removed as other HTML."""
+    now = datetime(2024, 6, 1, tzinfo=UTC)
+    args = ("alias@test.com", "sender@example.com", "en", False, True, True, now)
+    with (
+        patch("emails.utils.general_trackers", return_value=["open.tracker.com"]),
+        patch("emails.utils.strict_trackers", return_value=["strict.tracker.com"]),
+    ):
+        html_content = urlize_and_linebreaks(text_content)
+        expected = _convert_html_content(html_content, *args)
+        assert _convert_text_to_html_content(text_content, *args) == expected
+    assert expected[1] == removed
+
+
 @pytest.mark.parametrize("forwarded", ("False", "True"))
 @pytest.mark.parametrize("content_type", ("text/plain", "text/html"))
 @pytest.mark.django_db
@@ -3420,6 +3713,69 @@ def test_replace_headers_drops_duplicate_mime_version() -> None:
     ]
 
 
+@pytest.mark.parametrize(
+    "fixture_name", ["plain_text", "inline_image", "duplicate_mime_version"]
+)
+@pytest.mark.parametrize("linesep", ["\n", "\r\n"])
+def test_parse_email_with_headers_matches_replace_headers(
+    fixture_name: str, linesep: str
+) -> None:
+    """Replacing headers in the header block creates the same email."""
+    email_bytes = EMAIL_INCOMING[fixture_name].replace("\n", linesep).encode()
+    new_headers: OutgoingHeaders = {
+        "Subject": "Ça va? " * 12,
+        "From": '"friend@mail.example.com [via Relay]" <ebsbdsan7@test.com>',
+        "To": "user@example.com",
+        "Reply-To": "replies@default.com",
+        "Resent-From": "friend@mail.example.com",
+    }
+    assert _replace_headers_in_bytes(email_bytes, new_headers) is not None
+
+    email, issues = _parse_email_with_headers(email_bytes, new_headers)
+
+    expected_email = message_from_bytes(email_bytes, policy=relay_policy)
+    assert isinstance(expected_email, EmailMessage)
+    expected_issues = _replace_headers(expected_email, new_headers)
+    assert email.as_string() == expected_email.as_string()
+    assert issues == expected_issues
+
+
+def test_parse_email_with_headers_reports_header_defects() -> None:
+    """An email with a header defect is parsed before replacing headers."""
+    email_bytes = EMAIL_INCOMING["message_id_in_brackets"].encode()
+    new_headers: OutgoingHeaders = {"Subject": "Defect Test", "To": "to@example.com"}
+    assert _replace_headers_in_bytes(email_bytes, new_headers) is None
+
+    email, issues = _parse_email_with_headers(email_bytes, new_headers)
+
+    assert email["Subject"] == "Defect Test"
+    assert issues == [
+        {
+            "header": "Message-ID",
+            "direction": "in",
+            "defect_count": 1,
+            "parsed_value": "<[d7c5838b5ab944f89e3f0c1b85674aef====@example.com]>",
+            "raw_value": "<[d7c5838b5ab944f89e3f0c1b85674aef====@example.com]>",
+        }
+    ]
+
+
+@pytest.mark.parametrize(
+    "header_line",
+    [
+        "From sender@example.com Tue Sep  5 14:42:46 2023",
+        " continued",
+        "Not a header",
+        "X-Non-ASCII: Ça va?",
+    ],
+)
+def test_replace_headers_in_bytes_unusual_header_block(header_line: str) -> None:
+    """A header block with lines that are not header fields is not replaced."""
+    email_bytes = (header_line + "\n" + EMAIL_INCOMING["plain_text"]).encode()
+    new_headers: OutgoingHeaders = {"Subject": "Header Block Test"}
+    assert _replace_headers_in_bytes(email_bytes, new_headers) is None
+
+
 @pytest.mark.django_db
 def test_opt_out_user_has_minimal_email_dropped_log(caplog):
     user = baker.make(User, email="opt-out@example.com")
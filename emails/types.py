@@ -1,5 +1,6 @@
 """Types for email functions"""
 
+from mmap import mmap
 from typing import Any, Literal, TypedDict
 
 # Headers for outgoing emails
@@ -14,6 +15,9 @@ OutgoingHeaderName = Literal[
 ]
 OutgoingHeaders = dict[OutgoingHeaderName, str]
 
+# Raw email content, or a read-only memory map of a large email spooled to disk
+EmailBytes = bytes | mmap
+
 # Generic AWS message over SNS - Notification, Bounce, Complaint, ...
 AWS_SNSMessageJSON = dict[str, Any]
 
@@ -2,22 +2,29 @@ from __future__ import annotations
 
 import base64
 import contextlib
+import hashlib
 import json
 import logging
+import mmap
 import pathlib
 import re
+import time
 import zlib
-from collections.abc import Callable
+from collections.abc import Callable, Iterator, Sequence
+from contextvars import ContextVar
 from email.errors import HeaderParseError, InvalidHeaderDefect
 from email.headerregistry import Address, AddressHeader
 from email.message import EmailMessage
+from email.parser import BytesFeedParser
 from email.utils import formataddr, parseaddr
-from functools import cache
-from typing import Any, Literal, TypeVar, cast
+from functools import partial
+from tempfile import SpooledTemporaryFile
+from typing import Any, Literal, NamedTuple, TypeVar, cast
 from urllib.parse import quote_plus, urlparse
 
 from django.conf import settings
 from django.contrib.auth.models import Group, User
+from django.core.cache import caches
 from django.template.defaultfilters import linebreaksbr, urlize
 from django.template.loader import render_to_string
 from django.utils.text import Truncator
@@ -30,12 +37,21 @@ from allauth.socialaccount.models import SocialAccount
 from botocore.exceptions import ClientError
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.kdf.hkdf import HKDFExpand
+from markus.utils import generate_tag
 from mypy_boto3_ses.type_defs import ContentTypeDef, SendRawEmailResponseTypeDef
 
 from privaterelay.sp3_plans import get_sp3_country_language_mapping
 from privaterelay.utils import get_countries_info_from_lang_and_mapping
 
-from .apps import s3_client, ses_client
+from .apps import (
+    TRACKER_INDEX_FILE_NAME,
+    TRACKER_LIST_FILE_NAMES,
+    emails_config,
+    s3_client,
+    ses_client,
+)
+from .policy import relay_policy
+from .types import EmailBytes
 
 logger = logging.getLogger("events")
 info_logger = logging.getLogger("eventsinfo")
@@ -67,21 +83,8 @@ def get_domains_from_settings() -> (
 
 
 def get_trackers(level):
-    category = "Email"
-    tracker_list_name = "level-one-trackers"
-    if level == 2:
-        category = "EmailAggressive"
-        tracker_list_name = "level-two-trackers"
-
-    trackers = []
-    file_name = f"{tracker_list_name}.json"
-    try:
-        with open(TRACKER_FOLDER_PATH / file_name) as f:
-            trackers = json.load(f)
-    except FileNotFoundError:
-        trackers = download_trackers(shavar_prod_lists_url, category)
-        store_trackers(trackers, TRACKER_FOLDER_PATH, file_name)
-    return trackers
+    tracker_lists = emails_config().tracker_lists
+    return tracker_lists.level_two if level == 2 else tracker_lists.level_one
 
 
 def download_trackers(repo_url, category="Email"):
@@ -102,12 +105,33 @@ def store_trackers(trackers, path, file_name):
         json.dump(trackers, f, indent=4)
 
 
-@cache
+def store_tracker_index(path: pathlib.Path) -> dict[str, Any]:
+    """
+    Write the tracker index, from the tracker list files in the folder.
+
+    The index has both lists in one compact file, and a version that is a hash of the
+    lists. A missing list file is stored as an empty list.
+    """
+    lists: dict[str, list[str]] = {}
+    for level, file_name in TRACKER_LIST_FILE_NAMES.items():
+        try:
+            with open(path / file_name) as f:
+                trackers = json.load(f)
+        except FileNotFoundError:
+            trackers = []
+        lists["level_one" if level == 1 else "level_two"] = trackers
+    lists_json = json.dumps(lists, separators=(",", ":"), sort_keys=True)
+    version = hashlib.sha256(lists_json.encode()).hexdigest()[:16]
+    index = {"version": version, **lists}
+    with open(path / TRACKER_INDEX_FILE_NAME, "w") as f:
+        json.dump(index, f, separators=(",", ":"))
+    return index
+
+
 def general_trackers():
     return get_trackers(level=1)
 
 
-@cache
 def strict_trackers():
     return get_trackers(level=2)
 
@@ -131,6 +155,76 @@ def time_if_enabled(name: str) -> Callable[[_TimedFunction], _TimedFunction]:
     return timing_decorator
 
 
+class StageTimer:
+    """
+    Time the stages of processing an email.
+
+    Each stage time excludes the time of stages nested inside it, so the stage times
+    add up to the time spent in stages.
+    """
+
+    def __init__(self) -> None:
+        self.times: dict[str, float] = {}
+        self._nested_times: list[float] = []
+
+    @contextlib.contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        self._nested_times.append(0.0)
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            nested = self._nested_times.pop()
+            self.times[name] = self.times.get(name, 0.0) + elapsed - nested
+            if self._nested_times:
+                self._nested_times[-1] += elapsed
+
+
+_active_stage_timer: ContextVar[StageTimer | None] = ContextVar(
+    "active_stage_timer", default=None
+)
+
+
+def time_stage(name: str) -> contextlib.AbstractContextManager[None]:
+    """Time a stage, if called from a function decorated with time_stages."""
+    stage_timer = _active_stage_timer.get()
+    if stage_timer is None:
+        return contextlib.nullcontext()
+    return stage_timer.stage(name)
+
+
+def time_stages(name: str) -> Callable[[_TimedFunction], _TimedFunction]:
+    """
+    Time the stages of a function that returns an HttpResponse.
+
+    The stage times are emitted as the histogram name, in milliseconds, with a
+    stage tag. They are also added to the response as .stage_times_s, in seconds
+    with millisecond precision.
+    """
+
+    def timing_decorator(func: _TimedFunction) -> _TimedFunction:
+        def func_wrapper(*args, **kwargs):
+            stage_timer = StageTimer()
+            token = _active_stage_timer.set(stage_timer)
+            try:
+                response = func(*args, **kwargs)
+            finally:
+                _active_stage_timer.reset(token)
+            for stage, seconds in stage_timer.times.items():
+                histogram_if_enabled(
+                    name, round(seconds * 1000, 3), [generate_tag("stage", stage)]
+                )
+            response.stage_times_s = {
+                stage: round(seconds, 3) for stage, seconds in stage_timer.times.items()
+            }
+            return response
+
+        return cast(_TimedFunction, func_wrapper)
+
+    return timing_decorator
+
+
 def incr_if_enabled(name, value=1, tags=None):
     if settings.STATSD_ENABLED:
         metrics.incr(name, value, tags)
@@ -221,6 +315,38 @@ def get_welcome_email(user: User, format: str) -> str:
     )
 
 
+# Feed the email parser in chunks, so a large email is not decoded all at once
+EMAIL_PARSE_CHUNK_SIZE = 64 * 1024
+
+
+def parse_email_bytes(
+    email_bytes: EmailBytes, header_block: bytes = b"", body_start: int = 0
+) -> EmailMessage:
+    """
+    Parse an email, like email.message_from_bytes with the Relay policy.
+
+    message_from_bytes decodes the whole email to a string, and the parser copies it
+    to a StringIO, so a large email is in memory several times. This feeds the parser
+    one chunk at a time instead, which creates the same message.
+
+    If header_block is set, it is parsed in place of the email bytes before
+    body_start, without copying the rest of the email.
+    """
+    parser = BytesFeedParser(policy=relay_policy)
+    if header_block:
+        parser.feed(header_block)
+    with memoryview(email_bytes) as view:
+        for start in range(body_start, len(view), EMAIL_PARSE_CHUNK_SIZE):
+            parser.feed(bytes(view[start : start + EMAIL_PARSE_CHUNK_SIZE]))
+    email = parser.close()
+    # python/typeshed issue 2418
+    # The Python 3.2 default was Message, 3.6 uses policy.message_factory, and
+    # policy.default.message_factory is EmailMessage
+    if not isinstance(email, EmailMessage):
+        raise TypeError("email must be type EmailMessage")
+    return email
+
+
 @time_if_enabled("ses_send_raw_email")
 def ses_send_raw_email(
     source_address: str,
@@ -400,7 +526,31 @@ def get_message_content_from_s3(bucket, object_key):
         streamed_s3_object = client.get_object(Bucket=bucket, Key=object_key).get(
             "Body"
         )
-        return streamed_s3_object.read()
+        return spool_email_content(streamed_s3_object)
+
+
+# Emails larger than this are spooled to a temporary file, instead of memory
+EMAIL_SPOOL_MAX_SIZE = 1024 * 1024
+
+
+def spool_email_content(stream: Any) -> EmailBytes:
+    """
+    Read an email from a stream, such as an S3 object body.
+
+    A small email is returned as bytes. A larger email is written to a temporary file
+    as it is read, and returned as a read-only memory map of the file. The operating
+    system can then page the email out, rather than the worker holding it in memory.
+    """
+    with SpooledTemporaryFile(max_size=EMAIL_SPOOL_MAX_SIZE) as spool:
+        for chunk in iter(partial(stream.read, EMAIL_PARSE_CHUNK_SIZE), b""):
+            spool.write(chunk)
+        if spool.tell() <= EMAIL_SPOOL_MAX_SIZE:
+            # Still in memory
+            spool.seek(0)
+            return spool.read()
+        # The map keeps the deleted file open after the spool is closed
+        spool.flush()
+        return mmap.mmap(spool.fileno(), 0, access=mmap.ACCESS_READ)
 
 
 @time_if_enabled("s3_remove_message_from")
@@ -446,22 +596,178 @@ def convert_domains_to_regex_patterns(domain_pattern):
     return r"""(["'])(\S*://([^\s"'.]*\.)*""" + re.escape(domain_pattern) + r"\S*)\1"
 
 
-def count_tracker(html_content, trackers):
-    tracker_total = 0
-    details = {}
-    # html_content needs to be str for count()
+class TrackerIndex:
+    """
+    Find the tracker domains that may be in some content, in one pass.
+
+    A pattern from convert_domains_to_regex_patterns can only match where the domain
+    starts just after a "/" (the end of "://") or a ".". The index finds the domains
+    at those places with set lookups, so that only their patterns need to run.
+    The found domains are a superset of the matching domains.
+    """
+
+    def __init__(self, trackers: Sequence[str]) -> None:
+        self.trackers = tuple(trackers)
+        self.domains = frozenset(self.trackers)
+        self.lengths = sorted({len(domain) for domain in self.domains})
+        self.first_labels = frozenset(
+            domain.split(".", 1)[0] for domain in self.domains if "." in domain
+        )
+        # A domain without a dot may be the start of a longer label
+        self.has_dotless = any("." not in domain for domain in self.domains)
+        chars = set("".join(self.domains)) | {"."}
+        self.run_pattern = re.compile(
+            "[" + "".join(re.escape(char) for char in sorted(chars)) + "]+"
+        )
+
+    def find(self, content: str) -> set[str]:
+        """Return the tracker domains that start after a "/" or "." in content."""
+        found = {""} if "" in self.domains else set()
+        for match in self.run_pattern.finditer(content):
+            run, offset = match.group(), match.start()
+            if offset and content[offset - 1] == "/":
+                self._find_at(run, 0, found)
+            dot = run.find(".")
+            while dot != -1:
+                self._find_at(run, dot + 1, found)
+                dot = run.find(".", dot + 1)
+        return found
+
+    def _find_at(self, run: str, start: int, found: set[str]) -> None:
+        """Add the tracker domains that start at run[start]."""
+        label_end = run.find(".", start)
+        first_label = run[start:] if label_end == -1 else run[start:label_end]
+        if first_label not in self.first_labels and not self.has_dotless:
+            return
+        remaining = len(run) - start
+        for length in self.lengths:
+            if length > remaining:
+                break
+            domain = run[start : start + length]
+            if domain in self.domains:
+                found.add(domain)
+
+
+# The tracker indexes by name, with the tracker lists they were built from
+_tracker_indexes: dict[str, tuple[tuple[Sequence[str], ...], TrackerIndex]] = {}
+
+
+def get_tracker_index(name: str, *tracker_lists: Sequence[str]) -> TrackerIndex:
+    """
+    Get the tracker index for the tracker lists, by name.
+
+    The index is built from the lists joined in order, and is rebuilt if it is
+    requested with different list objects, such as after the lists are reloaded.
+    """
+    cached = _tracker_indexes.get(name)
+    if (
+        cached is not None
+        and len(cached[0]) == len(tracker_lists)
+        and all(old is new for old, new in zip(cached[0], tracker_lists))
+    ):
+        return cached[1]
+    index = TrackerIndex(
+        [tracker for trackers in tracker_lists for tracker in trackers]
+    )
+    _tracker_indexes[name] = (tracker_lists, index)
+    return index
+
+
+def prepare_tracker_indexes() -> None:
+    """Build the tracker indexes for the loaded tracker lists."""
+    general, strict = general_trackers(), strict_trackers()
+    get_tracker_index("level_one", general)
+    get_tracker_index("level_two", strict)
+    get_tracker_index("all", general, strict)
+
+
+def replace_trackers(
+    html_content: str,
+    trackers: Sequence[str],
+    repl: str | Callable[[re.Match[str]], str],
+    found: set[str] | None = None,
+    index: TrackerIndex | None = None,
+) -> tuple[str, int, dict[str, int]]:
+    """
+    Replace the links to trackers, like re.subn with each tracker's pattern in order.
+
+    Only the patterns of trackers found by the tracker index are run. When content
+    is replaced, the new content is indexed again, since it can add a tracker.
+
+    Arguments:
+    * html_content - the content to search
+    * trackers - the tracker domains, in the order to replace
+    * repl - the replacement, as for re.subn
+    * found - the domains found in html_content by a tracker index that includes the
+      trackers, or None to find them
+    * index - the tracker index for the trackers, or None to build one
+
+    Return is a tuple:
+    * The content with trackers replaced
+    * The number of replacements
+    * The replacements by tracker, omitting trackers that were not found
+    """
+    if index is None:
+        index = TrackerIndex(trackers)
+    found = index.find(html_content) if found is None else set(found)
+    total = 0
+    details: dict[str, int] = {}
     for tracker in trackers:
+        if tracker not in found:
+            continue
         pattern = convert_domains_to_regex_patterns(tracker)
-        html_content, count = re.subn(pattern, "", html_content)
+        html_content, count = re.subn(pattern, repl, html_content)
         if count:
-            tracker_total += count
+            total += count
             details[tracker] = count
+            found |= index.find(html_content)
+    return html_content, total, details
+
+
+def count_tracker(html_content, trackers, found=None, index=None):
+    _, tracker_total, details = replace_trackers(
+        html_content, trackers, "", found, index
+    )
     return {"count": tracker_total, "trackers": details}
 
 
-def count_all_trackers(html_content):
-    general_detail = count_tracker(html_content, general_trackers())
-    strict_detail = count_tracker(html_content, strict_trackers())
+class TrackerScan(NamedTuple):
+    """The trackers in some HTML content, from one index scan."""
+
+    found: set[str]  # Domains from both lists found by the tracker index
+    level_one: dict[str, Any]  # count_tracker with general_trackers()
+    level_two: dict[str, Any]  # count_tracker with strict_trackers()
+
+
+def scan_trackers(html_content: str) -> TrackerScan:
+    """
+    Scan content once for both tracker lists, and count the trackers.
+
+    A tracker pattern only matches a link with "://", so content without one, such
+    as the HTML generated from most plain text emails, is not indexed.
+    """
+    if "://" not in html_content:
+        return TrackerScan(
+            set(), {"count": 0, "trackers": {}}, {"count": 0, "trackers": {}}
+        )
+    general, strict = general_trackers(), strict_trackers()
+    found = get_tracker_index("all", general, strict).find(html_content)
+    return TrackerScan(
+        found,
+        count_tracker(
+            html_content, general, found, get_tracker_index("level_one", general)
+        ),
+        count_tracker(
+            html_content, strict, found, get_tracker_index("level_two", strict)
+        ),
+    )
+
+
+def count_all_trackers(html_content, scan=None):
+    if scan is None:
+        scan = scan_trackers(html_content)
+    general_detail = scan.level_one
+    strict_detail = scan.level_two
 
     incr_if_enabled("tracker.general_count", general_detail["count"])
     incr_if_enabled("tracker.strict_count", strict_detail["count"])
@@ -471,38 +777,40 @@ def count_all_trackers(html_content):
     )
 
 
-def remove_trackers(html_content, from_address, datetime_now, level="general"):
-    trackers = general_trackers() if level == "general" else strict_trackers()
-    tracker_removed = 0
-    changed_content = html_content
-
-    for tracker in trackers:
-        pattern = convert_domains_to_regex_patterns(tracker)
-
-        def convert_to_tracker_warning_link(matchobj):
-            quote, original_link, _ = matchobj.groups()
-            tracker_link_details = {
-                "sender": from_address,
-                "received_at": datetime_now,
-                "original_link": original_link,
-            }
-            anchor = quote_plus(json.dumps(tracker_link_details, separators=(",", ":")))
-            url = f"{settings.SITE_ORIGIN}/contains-tracker-warning/#{anchor}"
-            return f"{quote}{url}{quote}"
-
-        changed_content, matched = re.subn(
-            pattern, convert_to_tracker_warning_link, changed_content
-        )
-        tracker_removed += matched
-
-    level_one_detail = count_tracker(html_content, general_trackers())
-    level_two_detail = count_tracker(html_content, strict_trackers())
+def remove_trackers(
+    html_content, from_address, datetime_now, level="general", scan=None
+):
+    if level == "general":
+        trackers, index_name = general_trackers(), "level_one"
+    else:
+        trackers, index_name = strict_trackers(), "level_two"
+    if scan is None:
+        scan = scan_trackers(html_content)
+
+    def convert_to_tracker_warning_link(matchobj):
+        quote, original_link, _ = matchobj.groups()
+        tracker_link_details = {
+            "sender": from_address,
+            "received_at": datetime_now,
+            "original_link": original_link,
+        }
+        anchor = quote_plus(json.dumps(tracker_link_details, separators=(",", ":")))
+        url = f"{settings.SITE_ORIGIN}/contains-tracker-warning/#{anchor}"
+        return f"{quote}{url}{quote}"
+
+    changed_content, tracker_removed, _ = replace_trackers(
+        html_content,
+        trackers,
+        convert_to_tracker_warning_link,
+        scan.found,
+        get_tracker_index(index_name, trackers),
+    )
 
     tracker_details = {
         "tracker_removed": tracker_removed,
-        "level_one": level_one_detail,
+        "level_one": scan.level_one,
     }
-    logger_details = {"level": level, "level_two": level_two_detail}
+    logger_details = {"level": level, "level_two": scan.level_two}
     logger_details.update(tracker_details)
     info_logger.info(
         "email_tracker_summary",
@@ -534,3 +842,43 @@ def decode_dict_gza85(encoded_data: str) -> dict[str, Any]:
     if any(not isinstance(key, str) for key in data):
         raise ValueError("Encoded data has non-str key")
     return data
+
+
+class CachedMask(NamedTuple):
+    """How an email address resolved to a mask, from the mask resolution cache."""
+
+    mask_type: Literal["R", "D"]  # The metrics_id prefix, R for RelayAddress
+    mask_id: int
+    user_id: int
+
+
+# Bump the version when CachedMask changes, so old entries are not read
+_MASK_CACHE_KEY_PREFIX = "mask_resolution:v1:"
+
+
+def get_cached_mask(full_address: str) -> CachedMask | None:
+    """Get how a normalized email address resolved to a mask, or None if unknown."""
+    if not settings.MASK_CACHE_SECONDS:
+        return None
+    mask_cache = caches[settings.MASK_CACHE]
+    cached = mask_cache.get(_MASK_CACHE_KEY_PREFIX + full_address)
+    return cached if isinstance(cached, CachedMask) else None
+
+
+def cache_mask(full_address: str, cached_mask: CachedMask) -> None:
+    """Remember how a normalized email address resolved to a mask."""
+    if not settings.MASK_CACHE_SECONDS:
+        return
+    mask_cache = caches[settings.MASK_CACHE]
+    mask_cache.set(
+        _MASK_CACHE_KEY_PREFIX + full_address,
+        cached_mask,
+        timeout=settings.MASK_CACHE_SECONDS,
+    )
+
+
+def forget_cached_mask(full_address: str) -> None:
+    """Forget how a normalized email address resolved to a mask."""
+    if not settings.MASK_CACHE_SECONDS:
+        return
+    caches[settings.MASK_CACHE].delete(_MASK_CACHE_KEY_PREFIX + full_address)
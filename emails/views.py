@@ -4,10 +4,11 @@ import logging
 import re
 import shlex
 from datetime import UTC, datetime
-from email import message_from_bytes
+from email.headerregistry import UnstructuredHeader
 from email.iterators import _structure
 from email.message import EmailMessage
 from email.utils import parseaddr
+from functools import lru_cache
 from io import StringIO
 from json import JSONDecodeError
 from textwrap import dedent
@@ -17,8 +18,9 @@ from uuid import uuid4
 
 from django.conf import settings
 from django.contrib.auth.models import User
+from django.core.cache import caches
 from django.core.exceptions import ObjectDoesNotExist
-from django.db import transaction
+from django.db import IntegrityError, transaction
 from django.db.models import prefetch_related_objects
 from django.http import HttpRequest, HttpResponse
 from django.shortcuts import render
@@ -39,9 +41,11 @@ from privaterelay.utils import (
     flag_is_active_in_task,
     get_subplat_upgrade_link_by_language,
     glean_logger,
+    update_counters,
 )
 
-from .exceptions import CannotMakeAddressException
+from .counter_buffer import buffer_counters
+from .exceptions import CannotMakeAddressException, DomainAddrDuplicateException
 from .models import (
     DeletedAddress,
     DomainAddress,
@@ -50,36 +54,46 @@ from .models import (
     address_hash,
     get_domain_numerical,
 )
-from .policy import relay_policy
+from .policy import relay_header_factory, relay_policy
 from .sns import SUPPORTED_SNS_TYPES, verify_from_sns
 from .types import (
     AWS_MailJSON,
     AWS_SNSMessageJSON,
+    EmailBytes,
     EmailForwardingIssues,
     EmailHeaderIssues,
     OutgoingHeaders,
 )
 from .utils import (
+    CachedMask,
     InvalidFromHeader,
+    TrackerScan,
     _get_bucket_and_key_from_s3_json,
     _get_hero_img_src,
     b64_lookup_key,
+    cache_mask,
     count_all_trackers,
     decrypt_reply_metadata,
     derive_reply_keys,
     encode_dict_gza85,
     encrypt_reply_metadata,
+    forget_cached_mask,
     generate_from_header,
+    get_cached_mask,
     get_domains_from_settings,
     get_message_content_from_s3,
     get_message_id_bytes,
     get_reply_to_address,
     histogram_if_enabled,
     incr_if_enabled,
+    parse_email_bytes,
     parse_email_header,
     remove_message_from_s3,
     remove_trackers,
+    scan_trackers,
     ses_send_raw_email,
+    time_stage,
+    time_stages,
     urlize_and_linebreaks,
 )
 
@@ -191,6 +205,15 @@ def first_forwarded_email_test(request: HttpRequest) -> HttpResponse:
     return HttpResponse(wrapped_email)
 
 
+# Line breaks that str.splitlines() splits on, other than "\n"
+_OTHER_LINE_BREAKS = "\r\v\f\x1c\x1d\x1e\x85\u2028\u2029"
+# A first line, or a line after the first, that is empty or only whitespace
+_EMPTY_FIRST_LINE_RE = re.compile(r"[^\S\n]*(?:\n|\Z)")
+_EMPTY_LINE_RE = re.compile(r"\n[^\S\n]*\n")
+# The original HTML is indented to match the wrapper
+_ORIGINAL_HTML_INDENT = " " * 10
+
+
 def wrap_html_email(
     original_html: str,
     language: str,
@@ -199,10 +222,16 @@ def wrap_html_email(
     num_level_one_email_trackers_removed: int | None = None,
     tracker_report_link: str | None = None,
 ) -> str:
-    """Add Relay banners, surveys, etc. to an HTML email"""
+    """
+    Add Relay banners, surveys, etc. to an HTML email
+
+    Only the header is rendered for each email. The start of the document and the
+    footer are rendered once per language, and the original HTML is added between
+    them without passing through the template.
+    """
+    start, footer = _wrapped_email_frame(language, settings.SITE_ORIGIN)
     subplat_upgrade_link = get_subplat_upgrade_link_by_language(language)
     email_context = {
-        "original_html": original_html,
         "language": language,
         "has_premium": has_premium,
         "subplat_upgrade_link": subplat_upgrade_link,
@@ -211,8 +240,48 @@ def wrap_html_email(
         "num_level_one_email_trackers_removed": num_level_one_email_trackers_removed,
         "SITE_ORIGIN": settings.SITE_ORIGIN,
     }
-    content = render_to_string("emails/wrapped_email.html", email_context)
-    # Remove empty lines
+    header = _remove_empty_lines(
+        render_to_string("emails/wrapped_email_header.html", email_context)
+    )
+    indent = _ORIGINAL_HTML_INDENT
+    if _has_empty_lines(original_html):
+        # Remove empty lines, as in the rest of the email. If the first line is
+        # empty, the indent is removed with it.
+        original_lines = original_html.splitlines()
+        if original_lines and not original_lines[0].strip():
+            indent = ""
+        original_html = "\n".join(line for line in original_lines if line.strip())
+        if not original_html:
+            return start + header + footer
+    line_end = "" if original_html.endswith("\n") else "\n"
+    return "".join((start, header, indent, original_html, line_end, footer))
+
+
+@lru_cache(maxsize=128)
+def _wrapped_email_frame(language: str, site_origin: str) -> tuple[str, str]:
+    """Render the start of the document and the footer of a wrapped email."""
+    context = {"language": language, "SITE_ORIGIN": site_origin}
+    start = render_to_string("emails/wrapped_email_start.html", context)
+    footer = render_to_string("emails/wrapped_email_footer.html", context)
+    return _remove_empty_lines(start), _remove_empty_lines(footer)
+
+
+def _has_empty_lines(content: str) -> bool:
+    """
+    Return True if content has lines that are empty or only whitespace.
+
+    A line break other than "\n" also returns True, since removing empty lines
+    replaces it. A final "\n" is not an empty line.
+    """
+    if any(line_break in content for line_break in _OTHER_LINE_BREAKS):
+        return True
+    if _EMPTY_FIRST_LINE_RE.match(content) or _EMPTY_LINE_RE.search(content):
+        return True
+    return content[content.rfind("\n") + 1 :].isspace()
+
+
+def _remove_empty_lines(content: str) -> str:
+    """Remove empty lines and lines with only whitespace."""
     content_lines = [line for line in content.splitlines() if line.strip()]
     return "\n".join(content_lines) + "\n"
 
@@ -481,14 +550,65 @@ def _sns_notification(json_body):
             ),
             status=400,
         )
+    dedupe_keys = _get_dedupe_keys(json_body, message_json)
+    if _is_duplicate_notification(dedupe_keys):
+        incr_if_enabled("duplicate_suppressed", 1)
+        info_logger.info(
+            "Duplicate SNS notification suppressed",
+            extra={"sns_message_id": json_body.get("MessageId")},
+        )
+        return HttpResponse("Duplicate SNS notification suppressed", status=200)
+
     response = _sns_message(message_json)
     bucket, object_key = _get_bucket_and_key_from_s3_json(message_json)
     if response.status_code < 500:
         remove_message_from_s3(bucket, object_key)
+        _mark_notification_processed(dedupe_keys)
 
     return response
 
 
+def _get_dedupe_keys(
+    json_body: dict[str, Any], message_json: AWS_SNSMessageJSON
+) -> list[str]:
+    """
+    Return the cache keys that identify a notification.
+
+    SQS can deliver a message more than once, with the same SNS MessageId. SES can
+    publish the same received email more than once, with the same mail.messageId.
+    Bounces and complaints only use the SNS MessageId, since SES sends a separate
+    notification for each bounce or complaint about the same sent email.
+    """
+    keys = []
+    if sns_message_id := json_body.get("MessageId"):
+        keys.append(f"sns_dedupe:sns:{sns_message_id}")
+    mail_message_id = message_json.get("mail", {}).get("messageId")
+    notification_type = message_json.get("notificationType") or message_json.get(
+        "eventType"
+    )
+    if mail_message_id and notification_type == "Received":
+        keys.append(f"sns_dedupe:ses:Received:{mail_message_id}")
+    return keys
+
+
+def _is_duplicate_notification(dedupe_keys: list[str]) -> bool:
+    """Return True if a notification with one of the keys was already processed."""
+    if not dedupe_keys or not settings.AWS_SNS_DEDUPE_SECONDS:
+        return False
+    dedupe_cache = caches[settings.AWS_SNS_DEDUPE_CACHE]
+    return bool(dedupe_cache.get_many(dedupe_keys))
+
+
+def _mark_notification_processed(dedupe_keys: list[str]) -> None:
+    """Remember that a notification was processed, to suppress repeats."""
+    if not dedupe_keys or not settings.AWS_SNS_DEDUPE_SECONDS:
+        return
+    dedupe_cache = caches[settings.AWS_SNS_DEDUPE_CACHE]
+    dedupe_cache.set_many(
+        dict.fromkeys(dedupe_keys, True), timeout=settings.AWS_SNS_DEDUPE_SECONDS
+    )
+
+
 def _get_recipient_with_relay_domain(recipients):
     domains_to_check = get_domains_from_settings().values()
     for recipient in recipients:
@@ -576,6 +696,7 @@ def log_email_dropped(
     info_logger.info("email_dropped", extra=extra)
 
 
+@time_stages("relayed_email.stage_ms")
 def _handle_received(message_json: AWS_SNSMessageJSON) -> HttpResponse:
     """
     Handle an AWS SES received notification.
@@ -600,6 +721,9 @@ def _handle_received(message_json: AWS_SNSMessageJSON) -> HttpResponse:
     artifact from an earlier time when emails were sent to a webhook. Currently,
     production instead pulls events from a queue.
 
+    The time of each processing stage is emitted as relayed_email.stage_ms, and added
+    to the response as .stage_times_s.
+
     TODO: Return a more appropriate status object
     TODO: Document the metrics emitted
     """
@@ -644,9 +768,10 @@ def _handle_received(message_json: AWS_SNSMessageJSON) -> HttpResponse:
         # FIXME: this ambiguous return of either
         # RelayAddress or DomainAddress types makes the Rustacean in me throw
         # up a bit.
-        address = _get_address(to_address)
-        prefetch_related_objects([address.user], "socialaccount_set", "profile")
-        user_profile = address.user.profile
+        with time_stage("address_lookup"):
+            address = _get_address(to_address)
+            prefetch_related_objects([address.user], "socialaccount_set", "profile")
+            user_profile = address.user.profile
     except (
         ObjectDoesNotExist,
         CannotMakeAddressException,
@@ -677,7 +802,8 @@ def _handle_received(message_json: AWS_SNSMessageJSON) -> HttpResponse:
             return HttpResponse("DMARC failure, policy is reject", status=400)
 
     # if this user is over bounce limits, early return
-    bounce_paused, bounce_type = user_profile.check_bounce_pause()
+    with time_stage("bounce_check"):
+        bounce_paused, bounce_type = user_profile.check_bounce_pause()
     if bounce_paused:
         _record_receipt_verdicts(receipt, "user_bounce_paused")
         incr_if_enabled(f"email_suppressed_for_{bounce_type}_bounce", 1)
@@ -689,8 +815,9 @@ def _handle_received(message_json: AWS_SNSMessageJSON) -> HttpResponse:
 
     # check if this is a reply from an external sender to a Relay user
     try:
-        lookup_key, _ = _get_keys_from_headers(mail["headers"])
-        reply_record = _get_reply_record_from_lookup_key(lookup_key)
+        with time_stage("reply_detection"):
+            lookup_key, _ = _get_keys_from_headers(mail["headers"])
+            reply_record = _get_reply_record_from_lookup_key(lookup_key)
 
         # SECURITY: Verify the reply record belongs to the same user as the recipient
         # This prevents cross-account authorization bypass where an attacker could use
@@ -724,11 +851,9 @@ def _handle_received(message_json: AWS_SNSMessageJSON) -> HttpResponse:
     # if address is set to block, early return
     if not address.enabled:
         incr_if_enabled("email_for_disabled_address", 1)
-        address.num_blocked += 1
-        address.save(update_fields=["num_blocked"])
+        buffer_counters(address, {"num_blocked": 1})
         _record_receipt_verdicts(receipt, "disabled_alias")
-        user_profile.last_engagement = datetime.now(UTC)
-        user_profile.save()
+        buffer_counters(user_profile, last_engagement=datetime.now(UTC))
         glean_logger().log_email_blocked(mask=address, reason="block_all")
         return HttpResponse("Address is temporarily disabled.")
 
@@ -743,10 +868,8 @@ def _handle_received(message_json: AWS_SNSMessageJSON) -> HttpResponse:
         and _check_email_from_list(mail["headers"])
     ):
         incr_if_enabled("list_email_for_address_blocking_lists", 1)
-        address.num_blocked += 1
-        address.save(update_fields=["num_blocked"])
-        user_profile.last_engagement = datetime.now(UTC)
-        user_profile.save()
+        buffer_counters(address, {"num_blocked": 1})
+        buffer_counters(user_profile, last_engagement=datetime.now(UTC))
         glean_logger().log_email_blocked(mask=address, reason="block_promotional")
         return HttpResponse("Address is not accepting list emails.")
 
@@ -826,6 +949,9 @@ def _handle_received(message_json: AWS_SNSMessageJSON) -> HttpResponse:
         sample_trackers=sample_trackers,
         remove_level_one_trackers=remove_level_one_trackers,
     )
+    # Release the raw email, so only the parsed email is in memory while sending
+    forwarded_email_size = len(incoming_email_bytes)
+    del incoming_email_bytes
     if has_html:
         incr_if_enabled("email_with_html_content", 1)
     if has_text:
@@ -837,38 +963,36 @@ def _handle_received(message_json: AWS_SNSMessageJSON) -> HttpResponse:
 
     # Send new email
     try:
-        ses_response = ses_send_raw_email(
-            source_address=reply_address,
-            destination_address=destination_address,
-            message=forwarded_email,
-        )
+        with time_stage("ses_send"):
+            ses_response = ses_send_raw_email(
+                source_address=reply_address,
+                destination_address=destination_address,
+                message=forwarded_email,
+            )
     except ClientError:
         # 503 service unavailable response to SNS so it can retry
         log_email_dropped(reason="error_sending", mask=address, can_retry=True)
         return HttpResponse("SES client error on Raw Email", status=503)
 
     message_id = ses_response["MessageId"]
-    _store_reply_record(mail, message_id, address)
+    with time_stage("reply_record"):
+        _store_reply_record(mail, message_id, address)
 
-    user_profile.update_abuse_metric(
-        email_forwarded=True, forwarded_email_size=len(incoming_email_bytes)
-    )
-    user_profile.last_engagement = datetime.now(UTC)
-    user_profile.save()
-    address.num_forwarded += 1
-    address.last_used_at = datetime.now(UTC)
-    if level_one_trackers_removed:
-        address.num_level_one_trackers_blocked = (
-            address.num_level_one_trackers_blocked or 0
-        ) + level_one_trackers_removed
-    address.save(
-        update_fields=[
-            "num_forwarded",
-            "last_used_at",
-            "block_list_emails",
-            "num_level_one_trackers_blocked",
-        ]
-    )
+    with time_stage("counters"):
+        user_profile.update_abuse_metric(
+            email_forwarded=True, forwarded_email_size=forwarded_email_size
+        )
+        now = datetime.now(UTC)
+        buffer_counters(user_profile, last_engagement=now)
+        address_counters = {"num_forwarded": 1}
+        if level_one_trackers_removed:
+            address_counters["num_level_one_trackers_blocked"] = (
+                level_one_trackers_removed
+            )
+        buffer_counters(address, address_counters, last_used_at=now)
+        if address.block_list_emails and not user_profile.has_premium:
+            # As in RelayAddress.save() and DomainAddress.save()
+            update_counters(address, block_list_emails=False)
     glean_logger().log_email_forwarded(mask=address, is_reply=False)
     return HttpResponse("Sent email to final recipient.", status=200)
 
@@ -957,11 +1081,11 @@ _TransportType = Literal["sns", "s3"]
 
 def _get_email_bytes(
     message_json: AWS_SNSMessageJSON,
-) -> tuple[bytes, _TransportType, float]:
-    with Timer(logger=None) as load_timer:
+) -> tuple[EmailBytes, _TransportType, float]:
+    with Timer(logger=None) as load_timer, time_stage("s3_load"):
         if "content" in message_json:
             # email content in sns message
-            message_content = message_json["content"].encode("utf-8")
+            message_content: EmailBytes = message_json["content"].encode("utf-8")
             transport: Literal["sns", "s3"] = "sns"
         else:
             # assume email content in S3
@@ -1027,7 +1151,7 @@ def _log_dev_notification(
 
 
 def _convert_to_forwarded_email(
-    incoming_email_bytes: bytes,
+    incoming_email_bytes: EmailBytes,
     headers: OutgoingHeaders,
     to_address: str,
     from_address: str,
@@ -1047,70 +1171,64 @@ def _convert_to_forwarded_email(
     - has_html - True if the email has an HTML representation
     - has_text - True if the email has a plain text representation
     """
-    email = message_from_bytes(incoming_email_bytes, policy=relay_policy)
-    # python/typeshed issue 2418
-    # The Python 3.2 default was Message, 3.6 uses policy.message_factory, and
-    # policy.default.message_factory is EmailMessage
-    if not isinstance(email, EmailMessage):
-        raise TypeError("email must be type EmailMessage")
-
-    # Replace headers in the original email
-    header_issues = _replace_headers(email, headers)
-
-    # Find and replace text content
-    text_body = email.get_body("plain")
-    text_content = None
-    has_text = False
-    if text_body:
-        has_text = True
-        if not isinstance(text_body, EmailMessage):
-            raise TypeError("text_body must be type EmailMessage")
-        text_content = text_body.get_content()
-        new_text_content = _convert_text_content(text_content, to_address)
-        text_body.set_content(new_text_content)
-
-    # Find and replace HTML content
-    html_body = email.get_body("html")
-    level_one_trackers_removed = 0
-    has_html = False
-    if html_body:
-        has_html = True
-        if not isinstance(html_body, EmailMessage):
-            raise TypeError("html_body must be type EmailMessage")
-        html_content = html_body.get_content()
-        new_content, level_one_trackers_removed = _convert_html_content(
-            html_content,
-            to_address,
-            from_address,
-            language,
-            has_premium,
-            sample_trackers,
-            remove_level_one_trackers,
-        )
-        html_body.set_content(new_content, subtype="html")
-    elif text_content:
-        # Try to use the text content to generate HTML content
-        html_content = urlize_and_linebreaks(text_content)
-        new_content, level_one_trackers_removed = _convert_html_content(
-            html_content,
-            to_address,
-            from_address,
-            language,
-            has_premium,
-            sample_trackers,
-            remove_level_one_trackers,
-        )
-        if not isinstance(text_body, EmailMessage):
-            raise TypeError("text_body must be type EmailMessage")
-        try:
-            text_body.add_alternative(new_content, subtype="html")
-        except TypeError as e:
-            out = StringIO()
-            _structure(email, fp=out)
-            info_logger.error(
-                "Adding HTML alternate failed",
-                extra={"exception": str(e), "structure": out.getvalue()},
+    # Parse the email, with the headers replaced
+    email, header_issues = _parse_email_with_headers(incoming_email_bytes, headers)
+
+    # Convert the text and HTML content
+    with time_stage("convert"):
+        # Find and replace text content
+        text_body = email.get_body("plain")
+        text_content = None
+        has_text = False
+        if text_body:
+            has_text = True
+            if not isinstance(text_body, EmailMessage):
+                raise TypeError("text_body must be type EmailMessage")
+            text_content = text_body.get_content()
+            new_text_content = _convert_text_content(text_content, to_address)
+            text_body.set_content(new_text_content)
+
+        # Find and replace HTML content
+        html_body = email.get_body("html")
+        level_one_trackers_removed = 0
+        has_html = False
+        if html_body:
+            has_html = True
+            if not isinstance(html_body, EmailMessage):
+                raise TypeError("html_body must be type EmailMessage")
+            html_content = html_body.get_content()
+            new_content, level_one_trackers_removed = _convert_html_content(
+                html_content,
+                to_address,
+                from_address,
+                language,
+                has_premium,
+                sample_trackers,
+                remove_level_one_trackers,
+            )
+            html_body.set_content(new_content, subtype="html")
+        elif text_content:
+            # Try to use the text content to generate HTML content
+            new_content, level_one_trackers_removed = _convert_text_to_html_content(
+                text_content,
+                to_address,
+                from_address,
+                language,
+                has_premium,
+                sample_trackers,
+                remove_level_one_trackers,
             )
+            if not isinstance(text_body, EmailMessage):
+                raise TypeError("text_body must be type EmailMessage")
+            try:
+                text_body.add_alternative(new_content, subtype="html")
+            except TypeError as e:
+                out = StringIO()
+                _structure(email, fp=out)
+                info_logger.error(
+                    "Adding HTML alternate failed",
+                    extra={"exception": str(e), "structure": out.getvalue()},
+                )
 
     issues: EmailForwardingIssues = {}
     if header_issues:
@@ -1252,6 +1370,157 @@ def _replace_headers(
     return issues
 
 
+# A header line or a continuation line, as read by email.feedparser
+_HEADER_LINE_RE = re.compile(rb"[\x21-\x39\x3b-\x7e]+:|[\t ]")
+_LINE_END_RE = re.compile(rb"\r\n|\r|\n")
+# Characters and encoded words that can add defects to an unstructured header
+_UNSTRUCTURED_DEFECT_RE = re.compile(r"[^\t\r\n\x20-\x7e]|=\?")
+
+
+def _parse_email_with_headers(
+    email_bytes: EmailBytes, headers: OutgoingHeaders
+) -> tuple[EmailMessage, EmailHeaderIssues]:
+    """
+    Parse an email, and replace the headers with new headers.
+
+    Most emails have compliant headers, which are replaced in the raw header block
+    before parsing. Emails with header defects are parsed first, so that
+    _replace_headers can report the issues.
+    """
+    with time_stage("headers"):
+        replaced = _replace_headers_in_bytes(email_bytes, headers)
+    if replaced is None:
+        with time_stage("parse"):
+            email = parse_email_bytes(email_bytes)
+        with time_stage("headers"):
+            return email, _replace_headers(email, headers)
+    header_block, body_start, issues = replaced
+    with time_stage("parse"):
+        return parse_email_bytes(email_bytes, header_block, body_start), issues
+
+
+def _replace_headers_in_bytes(
+    email_bytes: EmailBytes, headers: OutgoingHeaders
+) -> tuple[bytes, int, EmailHeaderIssues] | None:
+    """
+    Replace the headers in the raw header block of an email.
+
+    This makes the same changes as _replace_headers, but only parses the structured
+    headers and the unstructured headers that could have defects. The other headers
+    are dropped or kept as bytes.
+
+    Return None if a header line or a header value has a defect. Otherwise, return a
+    tuple:
+    - header_block - The new header block, without the blank line
+    - body_start - The offset of the blank line after the original header block
+    - issues - The duplicated headers that were dropped
+    """
+    # Split the header block into header fields, like email.feedparser
+    fields: list[list[bytes]] = []
+    pos = 0
+    while True:
+        line_end = _LINE_END_RE.search(email_bytes, pos)
+        if line_end is None:
+            return None
+        if line_end.start() == pos:
+            body_start = pos
+            break
+        line = email_bytes[pos : line_end.end()]
+        if not line.isascii() or not _HEADER_LINE_RE.match(line):
+            return None
+        if line[0] in b"\t ":
+            if not fields:
+                return None
+            fields[-1].append(line)
+        else:
+            fields.append([line])
+        pos = line_end.end()
+
+    # Read the header values, and parse the ones that could have defects
+    values: list[tuple[str, str]] = []
+    for field in fields:
+        name, value = relay_policy.header_source_parse(
+            [line.decode("ascii") for line in field]
+        )
+        if issubclass(
+            relay_header_factory[name], UnstructuredHeader
+        ) and not _UNSTRUCTURED_DEFECT_RE.search(value):
+            values.append((name, value))
+            continue
+        try:
+            parsed_value = relay_policy.header_fetch_parse(name, value)
+        except Exception:
+            return None
+        if getattr(parsed_value, "defects", None) or getattr(
+            getattr(parsed_value, "_parse_tree", None), "all_defects", []
+        ):
+            return None
+        values.append((name, value))
+
+    # Find the kept headers, and the kept headers that appear more than once
+    replacements: set[str] = {_k.lower() for _k in headers.keys()}
+    kept: list[bool] = []
+    first_kept: dict[str, tuple[str, str]] = {}
+    duplicate_counts: dict[str, int] = {}
+    for name, value in values:
+        header_lower = name.lower()
+        if header_lower in replacements or (
+            header_lower != "mime-version" and not header_lower.startswith("content-")
+        ):
+            kept.append(False)
+        elif header_lower in first_kept:
+            kept.append(False)
+            duplicate_counts[header_lower] = duplicate_counts.get(header_lower, 0) + 1
+        else:
+            kept.append(True)
+            first_kept[header_lower] = (name, value)
+
+    # Copy the kept headers, then add the collapsed duplicates and the new headers
+    # after them, in the same order as _replace_headers
+    header_block = bytearray()
+    for field, (name, _), keep in zip(fields, values, kept):
+        if keep and name.lower() not in duplicate_counts:
+            header_block += b"".join(field)
+    issues: EmailHeaderIssues = []
+    for header_lower, count in duplicate_counts.items():
+        name, value = first_kept[header_lower]
+        folded = _fold_header(name, relay_policy.header_fetch_parse(name, value))
+        if folded is None:
+            return None
+        header_block += folded
+        issues.append({"header": name, "direction": "in", "duplicates_dropped": count})
+    for header, new_value in headers.items():
+        try:
+            name, parsed_value = relay_policy.header_store_parse(
+                header, new_value.rstrip("\r\n")
+            )
+        except Exception:
+            return None
+        if getattr(parsed_value, "defects", None):
+            return None
+        folded = _fold_header(name, parsed_value)
+        if folded is None:
+            return None
+        header_block += folded
+    return bytes(header_block), body_start, issues
+
+
+def _fold_header(name: str, value: str) -> bytes | None:
+    """
+    Fold a parsed header for a header block, or return None if it would change.
+
+    The parsed email writes a header from the header block as it is, unless a line
+    is too long. Then it is refolded, and can be different from the folded header.
+    """
+    folded = relay_policy.fold_binary(name, value)
+    _, source_value = relay_policy.header_source_parse(
+        folded.decode("ascii").splitlines(keepends=True)
+    )
+    if relay_policy.fold_binary(name, source_value) != folded:
+        return None
+    return folded
+
+
 def _replace_reply_email_in_body(
     email: EmailMessage, real_address: str, mask_address: str
 ) -> None:
@@ -1279,6 +1548,46 @@ def _replace_reply_email_in_body(
             html_body.set_content(new_content, subtype="html")
 
 
+# A link generated by urlize. The text is escaped, so only attributes have quotes.
+_GENERATED_LINK_HREF_RE = re.compile(r'href="[^"]*"')
+
+
+def _convert_text_to_html_content(
+    text_content: str,
+    to_address: str,
+    from_address: str,
+    language: str,
+    has_premium: bool,
+    sample_trackers: bool,
+    remove_level_one_trackers: bool,
+    now: datetime | None = None,
+) -> tuple[str, int]:
+    """
+    Generate the wrapped HTML content for a plain text email.
+
+    The generated HTML can only have trackers in the links added by urlize, so the
+    trackers are scanned in those links rather than the whole content. Text without
+    web links skips the scan.
+    """
+    html_content = urlize_and_linebreaks(text_content)
+    tracker_scan = None
+    if sample_trackers or remove_level_one_trackers:
+        with time_stage("tracker_removal"):
+            links = " ".join(_GENERATED_LINK_HREF_RE.findall(html_content))
+            tracker_scan = scan_trackers(links)
+    return _convert_html_content(
+        html_content,
+        to_address,
+        from_address,
+        language,
+        has_premium,
+        sample_trackers,
+        remove_level_one_trackers,
+        now,
+        tracker_scan,
+    )
+
+
 def _convert_html_content(
     html_content: str,
     to_address: str,
@@ -1288,6 +1597,7 @@ def _convert_html_content(
     sample_trackers: bool,
     remove_level_one_trackers: bool,
     now: datetime | None = None,
+    tracker_scan: TrackerScan | None = None,
 ) -> tuple[str, int]:
     # frontend expects a timestamp in milliseconds
     now = now or datetime.now(UTC)
@@ -1297,16 +1607,23 @@ def _convert_html_content(
     # and apply default link styles
     display_email = re.sub("([@.:])", r"<span>\1</span>", to_address)
 
+    # scan for trackers once, for sampling and removal
+    if tracker_scan is None and (sample_trackers or remove_level_one_trackers):
+        with time_stage("tracker_removal"):
+            tracker_scan = scan_trackers(html_content)
+
     # sample tracker numbers
     if sample_trackers:
-        count_all_trackers(html_content)
+        with time_stage("tracker_removal"):
+            count_all_trackers(html_content, tracker_scan)
 
     tracker_report_link = ""
     removed_count = 0
     if remove_level_one_trackers:
-        html_content, tracker_details = remove_trackers(
-            html_content, from_address, datetime_now_ms
-        )
+        with time_stage("tracker_removal"):
+            html_content, tracker_details = remove_trackers(
+                html_content, from_address, datetime_now_ms, scan=tracker_scan
+            )
         removed_count = tracker_details["tracker_removed"]
         tracker_report_details = {
             "sender": from_address,
@@ -1374,7 +1691,7 @@ def _build_reply_requires_premium_email(
 
 def _set_forwarded_first_reply(profile):
     profile.forwarded_first_reply = True
-    profile.save()
+    profile.save(update_fields=["forwarded_first_reply"])
 
 
 def _send_reply_requires_premium_email(
@@ -1467,7 +1784,8 @@ def _handle_reply(
         return HttpResponse("No In-Reply-To header", status=400)
 
     try:
-        reply_record = _get_reply_record_from_lookup_key(lookup_key)
+        with time_stage("reply_detection"):
+            reply_record = _get_reply_record_from_lookup_key(lookup_key)
     except Reply.DoesNotExist:
         incr_if_enabled("reply_email_header_error", 1, tags=["detail:no-reply-record"])
         return HttpResponse("Unknown or stale In-Reply-To header", status=404)
@@ -1508,30 +1826,29 @@ def _handle_reply(
         # we are returning a 500 so that SNS can retry the email processing
         return HttpResponse("Cannot fetch the message content from S3", status=503)
 
-    email = message_from_bytes(email_bytes, policy=relay_policy)
-    if not isinstance(email, EmailMessage):
-        raise TypeError("email must be type EmailMessage")
-
     # Convert to a reply email
     # TODO: Issue #1747 - Remove wrapper / prefix in replies
-    _replace_headers(email, headers)
+    email, _ = _parse_email_with_headers(email_bytes, headers)
+    # Release the raw email, so only the parsed email is in memory while sending
+    del email_bytes
     _replace_reply_email_in_body(email, address.user.email, outbound_from_address)
 
     try:
-        ses_send_raw_email(
-            source_address=outbound_from_address,
-            destination_address=to_address,
-            message=email,
-        )
+        with time_stage("ses_send"):
+            ses_send_raw_email(
+                source_address=outbound_from_address,
+                destination_address=to_address,
+                message=email,
+            )
     except ClientError:
         log_email_dropped(reason="error_sending", mask=address, is_reply=True)
         return HttpResponse("SES client error", status=400)
 
-    reply_record.increment_num_replied()
-    profile = address.user.profile
-    profile.update_abuse_metric(replied=True)
-    profile.last_engagement = datetime.now(UTC)
-    profile.save()
+    with time_stage("counters"):
+        reply_record.increment_num_replied()
+        profile = address.user.profile
+        profile.update_abuse_metric(replied=True)
+        buffer_counters(profile, last_engagement=datetime.now(UTC))
     glean_logger().log_email_forwarded(mask=address, is_reply=True)
     return HttpResponse("Sent email to final recipient.", status=200)
 
@@ -1556,36 +1873,69 @@ def _get_domain_address(
             incr_if_enabled("email_for_not_supported_domain", 1)
         raise ObjectDoesNotExist("Address does not exist")
     try:
-        with transaction.atomic():
-            locked_profile = Profile.objects.select_for_update().get(
-                subdomain=address_subdomain
-            )
-            domain_numerical = get_domain_numerical(address_domain)
-            # filter DomainAddress because it may not exist
-            # which will throw an error with get()
-            domain_address = DomainAddress.objects.filter(
-                user=locked_profile.user, address=local_portion, domain=domain_numerical
-            ).first()
-            if domain_address is None:
-                if not create:
-                    raise DomainAddress.DoesNotExist()
-                # TODO: Consider flows when a user generating alias on a fly
-                # was unable to receive an email due to user no longer being a
-                # premium user as seen in exception thrown on make_domain_address
-                domain_address = DomainAddress.make_domain_address(
-                    locked_profile.user, local_portion, True
-                )
-                glean_logger().log_email_mask_created(
-                    mask=domain_address,
-                    created_by_api=False,
-                )
-            domain_address.last_used_at = datetime.now(UTC)
-            domain_address.save()
-            return domain_address
+        profile = Profile.objects.select_related("user").get(
+            subdomain=address_subdomain
+        )
     except Profile.DoesNotExist as e:
         if create:
             incr_if_enabled("email_for_dne_subdomain", 1)
         raise e
+    domain_numerical = get_domain_numerical(address_domain)
+    # filter DomainAddress because it may not exist
+    # which will throw an error with get()
+    domain_address = DomainAddress.objects.filter(
+        user=profile.user, address=local_portion, domain=domain_numerical
+    ).first()
+    if domain_address is None:
+        if not create:
+            raise DomainAddress.DoesNotExist()
+        domain_address = _create_domain_address(
+            profile, local_portion, domain_numerical
+        )
+    _set_domain_address_last_used(domain_address)
+    return domain_address
+
+
+def _create_domain_address(
+    profile: Profile, local_portion: str, domain_numerical: int
+) -> DomainAddress:
+    """
+    Create a DomainAddress for an email to an unknown address on a subdomain.
+
+    The profile is not locked. If another email creates the same DomainAddress
+    first, the unique constraint on user and address rejects this one, and the
+    other DomainAddress is returned. If there is no DomainAddress for the domain,
+    the exception is raised.
+    """
+    try:
+        with transaction.atomic():
+            # TODO: Consider flows when a user generating alias on a fly
+            # was unable to receive an email due to user no longer being a
+            # premium user as seen in exception thrown on make_domain_address
+            domain_address = DomainAddress.make_domain_address(
+                profile.user, local_portion, True
+            )
+    except (DomainAddrDuplicateException, IntegrityError):
+        other_address = DomainAddress.objects.filter(
+            user=profile.user, address=local_portion, domain=domain_numerical
+        ).first()
+        if other_address is None:
+            raise
+        incr_if_enabled("domainaddress.create_via_email_race")
+        return other_address
+    glean_logger().log_email_mask_created(
+        mask=domain_address,
+        created_by_api=False,
+    )
+    return domain_address
+
+
+def _set_domain_address_last_used(domain_address: DomainAddress) -> None:
+    """Set DomainAddress.last_used_at, without the checks in DomainAddress.save()"""
+    domain_address.last_used_at = datetime.now(UTC)
+    DomainAddress.objects.filter(id=domain_address.id).update(
+        last_used_at=domain_address.last_used_at
+    )
 
 
 def _get_address(address: str, create: bool = True) -> RelayAddress | DomainAddress:
@@ -1605,12 +1955,17 @@ def _get_address(address: str, create: bool = True) -> RelayAddress | DomainAddr
     local_portion, domain_portion = address.split("@")
     local_address = local_portion.lower()
     domain = domain_portion.lower()
+    full_address = f"{local_address}@{domain}"
+    if cached_address := _get_cached_address(full_address):
+        return cached_address
 
     # if the domain is not the site's 'top' relay domain,
     # it may be for a user's subdomain
     email_domains = get_domains_from_settings().values()
     if domain not in email_domains:
-        return _get_domain_address(local_address, domain, create)
+        domain_address = _get_domain_address(local_address, domain, create)
+        _cache_address(full_address, domain_address)
+        return domain_address
 
     # the domain is the site's 'top' relay domain, so look up the RelayAddress
     try:
@@ -1618,6 +1973,7 @@ def _get_address(address: str, create: bool = True) -> RelayAddress | DomainAddr
         relay_address = RelayAddress.objects.get(
             address=local_address, domain=domain_numerical
         )
+        _cache_address(full_address, relay_address)
         return relay_address
     except RelayAddress.DoesNotExist as e:
         if not create:
@@ -1636,6 +1992,48 @@ def _get_address(address: str, create: bool = True) -> RelayAddress | DomainAddr
         raise e
 
 
+def _get_cached_address(full_address: str) -> RelayAddress | DomainAddress | None:
+    """
+    Get the mask for a normalized email address from the mask resolution cache.
+
+    The mask is loaded with its user and profile in one query, without locking the
+    profile. If the mask is gone or no longer has the address, the cache entry is
+    removed and None is returned.
+    """
+    cached_mask = get_cached_mask(full_address)
+    if cached_mask is None:
+        return None
+    mask: RelayAddress | DomainAddress | None
+    if cached_mask.mask_type == "R":
+        mask = (
+            RelayAddress.objects.select_related("user__profile")
+            .filter(id=cached_mask.mask_id)
+            .first()
+        )
+    else:
+        mask = (
+            DomainAddress.objects.select_related("user__profile")
+            .filter(id=cached_mask.mask_id)
+            .first()
+        )
+    try:
+        is_match = mask is not None and mask.full_address == full_address
+    except ObjectDoesNotExist:  # The user has no profile
+        is_match = False
+    if mask is None or not is_match:
+        forget_cached_mask(full_address)
+        return None
+    if isinstance(mask, DomainAddress):
+        _set_domain_address_last_used(mask)
+    return mask
+
+
+def _cache_address(full_address: str, mask: RelayAddress | DomainAddress) -> None:
+    """Remember the mask for a normalized email address."""
+    mask_type: Literal["R", "D"] = "R" if isinstance(mask, RelayAddress) else "D"
+    cache_mask(full_address, CachedMask(mask_type, mask.id, mask.user_id))
+
+
 def _get_address_if_exists(address: str) -> RelayAddress | DomainAddress | None:
     """Get the matching RelayAddress or DomainAddress, or None if it doesn't exist."""
     try:
@@ -22,6 +22,7 @@ from twilio.base.exceptions import TwilioException, TwilioRestException
 from twilio.rest import Client
 
 from emails.utils import incr_if_enabled
+from privaterelay.utils import update_counters
 
 from .apps import phones_config, twilio_client
 
@@ -241,6 +242,15 @@ def vcard_lookup_key_default():
     )
 
 
+# The RelayNumber counters that update the user's Profile.last_engagement
+_ENGAGEMENT_COUNTERS = (
+    "calls_forwarded",
+    "calls_blocked",
+    "texts_forwarded",
+    "texts_blocked",
+)
+
+
 class RelayNumber(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
     number = models.CharField(max_length=15, db_index=True, unique=True)
@@ -278,6 +288,15 @@ class RelayNumber(models.Model):
     def storing_phone_log(self) -> bool:
         return bool(self.user.profile.store_phone_log)
 
+    def increment_counters(self, **counters: int) -> None:
+        """
+        Add to the call and text counters with one UPDATE, so concurrent updates are
+        not lost. As in save(), changed forwarded or blocked counts are engagement.
+        """
+        update_counters(self, counters)
+        if any(counters.get(name) for name in _ENGAGEMENT_COUNTERS):
+            update_counters(self.user.profile, last_engagement=datetime.now(UTC))
+
     def save(self, *args, **kwargs):
         try:
             RealPhone.verified_objects.get(user=self.user)
@@ -0,0 +1,160 @@
+"""
+Count abuse metrics in a cache, and roll them up to the AbuseMetrics table.
+
+With settings.ABUSE_METRICS_BACKEND = "database" (the default),
+Profile.update_abuse_metric() locks and updates the user's AbuseMetrics row for the
+UTC day. With "cache", it adds to counters in settings.ABUSE_METRICS_CACHE, such as
+Redis, which add atomically and expire the day after. The abuse limits are checked
+against the cached totals.
+
+The rollup_abuse_metrics command copies the cached totals to AbuseMetrics, for
+review by SecOps. Until then, the table is behind the cache.
+"""
+
+from collections.abc import Mapping
+from datetime import UTC, date, datetime, time, timedelta
+from typing import Any
+
+from django.conf import settings
+from django.core.cache import BaseCache, caches
+
+# The abuse metrics, named as the AbuseMetrics fields
+ABUSE_METRIC_NAMES = (
+    "num_address_created_per_day",
+    "num_replies_per_day",
+    "num_email_forwarded_per_day",
+    "forwarded_email_size_per_day",
+)
+# AbuseMetrics uses PositiveSmallIntegerField for these
+_SMALL_INTEGER_METRICS = {
+    "num_address_created_per_day",
+    "num_replies_per_day",
+    "num_email_forwarded_per_day",
+}
+_SMALL_INTEGER_MAX = 32767
+
+_CACHE_KEY_PREFIX = "abuse_metrics:v1:"
+# Keep a day's counters for a day after it ends, so the last counts are rolled up
+_ROLLUP_GRACE = timedelta(days=1)
+_ROLLUP_BATCH_SIZE = 500
+
+
+def increment_cached_abuse_metrics(
+    user_id: int, now: datetime, increments: Mapping[str, int]
+) -> dict[str, int]:
+    """Add to the user's abuse metrics for the UTC day, and return the day's totals."""
+    abuse_cache = caches[settings.ABUSE_METRICS_CACHE]
+    day = now.astimezone(UTC).date()
+    timeout = _seconds_to_expire(day, now)
+    user_prefix = _user_prefix(day, user_id)
+
+    if abuse_cache.add(user_prefix + "first", now, timeout=timeout):
+        # The first metrics for the user today, add them to the day's users
+        number = _incr(abuse_cache, _day_prefix(day) + "users", 1, timeout)
+        abuse_cache.set(f"{_day_prefix(day)}user:{number}", user_id, timeout=timeout)
+    abuse_cache.set(user_prefix + "last", now, timeout=timeout)
+
+    totals = {
+        name: _incr(abuse_cache, user_prefix + name, amount, timeout)
+        for name, amount in increments.items()
+        if amount
+    }
+    other_keys = [
+        user_prefix + name for name in ABUSE_METRIC_NAMES if name not in totals
+    ]
+    stored = abuse_cache.get_many(other_keys) if other_keys else {}
+    for name in ABUSE_METRIC_NAMES:
+        if name not in totals:
+            totals[name] = stored.get(user_prefix + name, 0)
+    return totals
+
+
+def rollup_cached_abuse_metrics(day: date) -> int:
+    """
+    Write the cached abuse metrics for a UTC day to AbuseMetrics.
+
+    The day's totals replace the stored counts, so the rollup can run repeatedly.
+    Return the number of users written.
+    """
+    from emails.models import AbuseMetrics
+
+    abuse_cache = caches[settings.ABUSE_METRICS_CACHE]
+    day_prefix = _day_prefix(day)
+    day_start = datetime.combine(day, time.min, tzinfo=UTC)
+    day_end = day_start + timedelta(days=1)
+
+    user_count = abuse_cache.get(day_prefix + "users", 0)
+    user_ids: set[int] = set()
+    for start in range(1, user_count + 1, _ROLLUP_BATCH_SIZE):
+        keys = [
+            f"{day_prefix}user:{number}"
+            for number in range(start, min(start + _ROLLUP_BATCH_SIZE, user_count + 1))
+        ]
+        user_ids.update(abuse_cache.get_many(keys).values())
+
+    written = 0
+    sorted_ids = sorted(user_ids)
+    for start in range(0, len(sorted_ids), _ROLLUP_BATCH_SIZE):
+        batch = sorted_ids[start : start + _ROLLUP_BATCH_SIZE]
+        keys = [
+            _user_prefix(day, user_id) + name
+            for user_id in batch
+            for name in (*ABUSE_METRIC_NAMES, "first", "last")
+        ]
+        stored = abuse_cache.get_many(keys)
+        for user_id in batch:
+            user_prefix = _user_prefix(day, user_id)
+            if user_prefix + "first" not in stored:
+                continue  # Expired
+            values: dict[str, Any] = {
+                name: _clamp(name, stored.get(user_prefix + name, 0))
+                for name in ABUSE_METRIC_NAMES
+            }
+            values["last_recorded"] = stored.get(
+                user_prefix + "last", stored[user_prefix + "first"]
+            )
+            day_metrics = AbuseMetrics.objects.filter(
+                user_id=user_id,
+                first_recorded__gte=day_start,
+                first_recorded__lt=day_end,
+            )
+            if not day_metrics.update(**values):
+                abuse_metric = AbuseMetrics.objects.create(user_id=user_id, **values)
+                # The dates are set to now on create, so set them afterward
+                AbuseMetrics.objects.filter(id=abuse_metric.id).update(
+                    first_recorded=stored[user_prefix + "first"],
+                    last_recorded=values["last_recorded"],
+                )
+            written += 1
+    return written
+
+
+def _day_prefix(day: date) -> str:
+    return f"{_CACHE_KEY_PREFIX}{day.isoformat()}:"
+
+
+def _user_prefix(day: date, user_id: int) -> str:
+    return f"{_day_prefix(day)}{user_id}:"
+
+
+def _seconds_to_expire(day: date, now: datetime) -> int:
+    """Return the seconds until the day's counters expire."""
+    expires = datetime.combine(day, time.min, tzinfo=UTC) + timedelta(days=1)
+    return int((expires + _ROLLUP_GRACE - now).total_seconds())
+
+
+def _incr(abuse_cache: BaseCache, key: str, amount: int, timeout: int) -> int:
+    """Add to a counter, creating it with the timeout if needed."""
+    try:
+        return abuse_cache.incr(key, amount)
+    except ValueError:
+        if abuse_cache.add(key, amount, timeout=timeout):
+            return amount
+        return abuse_cache.incr(key, amount)
+
+
+def _clamp(name: str, value: int) -> int:
+    """Limit a count to what the AbuseMetrics field can store."""
+    if name in _SMALL_INTEGER_METRICS:
+        return min(value, _SMALL_INTEGER_MAX)
+    return value
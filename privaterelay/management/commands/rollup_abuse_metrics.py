@@ -0,0 +1,33 @@
+from datetime import UTC, datetime, time, timedelta
+from typing import Any
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from emails.models import AbuseMetrics
+from privaterelay.abuse_metrics import rollup_cached_abuse_metrics
+
+
+class Command(BaseCommand):
+    help = (
+        "Copies the cached abuse metrics for yesterday and today to AbuseMetrics,"
+        " and deletes older AbuseMetrics. Run periodically when"
+        " ABUSE_METRICS_BACKEND is 'cache'."
+    )
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        if settings.ABUSE_METRICS_BACKEND != "cache":
+            self.stdout.write("ABUSE_METRICS_BACKEND is not 'cache', nothing to do.")
+            return
+
+        today = datetime.now(UTC).date()
+        yesterday = today - timedelta(days=1)
+        for day in (yesterday, today):
+            written = rollup_cached_abuse_metrics(day)
+            self.stdout.write(f"Wrote abuse metrics for {written} users on {day}.")
+
+        start_of_yesterday = datetime.combine(yesterday, time.min, tzinfo=UTC)
+        deleted, _ = AbuseMetrics.objects.filter(
+            first_recorded__lt=start_of_yesterday
+        ).delete()
+        self.stdout.write(f"Deleted {deleted} older abuse metrics.")
@@ -17,6 +17,7 @@ from django.utils.translation.trans_real import (
 
 from allauth.socialaccount.models import SocialAccount
 
+from .abuse_metrics import ABUSE_METRIC_NAMES, increment_cached_abuse_metrics
 from .country_utils import AcceptLanguageError, guess_country_from_accept_lang
 from .exceptions import CannotMakeSubdomainException
 from .sp3_plans import get_premium_countries
@@ -430,6 +431,20 @@ class Profile(models.Model):
         if self.user.email in settings.ALLOWED_ACCOUNTS:
             return None
 
+        if settings.ABUSE_METRICS_BACKEND == "cache":
+            totals = increment_cached_abuse_metrics(
+                self.user.id,
+                datetime.now(UTC),
+                {
+                    "num_address_created_per_day": int(address_created),
+                    "num_replies_per_day": int(replied),
+                    "num_email_forwarded_per_day": int(email_forwarded),
+                    "forwarded_email_size_per_day": max(forwarded_email_size, 0),
+                },
+            )
+            self._flag_if_over_abuse_limits(totals)
+            return self.last_account_flagged
+
         with transaction.atomic():
             # look for abuse metrics created on the same UTC date, regardless of time.
             midnight_utc_today = datetime.combine(
@@ -464,50 +479,51 @@ class Profile(models.Model):
             abuse_metric.last_recorded = datetime.now(UTC)
             abuse_metric.save()
 
-            # check user should be flagged for abuse
-            hit_max_create = False
-            hit_max_replies = False
-            hit_max_forwarded = False
-            hit_max_forwarded_email_size = False
-
-            hit_max_create = (
-                abuse_metric.num_address_created_per_day
-                >= settings.MAX_ADDRESS_CREATION_PER_DAY
-            )
-            hit_max_replies = (
-                abuse_metric.num_replies_per_day >= settings.MAX_REPLIES_PER_DAY
-            )
-            hit_max_forwarded = (
-                abuse_metric.num_email_forwarded_per_day
-                >= settings.MAX_FORWARDED_PER_DAY
-            )
-            hit_max_forwarded_email_size = (
-                abuse_metric.forwarded_email_size_per_day
-                >= settings.MAX_FORWARDED_EMAIL_SIZE_PER_DAY
+            self._flag_if_over_abuse_limits(
+                {name: getattr(abuse_metric, name) for name in ABUSE_METRIC_NAMES}
             )
-            if (
-                hit_max_create
-                or hit_max_replies
-                or hit_max_forwarded
-                or hit_max_forwarded_email_size
-            ):
-                self.last_account_flagged = datetime.now(UTC)
-                self.save()
-                data = {
-                    "uid": self.fxa.uid if self.fxa else None,
-                    "flagged": self.last_account_flagged.timestamp(),
-                    "replies": abuse_metric.num_replies_per_day,
-                    "addresses": abuse_metric.num_address_created_per_day,
-                    "forwarded": abuse_metric.num_email_forwarded_per_day,
-                    "forwarded_size_in_bytes": (
-                        abuse_metric.forwarded_email_size_per_day
-                    ),
-                }
-                # log for further secops review
-                abuse_logger.info("Abuse flagged", extra=data)
 
         return self.last_account_flagged
 
+    def _flag_if_over_abuse_limits(self, totals: dict[str, int]) -> None:
+        """Flag the account if the day's abuse metrics reach a limit."""
+        # check user should be flagged for abuse
+        hit_max_create = False
+        hit_max_replies = False
+        hit_max_forwarded = False
+        hit_max_forwarded_email_size = False
+
+        hit_max_create = (
+            totals["num_address_created_per_day"]
+            >= settings.MAX_ADDRESS_CREATION_PER_DAY
+        )
+        hit_max_replies = totals["num_replies_per_day"] >= settings.MAX_REPLIES_PER_DAY
+        hit_max_forwarded = (
+            totals["num_email_forwarded_per_day"] >= settings.MAX_FORWARDED_PER_DAY
+        )
+        hit_max_forwarded_email_size = (
+            totals["forwarded_email_size_per_day"]
+            >= settings.MAX_FORWARDED_EMAIL_SIZE_PER_DAY
+        )
+        if (
+            hit_max_create
+            or hit_max_replies
+            or hit_max_forwarded
+            or hit_max_forwarded_email_size
+        ):
+            self.last_account_flagged = datetime.now(UTC)
+            self.save(update_fields=["last_account_flagged"])
+            data = {
+                "uid": self.fxa.uid if self.fxa else None,
+                "flagged": self.last_account_flagged.timestamp(),
+                "replies": totals["num_replies_per_day"],
+                "addresses": totals["num_address_created_per_day"],
+                "forwarded": totals["num_email_forwarded_per_day"],
+                "forwarded_size_in_bytes": totals["forwarded_email_size_per_day"],
+            }
+            # log for further secops review
+            abuse_logger.info("Abuse flagged", extra=data)
+
     @property
     def is_flagged(self):
         if not self.last_account_flagged:
@@ -264,9 +264,19 @@ AWS_ACCESS_KEY_ID = config("AWS_ACCESS_KEY_ID", None)
 AWS_SECRET_ACCESS_KEY = config("AWS_SECRET_ACCESS_KEY", None)
 AWS_SNS_TOPIC = set(config("AWS_SNS_TOPIC", "", cast=Csv()))
 AWS_SNS_KEY_CACHE = config("AWS_SNS_KEY_CACHE", "default")
+AWS_SNS_DEDUPE_CACHE = config("AWS_SNS_DEDUPE_CACHE", "default")
+AWS_SNS_DEDUPE_SECONDS = config("AWS_SNS_DEDUPE_SECONDS", 60 * 60 * 24, cast=int)
 AWS_SES_CONFIGSET: str | None = config("AWS_SES_CONFIGSET", None)
 AWS_SQS_EMAIL_QUEUE_URL = config("AWS_SQS_EMAIL_QUEUE_URL", None)
 AWS_SQS_EMAIL_DLQ_URL = config("AWS_SQS_EMAIL_DLQ_URL", None)
+MASK_CACHE = config("MASK_CACHE", "default")
+MASK_CACHE_SECONDS = config("MASK_CACHE_SECONDS", 60 * 60 * 24, cast=int)
+# Buffer mask and profile counters, see emails/counter_buffer.py
+COUNTER_BUFFER = config(
+    "COUNTER_BUFFER", "", cast=Choices(["", "memory", "cache"], cast=str)
+)
+COUNTER_BUFFER_CACHE = config("COUNTER_BUFFER_CACHE", "default")
+COUNTER_BUFFER_FLUSH_SECONDS = config("COUNTER_BUFFER_FLUSH_SECONDS", 10, cast=int)
 
 RELAY_FROM_ADDRESS: str = config("RELAY_FROM_ADDRESS", "")
 GOOGLE_ANALYTICS_ID = config("GOOGLE_ANALYTICS_ID", None)
@@ -469,6 +479,13 @@ MAX_FORWARDED_PER_DAY: int = config("MAX_FORWARDED_PER_DAY", 1000, cast=int)
 MAX_FORWARDED_EMAIL_SIZE_PER_DAY: int = config(
     "MAX_FORWARDED_EMAIL_SIZE_PER_DAY", 1_000_000_000, cast=int
 )
+# Count abuse metrics in the database or a cache, see privaterelay/abuse_metrics.py
+ABUSE_METRICS_BACKEND = config(
+    "ABUSE_METRICS_BACKEND",
+    "database",
+    cast=Choices(["database", "cache"], cast=str),
+)
+ABUSE_METRICS_CACHE = config("ABUSE_METRICS_CACHE", "default")
 PREMIUM_FEATURE_PAUSED_DAYS: int = config(
     "ACCOUNT_PREMIUM_FEATURE_PAUSED_DAYS", 1, cast=int
 )
@@ -932,12 +949,28 @@ if USE_SILK:
 PROCESS_EMAIL_BATCH_SIZE = config(
     "PROCESS_EMAIL_BATCH_SIZE", 10, cast=Choices(range(1, 11), cast=int)
 )
+PROCESS_EMAIL_ADAPTIVE_POLLING = config(
+    "PROCESS_EMAIL_ADAPTIVE_POLLING", False, cast=bool
+)
+PROCESS_EMAIL_MIN_BATCH_SIZE = config(
+    "PROCESS_EMAIL_MIN_BATCH_SIZE", 1, cast=Choices(range(1, 11), cast=int)
+)
+PROCESS_EMAIL_MIN_WAIT_SECONDS = config("PROCESS_EMAIL_MIN_WAIT_SECONDS", 0, cast=int)
+PROCESS_EMAIL_RETRY_BACKOFF_SECONDS = config(
+    "PROCESS_EMAIL_RETRY_BACKOFF_SECONDS", 15, cast=int
+)
 PROCESS_EMAIL_DELETE_FAILED_MESSAGES = config(
     "PROCESS_EMAIL_DELETE_FAILED_MESSAGES", False, cast=bool
 )
 PROCESS_EMAIL_HEALTHCHECK_PATH = config(
     "PROCESS_EMAIL_HEALTHCHECK_PATH", os.path.join(TMP_DIR, "healthcheck.json")
 )
+PROCESS_EMAIL_HEALTHCHECK_SECONDS = config(
+    "PROCESS_EMAIL_HEALTHCHECK_SECONDS", 5.0, cast=float
+)
+PROCESS_EMAIL_QUEUE_REFRESH_SECONDS = config(
+    "PROCESS_EMAIL_QUEUE_REFRESH_SECONDS", 15.0, cast=float
+)
 PROCESS_EMAIL_MAX_SECONDS = config("PROCESS_EMAIL_MAX_SECONDS", 0, cast=int) or None
 PROCESS_EMAIL_VERBOSITY = config(
     "PROCESS_EMAIL_VERBOSITY", 1, cast=Choices(range(0, 4), cast=int)
@@ -949,6 +982,8 @@ PROCESS_EMAIL_WAIT_SECONDS = config("PROCESS_EMAIL_WAIT_SECONDS", 5, cast=int)
 PROCESS_EMAIL_HEALTHCHECK_MAX_AGE = config(
     "PROCESS_EMAIL_HEALTHCHECK_MAX_AGE", 120, cast=int
 )
+PROCESS_EMAIL_CONCURRENCY = config("PROCESS_EMAIL_CONCURRENCY", 1, cast=int)
+PROCESS_EMAIL_PREFETCH = config("PROCESS_EMAIL_PREFETCH", False, cast=bool)
 PROCESS_EMAIL_MAX_SECONDS_PER_MESSAGE = config(
     "PROCESS_EMAIL_MAX_SECONDS_PER_MESSAGE",
     PROCESS_EMAIL_MAX_SECONDS or 120.0,
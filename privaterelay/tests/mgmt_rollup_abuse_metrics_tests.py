@@ -0,0 +1,98 @@
+from collections.abc import Iterator
+from datetime import UTC, datetime, timedelta
+
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.core.management import call_command
+
+import pytest
+from model_bakery import baker
+from pytest_django.fixtures import SettingsWrapper
+
+from emails.models import AbuseMetrics
+from privaterelay.abuse_metrics import increment_cached_abuse_metrics
+
+COMMAND_NAME = "rollup_abuse_metrics"
+
+
+@pytest.fixture(autouse=True)
+def cached_abuse_metrics(settings: SettingsWrapper) -> Iterator[None]:
+    settings.ABUSE_METRICS_BACKEND = "cache"
+    settings.ABUSE_METRICS_CACHE = "default"
+    caches["default"].clear()
+    yield
+    caches["default"].clear()
+
+
+@pytest.mark.django_db
+def test_rollup_abuse_metrics_writes_cached_totals() -> None:
+    user = baker.make(User)
+    now = datetime.now(UTC)
+    increment_cached_abuse_metrics(
+        user.id,
+        now,
+        {"num_email_forwarded_per_day": 1, "forwarded_email_size_per_day": 100},
+    )
+    increment_cached_abuse_metrics(user.id, now, {"num_replies_per_day": 1})
+
+    call_command(COMMAND_NAME)
+
+    abuse_metric = AbuseMetrics.objects.get(user=user)
+    assert abuse_metric.first_recorded == now
+    assert abuse_metric.last_recorded == now
+    assert abuse_metric.num_email_forwarded_per_day == 1
+    assert abuse_metric.forwarded_email_size_per_day == 100
+    assert abuse_metric.num_replies_per_day == 1
+    assert abuse_metric.num_address_created_per_day == 0
+
+    increment_cached_abuse_metrics(user.id, now, {"num_email_forwarded_per_day": 1})
+    call_command(COMMAND_NAME)
+
+    abuse_metric = AbuseMetrics.objects.get(user=user)
+    assert abuse_metric.num_email_forwarded_per_day == 2
+    assert abuse_metric.num_replies_per_day == 1
+
+
+@pytest.mark.django_db
+def test_rollup_abuse_metrics_yesterday_and_older() -> None:
+    user = baker.make(User)
+    yesterday = datetime.now(UTC) - timedelta(days=1)
+    increment_cached_abuse_metrics(
+        user.id, yesterday, {"num_address_created_per_day": 1}
+    )
+    old_metric = baker.make(AbuseMetrics, user=user)
+    AbuseMetrics.objects.filter(id=old_metric.id).update(
+        first_recorded=yesterday - timedelta(days=2)
+    )
+
+    call_command(COMMAND_NAME)
+
+    abuse_metric = AbuseMetrics.objects.get(user=user)
+    assert abuse_metric.first_recorded == yesterday
+    assert abuse_metric.num_address_created_per_day == 1
+
+
+@pytest.mark.django_db
+def test_rollup_abuse_metrics_limits_small_counts() -> None:
+    user = baker.make(User)
+    increment_cached_abuse_metrics(
+        user.id, datetime.now(UTC), {"num_email_forwarded_per_day": 40_000}
+    )
+
+    call_command(COMMAND_NAME)
+
+    abuse_metric = AbuseMetrics.objects.get(user=user)
+    assert abuse_metric.num_email_forwarded_per_day == 32767
+
+
+@pytest.mark.django_db
+def test_rollup_abuse_metrics_database_backend(settings: SettingsWrapper) -> None:
+    settings.ABUSE_METRICS_BACKEND = "database"
+    user = baker.make(User)
+    increment_cached_abuse_metrics(
+        user.id, datetime.now(UTC), {"num_replies_per_day": 1}
+    )
+
+    call_command(COMMAND_NAME)
+
+    assert not AbuseMetrics.objects.exists()
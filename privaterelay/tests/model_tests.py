@@ -5,6 +5,7 @@ from uuid import uuid4
 
 from django.conf import settings
 from django.contrib.auth.models import User
+from django.core.cache import caches
 from django.test import TestCase, override_settings
 
 import pytest
@@ -758,6 +759,72 @@ class ProfileUpdateAbuseMetricTest(ProfileTestCase):
         assert self.abuse_metric.forwarded_email_size_per_day == 100
         assert self.profile.last_account_flagged == self.expected_now
 
+    @override_settings(MAX_FORWARDED_PER_DAY=5)
+    def test_flagging_profile_only_saves_last_account_flagged(self) -> None:
+        self.abuse_metric.num_email_forwarded_per_day = 4
+        self.abuse_metric.save()
+        # Another process changed the profile since it was loaded
+        Profile.objects.filter(id=self.profile.id).update(num_address_deleted=10)
+
+        self.profile.update_abuse_metric(email_forwarded=True)
+
+        self.profile.refresh_from_db()
+        assert self.profile.last_account_flagged == self.expected_now
+        assert self.profile.num_address_deleted == 10
+
+
+@override_settings(ABUSE_METRICS_BACKEND="cache", ABUSE_METRICS_CACHE="default")
+class ProfileUpdateAbuseMetricCacheTest(ProfileTestCase):
+    """Tests for Profile.update_abuse_metric() with cached abuse metrics"""
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.get_or_create_social_account()
+        caches["default"].clear()
+        self.addCleanup(caches["default"].clear)
+
+        patcher_logger = patch("privaterelay.models.abuse_logger.info")
+        self.mocked_abuse_info = patcher_logger.start()
+        self.addCleanup(patcher_logger.stop)
+
+    @override_settings(MAX_FORWARDED_PER_DAY=3)
+    def test_flags_profile_when_emails_forwarded_abuse_threshold_met(self) -> None:
+        for _ in range(2):
+            assert self.profile.update_abuse_metric(email_forwarded=True) is None
+        self.mocked_abuse_info.assert_not_called()
+
+        flagged = self.profile.update_abuse_metric(
+            email_forwarded=True, forwarded_email_size=10
+        )
+
+        assert flagged is not None
+        assert self.profile.fxa
+        self.mocked_abuse_info.assert_called_once_with(
+            "Abuse flagged",
+            extra={
+                "uid": self.profile.fxa.uid,
+                "flagged": flagged.timestamp(),
+                "replies": 0,
+                "addresses": 0,
+                "forwarded": 3,
+                "forwarded_size_in_bytes": 10,
+            },
+        )
+        self.profile.refresh_from_db()
+        assert self.profile.last_account_flagged == flagged
+        assert not AbuseMetrics.objects.exists()
+
+    @override_settings(MAX_ADDRESS_CREATION_PER_DAY=2)
+    def test_counts_each_user_separately(self) -> None:
+        other_profile = baker.make(User).profile
+        self.profile.update_abuse_metric(address_created=True)
+        other_profile.update_abuse_metric(address_created=True)
+        assert self.profile.last_account_flagged is None
+        assert other_profile.last_account_flagged is None
+
+        assert self.profile.update_abuse_metric(address_created=True) is not None
+        assert other_profile.last_account_flagged is None
+
 
 class ProfileMetricsEnabledTest(ProfileTestCase):
     def test_no_fxa_means_metrics_enabled(self) -> None:
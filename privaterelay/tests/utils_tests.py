@@ -1,6 +1,7 @@
 import logging
 import pickle
 from collections.abc import Iterator
+from datetime import UTC, datetime
 from pathlib import Path
 from unittest.mock import patch
 
@@ -11,11 +12,14 @@ from django.test import RequestFactory
 import pytest
 from _pytest.fixtures import SubRequest
 from _pytest.logging import LogCaptureFixture
+from model_bakery import baker
 from pytest_django.fixtures import SettingsWrapper
 from waffle.models import AbstractUserFlag, Flag
 from waffle.testutils import override_flag
 from waffle.utils import get_cache as get_waffle_cache
 
+from emails.models import RelayAddress
+
 from ..country_utils import AcceptLanguageError, guess_country_from_accept_lang
 from ..sp3_plans import get_sp3_country_language_mapping
 from ..utils import (
@@ -24,6 +28,7 @@ from ..utils import (
     get_subplat_upgrade_link_by_language,
     get_version_info,
     parse_relay_client_platform,
+    update_counters,
 )
 
 
@@ -679,3 +684,44 @@ def test_parse_relay_client_platform(
     relay_client_platform: str, expected_os_platform: tuple
 ) -> None:
     assert parse_relay_client_platform(relay_client_platform) == expected_os_platform
+
+
+@pytest.mark.django_db
+def test_update_counters_adds_and_sets() -> None:
+    user = baker.make(User)
+    address = baker.make(RelayAddress, user=user, num_forwarded=2)
+    last_used_at = datetime(2024, 1, 2, tzinfo=UTC)
+
+    update_counters(address, {"num_forwarded": 1}, last_used_at=last_used_at)
+
+    assert address.num_forwarded == 3
+    assert address.last_used_at == last_used_at
+    address.refresh_from_db()
+    assert address.num_forwarded == 3
+    assert address.last_used_at == last_used_at
+
+
+@pytest.mark.django_db
+def test_update_counters_null_counter_is_zero() -> None:
+    profile = baker.make(User).profile
+    profile.num_level_one_trackers_blocked_in_deleted_address = None
+    profile.save()
+
+    update_counters(profile, {"num_level_one_trackers_blocked_in_deleted_address": 2})
+
+    assert profile.num_level_one_trackers_blocked_in_deleted_address == 2
+    profile.refresh_from_db()
+    assert profile.num_level_one_trackers_blocked_in_deleted_address == 2
+
+
+@pytest.mark.django_db
+def test_update_counters_keeps_concurrent_updates() -> None:
+    address = baker.make(RelayAddress, user=baker.make(User))
+    stale_address = RelayAddress.objects.get(id=address.id)
+
+    update_counters(address, {"num_blocked": 1})
+    update_counters(stale_address, {"num_blocked": 1})
+
+    assert stale_address.num_blocked == 1
+    address.refresh_from_db()
+    assert address.num_blocked == 2
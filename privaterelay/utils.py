@@ -3,14 +3,16 @@ from __future__ import annotations
 import json
 import logging
 import random
-from collections.abc import Callable
+from collections.abc import Callable, Mapping
 from decimal import Decimal
 from functools import cache, wraps
 from pathlib import Path
-from typing import TYPE_CHECKING, ParamSpec, TypedDict, TypeVar, cast
+from typing import TYPE_CHECKING, Any, ParamSpec, TypedDict, TypeVar, cast
 
 from django.conf import settings
 from django.contrib.auth.models import AbstractBaseUser
+from django.db.models import F, IntegerField, Model
+from django.db.models.functions import Coalesce
 from django.http import Http404, HttpRequest
 
 from waffle import get_waffle_flag_model
@@ -305,3 +307,27 @@ def glean_logger() -> RelayGleanLogger:
         app_display_version=version_info["version"],
         channel=settings.RELAY_CHANNEL,
     )
+
+
+def update_counters(
+    instance: Model, counters: Mapping[str, int] | None = None, **values: Any
+) -> None:
+    """
+    Add to counters and set values on a saved model, with a single UPDATE.
+
+    The counters are added in the database with F() expressions, so updates from
+    concurrent workers are not lost, and only the changed columns are written. A
+    null counter counts as 0. Model.save() and the save signals are not run.
+
+    The instance gets the same changes. Its counters are not reloaded, so they do
+    not include concurrent updates.
+    """
+    counters = counters or {}
+    changes: dict[str, Any] = dict(values)
+    for name, amount in counters.items():
+        changes[name] = Coalesce(F(name), 0, output_field=IntegerField()) + amount
+    type(instance)._default_manager.filter(pk=instance.pk).update(**changes)
+    for name, amount in counters.items():
+        setattr(instance, name, (getattr(instance, name) or 0) + amount)
+    for name, value in values.items():
+        setattr(instance, name, value)